@@ -1,3 +1,6 @@
 from abots.events.every import Every
 from abots.events.threads import ThreadPool, ThreadMarshal, acquire_timeout
+from abots.events.processes import ProcessPool
 from abots.events.duodecimer import Duodecimer, Cron
+from abots.events.executor import MarshalExecutor
+from abots.events.autoscaler import Autoscaler
@@ -0,0 +1,157 @@
+from abots.events.every import Every
+
+from collections import deque
+from time import time, monotonic
+
+"""
+
+Autoscaler
+==========
+
+Grows and shrinks the workers of a `ThreadMarshal` one worker at a time, going
+by how long tasks waited in its queue and how busy its workers were since the
+last check. The marshal has to use the priority scheduler, whose queue keeps
+the wait times (with every task at the same priority it is a plain FIFO), and
+`max_pools=1` so that it never adds whole pools on its own. The `pool_size`
+threads it starts with are the fewest it will have.
+
+A worker is added as soon as tasks waited longer than `grow_wait` on average,
+or the workers were busier than `high_utilization`. One is only removed once
+tasks waited no longer than `shrink_wait` while the workers were less busy
+than `low_utilization`, for `patience` checks in a row, so that a burst does
+not set it swinging back and forth.
+
+"""
+
+class Autoscaler:
+    def __init__(self, marshal, max_workers=None, interval=1, grow_wait=0.01,
+        shrink_wait=0.001, high_utilization=0.9, low_utilization=0.5,
+        patience=3, history=100):
+        if marshal.scheduler != "priority":
+            raise ValueError("Autoscaling needs the priority scheduler")
+        if marshal.max_pools != 1:
+            raise ValueError("Autoscaling needs a single pool")
+        self.marshal = marshal
+        self.min_workers = marshal.pool_size
+        if max_workers is None:
+            max_workers = 4 * marshal.pool_size
+        self.max_workers = max(max_workers, self.min_workers)
+        self.interval = interval
+        self.grow_wait = grow_wait
+        self.shrink_wait = shrink_wait
+        self.high_utilization = high_utilization
+        self.low_utilization = low_utilization
+        self.patience = patience
+
+        # What was measured at the last check and what was done about it
+        self.wait = 0
+        self.utilization = 0
+        self.grown = 0
+        self.shrunk = 0
+        self.decisions = deque(maxlen=history)
+
+        self._calm = 0
+        self._previous = None
+        self.every = Every(interval, self._check)
+
+    def _totals(self, pool):
+        ran, waited = self.marshal.wait_stats.totals()
+        return monotonic(), ran, waited, pool.busy_time()
+
+    def _measure(self, pool):
+        totals = self._totals(pool)
+        previous = self._previous
+        self._previous = totals
+        if previous is None:
+            return False
+        elapsed, ran, waited, busy = [now - then
+            for now, then in zip(totals, previous)]
+        if ran > 0:
+            self.wait = waited / ran
+        # Nothing got to run while tasks were waiting the whole time
+        elif pool.queues[0].qsize() > 0:
+            self.wait = elapsed
+        else:
+            self.wait = 0
+        self.utilization = min(busy / (elapsed * pool.size()), 1)
+        return True
+
+    def _decide(self, pool):
+        workers = pool.size()
+        if self.wait > self.grow_wait or (
+            self.utilization > self.high_utilization):
+            self._calm = 0
+            if workers < self.max_workers:
+                pool.add_worker(self.interval)
+                self.grown = self.grown + 1
+                return "grow"
+            return "hold"
+        if self.wait <= self.shrink_wait and (
+            self.utilization < self.low_utilization):
+            self._calm = self._calm + 1
+            if self._calm >= self.patience and workers > self.min_workers:
+                self._calm = 0
+                pool.remove_worker()
+                self.shrunk = self.shrunk + 1
+                return "shrink"
+            return "hold"
+        self._calm = 0
+        return "hold"
+
+    def _check(self, state):
+        # NOTE: The pool goes away once the marshal is stopped
+        if len(self.marshal.pools) == 0:
+            self.stop()
+            return None
+        pool = self.marshal.pools[0]
+        if not self._measure(pool):
+            return None
+        action = self._decide(pool)
+        decision = dict()
+        decision["time"] = time()
+        decision["action"] = action
+        decision["workers"] = pool.size()
+        decision["wait"] = self.wait
+        decision["utilization"] = self.utilization
+        self.decisions.append(decision)
+        return None
+
+    def start(self):
+        self.every.start()
+
+    def stop(self):
+        self.every.stop()
+
+    def workers(self):
+        if len(self.marshal.pools) == 0:
+            return 0
+        return self.marshal.pools[0].size()
+
+    def snapshot(self):
+        snapshot = dict()
+        snapshot["workers"] = self.workers()
+        snapshot["min_workers"] = self.min_workers
+        snapshot["max_workers"] = self.max_workers
+        snapshot["wait"] = self.wait
+        snapshot["utilization"] = self.utilization
+        snapshot["grown"] = self.grown
+        snapshot["shrunk"] = self.shrunk
+        snapshot["decisions"] = list(self.decisions)
+        return snapshot
+
+    # Renders a snapshot in the Prometheus text exposition format
+    def export(self, prefix="abots_autoscaler"):
+        snapshot = self.snapshot()
+        lines = list()
+        metrics = list()
+        metrics.append(("workers", "gauge", snapshot["workers"]))
+        metrics.append(("min_workers", "gauge", snapshot["min_workers"]))
+        metrics.append(("max_workers", "gauge", snapshot["max_workers"]))
+        metrics.append(("wait_seconds", "gauge", snapshot["wait"]))
+        metrics.append(("utilization", "gauge", snapshot["utilization"]))
+        metrics.append(("grown_total", "counter", snapshot["grown"]))
+        metrics.append(("shrunk_total", "counter", snapshot["shrunk"]))
+        for name, kind, value in metrics:
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            lines.append(f"{prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
@@ -1,9 +1,11 @@
 from abots.events import Every, ThreadMarshal
+from abots.events.threads import backends
 from abots.helpers import cast, utc_now
 
 from queue import Queue, Empty
 from collections import defaultdict
-from threading import Thread, Event
+from threading import Thread, Event, Lock
+from os import cpu_count
 
 """
 
@@ -113,6 +115,10 @@ class Duodecimer:
     def __init__(self):
         self.queues = dict()
         self.timers = dict()
+        # Marshals kept for tasks routed to backends other than threads, which
+        # are too costly to start up again every time the timer goes off
+        self.marshals = dict()
+        self._marshals_lock = Lock()
         self._intervals = dict()
         self._intervals["5s"] = 5
         self._intervals["30s"] = 30
@@ -163,8 +169,16 @@ class Duodecimer:
         else:
             return now == value
 
+    def _marshal(self, backend):
+        with self._marshals_lock:
+            marshal = self.marshals.get(backend, None)
+            if marshal is None:
+                marshal = ThreadMarshal(cpu_count(), backend=backend)
+                self.marshals[backend] = marshal
+            return marshal
+
     def _timer(self, state, queue):
-        state = self._process_queue(state, queue, 3)
+        state = self._process_queue(state, queue, 4)
         marshal = ThreadMarshal(len(state), destroy=True)
         cancelled = list()
         for job in state:
@@ -173,7 +187,11 @@ class Duodecimer:
             if cancel.is_set():
                 cancelled.append(job)
                 continue
-            marshal.reserve(*task)
+            method, args, kwargs, backend = task
+            if backend == "thread":
+                marshal.reserve(method, args, kwargs)
+            else:
+                self._marshal(backend).reserve(method, args, kwargs)
         for job in cancelled:
             state.remove(job)
         return state
@@ -219,11 +237,20 @@ class Duodecimer:
     def stop(self):
         for name, timer in self.timers.items():
             timer.stop()
+        with self._marshals_lock:
+            for backend, marshal in self.marshals.items():
+                marshal.stop()
+            self.marshals.clear()
 
-    def assign(self, timer, method, args=tuple(), kwargs=dict()):
+    # The `backend` runs the task on a pool of that kind, such as "process"
+    def assign(self, timer, method, args=tuple(), kwargs=dict(),
+        backend="thread"):
         if timer not in self.queues.keys():
             return None
-        task = method, args, kwargs
+        # NOTE: Checked now, it would only fail once the timer goes off
+        if backend not in backends:
+            return None
+        task = method, args, kwargs, backend
         cancel = Event()
         job = cancel, task
         self.queues[timer].put(job)
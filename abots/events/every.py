@@ -1,4 +1,4 @@
-from time import monotonic, sleep
+from time import monotonic
 from threading import Event, Thread
 
 class Every:
@@ -14,7 +14,9 @@ class Every:
         state = None
         while not self.event.is_set():
             state = self.function(state, *args, **kwargs)
-            sleep(self.interval - ((monotonic() - start) % self.interval))
+            delay = self.interval - ((monotonic() - start) % self.interval)
+            # Waits on the event rather than sleeping so `stop` wakes it up
+            self.event.wait(delay)
 
     def start(self):
         args = self.args
@@ -0,0 +1,81 @@
+from abots.events.threads import ThreadMarshal
+
+from concurrent.futures import Executor, Future, wait as wait_futures
+from threading import Thread, Lock
+
+"""
+
+MarshalExecutor
+===============
+
+A `concurrent.futures.Executor` running its tasks on a `ThreadMarshal`, so the
+results and exceptions of tasks come back through real futures instead of
+being lost in the worker. It can be handed a marshal to share, otherwise it
+makes one with a single pool of `max_workers` workers that tasks queue up on,
+of the given `backend`. With the "process" backend the calls and their
+results are pickled, so they have to be importable and picklable.
+
+`submit_many` queues any number of calls at once while only taking the lock of
+the marshal a single time, rather than once for each of them.
+
+"""
+
+class MarshalExecutor(Executor):
+    def __init__(self, max_workers=4, marshal=None, scheduler="shared",
+        backend="thread"):
+        self._owned = marshal is None
+        if marshal is None:
+            marshal = ThreadMarshal(max_workers, scheduler=scheduler,
+                max_pools=1, backend=backend)
+        self.marshal = marshal
+        self._shutdown = False
+        self._lock = Lock()
+
+        # Futures that have not finished yet, so `shutdown` can cancel them
+        self._pending = set()
+
+    def _untrack(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def submit(self, fn, *args, **kwargs):
+        return self.submit_many([(fn, args, kwargs)])[0]
+
+    # Submits each of the `(fn, args, kwargs)` calls, returning their futures
+    def submit_many(self, calls):
+        futures = list()
+        tasks = list()
+        for fn, args, kwargs in calls:
+            futures.append(Future())
+            tasks.append((fn, tuple(args), dict(kwargs)))
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("Cannot submit after shutdown")
+            self._pending.update(futures)
+        # NOTE: Not under the lock, which every finished future takes
+        for future in futures:
+            future.add_done_callback(self._untrack)
+        # The workers resolve them, skipping the ones cancelled meanwhile
+        self.marshal.reserve_many(tasks, futures=futures)
+        return futures
+
+    # Waits for whatever is left to finish before stopping the marshal, whose
+    # workers would otherwise leave the tasks queued up on them never run
+    def _finish(self, pending):
+        wait_futures(pending)
+        if self._owned:
+            self.marshal.stop()
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self._lock:
+            self._shutdown = True
+            pending = list(self._pending)
+        if cancel_futures:
+            for future in pending:
+                future.cancel()
+        if wait:
+            self._finish(pending)
+            return
+        thread = Thread(target=self._finish, args=(pending,))
+        thread.setDaemon(True)
+        thread.start()
@@ -0,0 +1,138 @@
+from abots.events.threads import ThreadPool, backends
+
+from multiprocessing import get_context
+from pickle import dumps, loads
+
+"""
+
+ProcessPool
+===========
+
+A `ThreadPool` whose workers each hand their tasks off to a process of their
+own, for CPU-bound tasks that would otherwise all take turns on the GIL. The
+threads are kept so everything else stays the same, including the controls
+run once a task is done and how a `ThreadMarshal` grows and cleans up its
+pools, which it does for this backend when made with `backend="process"`.
+
+Tasks are pickled over to the process, so their methods have to be importable
+by it. A task whose only argument is bytes has the bytes sent as they are,
+without being pickled, as do results that are bytes. What a task returns or
+raises comes back through the future it was reserved with, if any, see
+`ThreadMarshal.reserve`. A task that cannot be unpickled by the process, or
+whose result cannot be pickled back, raises the error that caused it.
+
+"""
+
+# Kinds of task, sent as the first byte of its message. A task of bytes is
+# followed by a message of the bytes themselves.
+task_pickled = 0
+task_bytes = 1
+
+# Kinds of reply to a task
+reply_value = 0
+reply_bytes = 1
+reply_error = 2
+
+def _reply_error(conn, error):
+    try:
+        loads(dumps(error))
+    # Not every exception survives being pickled
+    except Exception:
+        error = RuntimeError(repr(error))
+    conn.send((reply_error, error))
+
+# Run in each process, serving the tasks its worker sends down the pipe
+def _serve(conn):
+    while True:
+        try:
+            message = conn.recv_bytes()
+            # NOTE: Read before anything can fail so the pipe stays in step
+            if len(message) > 0 and message[0] == task_bytes:
+                data = conn.recv_bytes()
+        except EOFError:
+            break
+        # NOTE: Sentinel sent once the worker stops
+        if len(message) == 0:
+            break
+        try:
+            if message[0] == task_bytes:
+                method = loads(memoryview(message)[1:])
+                args = data,
+                kwargs = dict()
+            else:
+                method, args, kwargs = loads(memoryview(message)[1:])
+            result = method(*args, **kwargs)
+        except Exception as e:
+            _reply_error(conn, e)
+            continue
+        try:
+            if isinstance(result, (bytes, bytearray)):
+                conn.send((reply_bytes, None))
+                conn.send_bytes(result)
+            else:
+                conn.send((reply_value, result))
+        # The worker is gone
+        except OSError:
+            break
+        # NOTE: Nothing was sent, the result is pickled before that
+        except Exception as e:
+            _reply_error(conn, e)
+    conn.close()
+
+class ProcessPool(ThreadPool):
+    def __init__(self, pool_size, timeout=None, scheduler="dedicated",
+        aging=None, stats=None, start_method="spawn"):
+        # NOTE: Spawned rather than forked, the parent is full of threads
+        self.context = get_context(start_method)
+        # The pipe to the process of each worker and the process, by its id
+        self.conns = dict()
+        self.processes = dict()
+        for s in range(pool_size):
+            self.conns[s], self.processes[s] = self._spawn()
+        super().__init__(pool_size, timeout, scheduler, aging, stats)
+
+    def _spawn(self):
+        conn, child = self.context.Pipe()
+        process = self.context.Process(target=_serve, args=(child,))
+        process.daemon = True
+        process.start()
+        child.close()
+        return conn, process
+
+    def _execute(self, worker_id, method, args, kwargs):
+        conn = self.conns[worker_id]
+        try:
+            if len(args) == 1 and len(kwargs) == 0 and isinstance(args[0],
+                (bytes, bytearray, memoryview)):
+                conn.send_bytes(bytes([task_bytes]) + dumps(method))
+                conn.send_bytes(args[0])
+            else:
+                task = method, args, kwargs
+                conn.send_bytes(bytes([task_pickled]) + dumps(task))
+            kind, result = conn.recv()
+            if kind == reply_bytes:
+                result = conn.recv_bytes()
+        except (EOFError, OSError):
+            # The process died, so the next task gets a new one
+            conn.close()
+            self.conns[worker_id], self.processes[worker_id] = self._spawn()
+            raise ChildProcessError(f"Worker {worker_id} process died")
+        if kind == reply_error:
+            raise result
+        return result
+
+    # Stops the process along with its worker, once it has no tasks left
+    def _worker(self, worker_id, event, queue, timeout=None):
+        # Workers added by `add_worker` start their own process
+        if worker_id not in self.conns:
+            self.conns[worker_id], self.processes[worker_id] = self._spawn()
+        super()._worker(worker_id, event, queue, timeout)
+        conn = self.conns.pop(worker_id)
+        try:
+            conn.send_bytes(b"")
+        except OSError:
+            pass
+        conn.close()
+        self.processes.pop(worker_id).join()
+
+backends["process"] = ProcessPool
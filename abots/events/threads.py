@@ -1,9 +1,13 @@
-from abots.helpers import eprint, cast
+from abots.helpers import eprint, cast, noop
 from abots.events import Every
 
 from queue import Queue, Empty, Full
-from threading import Thread, Event, Lock, RLock, BoundedSemaphore
+from threading import Thread, Event, Lock, RLock, BoundedSemaphore, Condition
 from contextlib import contextmanager
+from collections import deque
+from time import monotonic
+from heapq import heappush, heappop
+from itertools import count
 
 """
 TODO:
@@ -18,17 +22,251 @@ def acquire_timeout(lock, timeout=-1):
     if result:
         lock.release()
 
+# Ways a `ThreadPool` can hand out the jobs put on its queues:
+# - dedicated: each worker has its own queue and only runs what is put on it
+# - shared: the workers all take from one queue, whichever is free first
+# - stealing: each worker has its own queue, but takes the oldest job waiting
+#   on the busiest of the others whenever its own is empty
+# - priority: the workers all take from one queue, most urgent job first
+schedulers = ["dedicated", "shared", "stealing", "priority"]
+
+# One of the queues of a pool in the stealing scheduler, with just enough of
+# the interface of `Queue` for `ThreadPool` and `ThreadMarshal`
+class StealingQueue:
+    def __init__(self, siblings, condition):
+        # Every queue of the pool, including this one, sharing the condition
+        self.siblings = siblings
+        self.condition = condition
+        self._jobs = deque()
+
+    def put_nowait(self, job):
+        with self.condition:
+            self._jobs.append(job)
+            # Any idle worker can take a task, but pills are only for the
+            # worker they were put in for
+            if len(job) == 2 and job[1] is None:
+                self.condition.notify_all()
+            else:
+                self.condition.notify()
+
+    def put(self, job, block=True, timeout=None):
+        self.put_nowait(job)
+
+    # Takes the next task of the busiest sibling, passing over the ones that
+    # have a pill up next since that is for their own worker
+    def _steal(self):
+        victims = sorted(self.siblings, key=lambda queue: len(queue._jobs),
+            reverse=True)
+        for victim in victims:
+            if len(victim._jobs) == 0:
+                return None
+            job = victim._jobs[0]
+            if len(job) == 2 and job[1] is None:
+                continue
+            return victim._jobs.popleft()
+        return None
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.condition:
+            while True:
+                if len(self._jobs) > 0:
+                    return self._jobs.popleft()
+                job = self._steal()
+                if job is not None:
+                    return job
+                if not block:
+                    raise Empty
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        raise Empty
+                self.condition.wait(remaining)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def task_done(self):
+        pass
+
+    def qsize(self):
+        return len(self._jobs)
+
+    def empty(self):
+        return len(self._jobs) == 0
+
+# How long jobs waited in a priority queue before running, for each priority
+# NOTE: Locked, every worker of every pool of a marshal updates the same one
+class WaitStats:
+    def __init__(self):
+        # Jobs run, jobs expired, total and longest wait in seconds
+        self.classes = dict()
+        self._lock = Lock()
+
+    def _class(self, priority):
+        counters = self.classes.get(priority, None)
+        if counters is None:
+            counters = [0, 0, 0, 0]
+            self.classes[priority] = counters
+        return counters
+
+    def waited(self, priority, seconds):
+        with self._lock:
+            counters = self._class(priority)
+            counters[0] = counters[0] + 1
+            counters[2] = counters[2] + seconds
+            counters[3] = max(counters[3], seconds)
+
+    def expired(self, priority):
+        with self._lock:
+            counters = self._class(priority)
+            counters[1] = counters[1] + 1
+
+    # Jobs run and the seconds they waited in total, over every priority
+    def totals(self):
+        ran = 0
+        waited = 0
+        with self._lock:
+            for counters in self.classes.values():
+                ran = ran + counters[0]
+                waited = waited + counters[2]
+        return ran, waited
+
+    def snapshot(self):
+        snapshot = dict()
+        with self._lock:
+            classes = [(priority, list(counters))
+                for priority, counters in self.classes.items()]
+        for priority, counters in sorted(classes):
+            ran, expired, total, longest = counters
+            stats = dict()
+            stats["ran"] = ran
+            stats["expired"] = expired
+            stats["wait_mean"] = total / ran if ran > 0 else 0
+            stats["wait_max"] = longest
+            snapshot[priority] = stats
+        return snapshot
+
+# The one queue of a pool in the priority scheduler, where lower priorities run
+# first. Jobs gain a priority for every `aging` seconds they wait so that none
+# wait forever, which leaves their order fixed by `priority * aging` plus the
+# time they were queued. Without `aging` priorities are strict.
+class PriorityJobQueue:
+    def __init__(self, aging=None, stats=None):
+        self.aging = aging
+        self.stats = WaitStats() if stats is None else stats
+        self.condition = Condition()
+        self._heap = list()
+        # Breaks ties in the order jobs were queued
+        self._order = count()
+
+    # A job whose `deadline` (by `monotonic`) passes before it starts has its
+    # task handed to `on_expired` instead of being run
+    def put_nowait(self, job, priority=0, deadline=None, on_expired=None):
+        queued = monotonic()
+        if self.aging is None:
+            rank = priority
+        else:
+            rank = queued + priority * self.aging
+        entry = rank, next(self._order), queued, priority, deadline, on_expired
+        with self.condition:
+            heappush(self._heap, entry + (job,))
+            self.condition.notify()
+
+    def put(self, job, block=True, timeout=None):
+        self.put_nowait(job)
+
+    def _expire(self, job, on_expired):
+        controls, task = job
+        future = controls.pop("future", None)
+        if future is not None and future.set_running_or_notify_cancel():
+            future.set_exception(TimeoutError("Task expired before it ran"))
+        # The controls still run, which sets it done and frees its worker
+        if on_expired is None:
+            return controls, (noop, tuple(), dict())
+        # Run by the worker thread itself, never sent off to another process
+        controls["inline"] = True
+        return controls, (on_expired, (task,), dict())
+
+    def _pop(self):
+        entry = heappop(self._heap)
+        queued, priority, deadline, on_expired, job = entry[2:]
+        now = monotonic()
+        # NOTE: Pills never expire
+        pill = len(job) == 2 and job[1] is None
+        if deadline is not None and now > deadline and not pill:
+            self.stats.expired(priority)
+            return self._expire(job, on_expired)
+        self.stats.waited(priority, now - queued)
+        return job
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.condition:
+            while len(self._heap) == 0:
+                if not block:
+                    raise Empty
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        raise Empty
+                self.condition.wait(remaining)
+            return self._pop()
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def task_done(self):
+        pass
+
+    def qsize(self):
+        return len(self._heap)
+
+    def empty(self):
+        return len(self._heap) == 0
+
 class ThreadPool:
-    def __init__(self, pool_size, timeout=None):
+    # The `aging` and `stats` are for the queue of the priority scheduler
+    def __init__(self, pool_size, timeout=None, scheduler="dedicated",
+        aging=None, stats=None):
+        if scheduler not in schedulers:
+            raise ValueError(f"Unknown scheduler: {scheduler}")
+        self.scheduler = scheduler
         self.locks = list()
         self.events = list()
         self.queues = list()
         self.workers = list()
         data = dict()
+
+        # Workers added on top of the pool, as tuples of their event and thread
+        self.extras = list()
+        # Those removed again, which can still be finishing up
+        self._retired = list()
+        self._ids = count(pool_size)
+        self._resize = Lock()
+
+        # Seconds each worker has spent running tasks, by its id, and when the
+        # task each of them is running right now started
+        self.busy = dict()
+        self._running = dict()
+        self._busy_lock = Lock()
+        # NOTE: Every worker still gets an entry in `queues`, the same one
+        if scheduler == "priority":
+            shared = PriorityJobQueue(aging, stats)
+        else:
+            shared = Queue()
+        condition = Condition()
         for s in range(pool_size):
             lock = Lock()
             event = Event()
-            queue = Queue()
+            if scheduler in ["shared", "priority"]:
+                queue = shared
+            elif scheduler == "stealing":
+                queue = StealingQueue(self.queues, condition)
+            else:
+                queue = Queue()
             args = (s, event, queue, timeout)
             worker = Thread(target=self._worker, args=args)
             worker.setDaemon(True)
@@ -43,15 +281,17 @@ class ThreadPool:
             for method in methods:
                 cast(method, action)
 
+    # Runs a task for the worker, which other backends run somewhere else
+    def _execute(self, worker_id, method, args, kwargs):
+        return method(*args, **kwargs)
+
     def _worker(self, worker_id, event, queue, timeout=None):
         while not event.is_set():
             try:
                 # NOTE: This is really spammy, use only in case of emergencies
                 # print(f"[worker:{worker_id}]: Getting task")
-                if timeout is not None:
-                    job = queue.get(block=True, timeout=timeout)
-                else:
-                    job = queue.get_nowait()
+                # Sleeps until there is a job, `stop` wakes it up with a pill
+                job = queue.get(block=True, timeout=timeout)
                 if len(job) != 2:
                     # print(f"[worker:{worker_id}]: Job is malformed")
                     continue
@@ -59,6 +299,10 @@ class ThreadPool:
                 if type(controls) != dict:
                     # print(f"[worker:{worker_id}]: Controls are malformed")
                     continue
+                # Resolved with what the task returns or raises, if there is one
+                future = controls.pop("future", None)
+                # Run right here instead of by the backend, see `_expire`
+                inline = controls.pop("inline", False)
                 if task is None: # NOTE: Poison pill to kill worker
                     # print(f"[worker:{worker_id}]: Poisoned")
                     event.set()
@@ -66,43 +310,137 @@ class ThreadPool:
                     break
                 if len(task) != 3:
                     # print(f"[worker:{worker_id}]: Task is malformed")
+                    if future is not None and (
+                        future.set_running_or_notify_cancel()):
+                        future.set_exception(ValueError("Task is malformed"))
                     self._exec_controls(controls)
                     continue
+                # Cancelled while it was waiting on its worker
+                if future is not None and (
+                    not future.set_running_or_notify_cancel()):
+                    self._exec_controls(controls)
+                    queue.task_done()
+                    continue
                 method, args, kwargs = task
                 # print(f"[worker:{worker_id}]: Running task")
+                started = monotonic()
+                with self._busy_lock:
+                    self._running[worker_id] = started
                 try:
-                    method(*args, **kwargs)
+                    if inline:
+                        result = method(*args, **kwargs)
+                    else:
+                        result = self._execute(worker_id, method, args,
+                            kwargs)
                 except Exception as e:
-                    print(e)
+                    if future is None:
+                        print(e)
+                    else:
+                        future.set_exception(e)
+                else:
+                    if future is not None:
+                        future.set_result(result)
                 finally:
                     # print(f"[worker:{worker_id}]: Task complete")
+                    with self._busy_lock:
+                        del self._running[worker_id]
+                        busy = self.busy.get(worker_id, 0)
+                        self.busy[worker_id] = busy + monotonic() - started
                     self._exec_controls(controls)
                     queue.task_done()
             except Empty:
                 continue
-        # Clear out the queue
+        # Clear out the queue, unless the pills of the others are still in it
         # print(f"[worker:{worker_id}]: Clearing out queue")
-        while True:
+        while self.scheduler not in ["shared", "priority"]:
             try:
                 queue.get_nowait()
                 queue.task_done()
             except Empty:
                 break
 
+    def size(self):
+        return len(self.workers) + len(self.extras)
+
+    # Seconds the workers have spent running tasks, counting the tasks still
+    # running up until now
+    def busy_time(self):
+        now = monotonic()
+        with self._busy_lock:
+            running = [now - started for started in self._running.values()]
+            return sum(self.busy.values()) + sum(running)
+
+    # Adds a worker taking from the queue all of the others share, so only for
+    # the shared and priority schedulers. Returns the id of the new worker.
+    def add_worker(self, idle_timeout=1):
+        if self.scheduler not in ["shared", "priority"]:
+            raise ValueError("Only pools with a shared queue can add workers")
+        with self._resize:
+            worker_id = next(self._ids)
+            event = Event()
+            # Wakes up while idle so that it notices when it is retired
+            args = (worker_id, event, self.queues[0], idle_timeout)
+            worker = Thread(target=self._worker, args=args)
+            worker.setDaemon(True)
+            self.extras.append((event, worker))
+            worker.start()
+            return worker_id
+
+    # Retires the newest added worker once it is done with its task, returns
+    # False if only the workers the pool started with are left
+    def remove_worker(self):
+        with self._resize:
+            if len(self.extras) == 0:
+                return False
+            event, worker = self.extras.pop()
+            event.set()
+            self._retired = [retired for retired in self._retired
+                if retired[1].is_alive()]
+            self._retired.append((event, worker))
+            return True
+
     def stop(self, done=None, wait=True):
         # print(f"Stopping pool")
+        with self._resize:
+            extras = self.extras + self._retired
+            self.extras.clear()
+            self._retired.clear()
         for event in self.events:
             event.set()
+        for event, worker in extras:
+            event.set()
+        # NOTE: Added workers share the queue and can take any of the pills
+        for queue in self.queues + [self.queues[0]] * len(extras):
+            queue.put_nowait((dict(), None))
         if wait:
             for worker in self.workers:
                 worker.join()
+            for event, worker in extras:
+                worker.join()
         cast(done, "set")
         # print(f"Stopped pool")
 
+# Kinds of pool a `ThreadMarshal` can run its tasks on, by the name of their
+# backend. Each takes the same arguments as `ThreadPool` and has its interface.
+backends = dict()
+backends["thread"] = ThreadPool
+
 class ThreadMarshal:
     def __init__(self, pool_size, monitor=1, cleanup=True, timeout=None, 
-        destroy=False):
+        destroy=False, scheduler="dedicated", max_pools=None, backend="thread",
+        aging=1):
+        if backend not in backends:
+            raise ValueError(f"Unknown backend: {backend}")
         self.pool_size = pool_size
+        self.scheduler = scheduler
+        # Seconds a task waits to gain a priority, in the priority scheduler
+        self.aging = aging
+        self.wait_stats = WaitStats()
+        self.backend = backend
+        # Marshals of the other backends that tasks have been routed to
+        self.siblings = dict()
+        # Once there are this many pools tasks queue up instead of adding more
+        self.max_pools = max_pools
         self.monitor_interval = monitor
         self.cleanup = cleanup
         self.timeout = timeout
@@ -188,14 +526,15 @@ class ThreadMarshal:
         pool.stop(done, wait)
         # print(f"[manager] Stopped pool {index}")
 
-    def _run(self, task, controls, reserve, coordinates):
+    def _run(self, task, controls, reserve, coordinates, schedule=None):
         pool_index, worker_index = coordinates
         # print(f"[manager:reserve] Trying worker {self.worker_index}")
         lock = self.locks[pool_index][worker_index]
         event =self.events[pool_index][worker_index]
         queue =self.queues[pool_index][worker_index]
-        if event.is_set() or lock.locked():
+        if event.is_set() or (reserve and lock.locked()):
             return False
+        # Tasks that do not reserve the worker can queue up behind one that did
         if not reserve:
             lock = Lock()
         # print(f"[manager:reserve] Using worker {worker_index}")
@@ -203,13 +542,18 @@ class ThreadMarshal:
         release = controls.get("release", list())
         release.append(lock)
         job = controls, task
-        queue.put_nowait(job)
+        if schedule is None:
+            queue.put_nowait(job)
+        else:
+            queue.put_nowait(job, *schedule)
         return True
 
     def _add_pool(self):
         index = len(self.pools)
         # print(f"[manager] Adding pool {index}")
-        pool = ThreadPool(self.pool_size, self.timeout)
+        pool_type = backends[self.backend]
+        pool = pool_type(self.pool_size, self.timeout, self.scheduler,
+            self.aging, self.wait_stats)
         self.pools.append(pool)
         self.locks.append(pool.locks)
         self.events.append(pool.events)
@@ -253,7 +597,11 @@ class ThreadMarshal:
                 for thread in threads:
                     thread.join(self.timeout)
             self._load_presets()
-            cast(self.stopped, "set")
+            siblings = list(self.siblings.values())
+            self.siblings.clear()
+        for sibling in siblings:
+            sibling.stop(wait)
+        cast(self.stopped, "set")
         # print("[manager] Stopped")
 
     def run(self, task, done, reserve, coordinates):
@@ -277,39 +625,110 @@ class ThreadMarshal:
             self._run(task, controls, reserve, coordinates)
         return True
 
-    def reserve(self, method, args=tuple(), kwargs=dict(), reserve=True):
-        # print("[manager:reserve] Acquiring lock")
+    def _at_max_pools(self):
+        return self.max_pools is not None and len(self.pools) >= self.max_pools
+
+    # Places the task on a worker, expects the manager lock to be held
+    def _reserve(self, task, reserve=True, schedule=None, future=None):
         done = Event()
-        with self._manager:
-            task = method, args, kwargs
-            if self._pool_cursor >= len(self.pools):
+        if self._pool_cursor >= len(self.pools):
+            self._next_pool()
+        pool_found = False
+        for p in range(len(self.pools)):
+            # print(f"[manager:reserve] Trying pool {self._pool_cursor}")
+            semaphore = self.semaphores[self._pool_cursor]
+            if not semaphore.acquire(False):
                 self._next_pool()
-            pool_found = False
-            for p in range(len(self.pools)):
-                # print(f"[manager:reserve] Trying pool {self._pool_cursor}")
-                semaphore = self.semaphores[self._pool_cursor]
-                if not semaphore.acquire(False):
-                    self._next_pool()
-                    continue
-                pool_found = True
-                break
-            if not pool_found:
-                # print(f"[manager:reserve] Pools are full, adding new pool")
-                index = self._add_pool()
-                self._pool_cursor = index
-                self._worker_cursor = 0
-                semaphore = self.semaphores[self._pool_cursor]
-                semaphore.acquire()
-            # print(f"[manager:reserve] Using pool {self._pool_cursor}")
-            pool = self.pools[self._pool_cursor]
-            for w in range(self.pool_size):
-                coordinates = (self._pool_cursor, self._worker_cursor)
-                controls = dict()
-                controls["set"] = [done]
-                controls["release"] = [semaphore]
-                queued = self._run(task, controls, reserve, coordinates)
-                self._next_worker()
-                if not queued:
-                    continue
-                break
+                continue
+            pool_found = True
+            break
+        if not pool_found and self._at_max_pools():
+            # Waits behind the tasks already on the worker instead
+            semaphore = None
+            reserve = False
+        elif not pool_found:
+            # print(f"[manager:reserve] Pools are full, adding new pool")
+            index = self._add_pool()
+            self._pool_cursor = index
+            self._worker_cursor = 0
+            semaphore = self.semaphores[self._pool_cursor]
+            semaphore.acquire()
+        # print(f"[manager:reserve] Using pool {self._pool_cursor}")
+        pool = self.pools[self._pool_cursor]
+        for w in range(self.pool_size):
+            coordinates = (self._pool_cursor, self._worker_cursor)
+            controls = dict()
+            controls["set"] = [done]
+            controls["release"] = list()
+            if semaphore is not None:
+                controls["release"].append(semaphore)
+            if future is not None:
+                controls["future"] = future
+            queued = self._run(task, controls, reserve, coordinates, schedule)
+            self._next_worker()
+            if not queued:
+                continue
+            break
         return done
+
+    # Marshal for the backend, started with the same settings as this one
+    def _sibling(self, backend):
+        with self._manager:
+            sibling = self.siblings.get(backend, None)
+            if sibling is None:
+                sibling = ThreadMarshal(self.pool_size, self.monitor_interval,
+                    self.cleanup, self.timeout, scheduler=self.scheduler,
+                    max_pools=self.max_pools, backend=backend,
+                    aging=self.aging)
+                self.siblings[backend] = sibling
+            return sibling
+
+    # What the priority queue needs to place the task, None if nothing does
+    def _schedule(self, priority, deadline, on_expired):
+        if priority == 0 and deadline is None and on_expired is None:
+            return None
+        if self.scheduler != "priority":
+            raise ValueError("Priorities need the priority scheduler")
+        if deadline is not None:
+            deadline = monotonic() + deadline
+        return priority, deadline, on_expired
+
+    # Queue wait times by priority, see `WaitStats`
+    def stats(self):
+        return self.wait_stats.snapshot()
+
+    # The `backend` routes the task to a pool of that kind instead. With the
+    # priority scheduler, lower priorities run first and a task that has not
+    # started within `deadline` seconds is passed to `on_expired` instead.
+    # The `future`, if given, is resolved with what the task returns or 
+    # raises, which is the only way to get them back from another process.
+    # NOTE: Tasks only wait on each other once they do not reserve a worker,
+    # or the marshal is kept from growing by `max_pools`
+    def reserve(self, method, args=tuple(), kwargs=dict(), reserve=True,
+        backend=None, priority=0, deadline=None, on_expired=None, future=None):
+        if backend is not None and backend != self.backend:
+            sibling = self._sibling(backend)
+            return sibling.reserve(method, args, kwargs, reserve,
+                priority=priority, deadline=deadline, on_expired=on_expired,
+                future=future)
+        schedule = self._schedule(priority, deadline, on_expired)
+        # print("[manager:reserve] Acquiring lock")
+        with self._manager:
+            task = method, args, kwargs
+            return self._reserve(task, reserve, schedule, future)
+
+    # Like `reserve` for each of the `(method, args, kwargs)` tasks, but only
+    # takes the manager lock once for all of them. The `futures` go with the
+    # tasks in the same order.
+    def reserve_many(self, tasks, reserve=True, backend=None, priority=0,
+        deadline=None, on_expired=None, futures=None):
+        if backend is not None and backend != self.backend:
+            return self._sibling(backend).reserve_many(tasks, reserve,
+                priority=priority, deadline=deadline, on_expired=on_expired,
+                futures=futures)
+        schedule = self._schedule(priority, deadline, on_expired)
+        if futures is None:
+            futures = [None] * len(tasks)
+        with self._manager:
+            return [self._reserve(task, reserve, schedule, future)
+                for task, future in zip(tasks, futures)]
@@ -1,2 +1,7 @@
 from abots.net.socket_server import SocketServer
-from abots.net.socket_client import SocketClient
\ No newline at end of file
+from abots.net.socket_client import SocketClient, socket_pair
+from abots.net.async_socket_server import AsyncSocketServer
+from abots.net.async_socket_client import AsyncSocketClient
+from abots.net.socket_supervisor import SocketSupervisor
+from abots.net.socket_client_pool import SocketClientPool
+from abots.net.shared_ring import SharedMemoryChannel
@@ -0,0 +1,179 @@
+"""
+
+net/AsyncSocketClient
+=====================
+
+The asyncio counterpart to `SocketClient`, built on `asyncio.open_connection`.
+It speaks the same 4-byte `>I` length-prefixed protocol, so it can talk to
+either `SocketServer` or `AsyncSocketServer`.
+With `binary` set it uses the typed frames of binary mode instead.
+
+Messages are received by awaiting `recv` or by iterating over the client with
+`async for`. If the connection breaks it is re-established using the same
+exponential backoff as `SocketClient._attempt_reconnect`.
+
+"""
+
+from abots.helpers import eprint, utc_now_timestamp, jots
+from abots.net.framing import frame_message, frame_payload, read_payload
+from abots.net.framing import header_format, header_size, typed_format
+from abots.net.framing import typed_size, kind_text
+
+from asyncio import open_connection, sleep, Queue, Event, Lock
+from asyncio import IncompleteReadError, create_task
+from struct import unpack
+from random import randint
+
+class AsyncSocketClient:
+    def __init__(self, host, port, ssl=None, reconnects=10, binary=False):
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.reconnects = reconnects
+
+        # Uses the typed frames of `SocketClient`'s binary mode
+        self.binary = binary
+
+        self.reader = None
+        self.writer = None
+        self._reading = None
+        self._reconnect_lock = Lock()
+        # Bumped on every new connection to tell if one is already replaced
+        self._generation = 0
+
+        self.ready = Event()
+        self.stopped = Event()
+        self.broken = Event()
+        self.reconnecting = Event()
+
+        self._events = Queue()
+        self._outbox = Queue()
+        self.queues = dict()
+        self.queues["outbox"] = self._outbox
+        self.queues["events"] = self._events
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self._outbox.get()
+        # NOTE: Poison pill put in by `stop`
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    def _send_event(self, message):
+        self._events.put_nowait(jots(message))
+
+    async def _prepare(self):
+        try:
+            self.reader, self.writer = await open_connection(self.host,
+                self.port, ssl=self.ssl)
+        except Exception as e:
+            return True, e
+        self._generation = self._generation + 1
+        return False, None
+
+    def _package_message(self, message, *args):
+        if self.binary:
+            return b"".join(frame_payload(message, *args))
+        return b"".join(frame_message(message, *args))
+
+    async def _get_message(self):
+        if self.binary:
+            raw_header = await self.reader.readexactly(typed_size)
+            message_size, flags, kind = unpack(typed_format, raw_header)
+        else:
+            raw_header = await self.reader.readexactly(header_size)
+            message_size = unpack(header_format, raw_header)[0]
+            kind = kind_text
+        message = await self.reader.readexactly(message_size)
+        return read_payload(kind, message)
+
+    async def _reader(self):
+        while not self.stopped.is_set():
+            generation = self._generation
+            try:
+                message = await self._get_message()
+            # The socket can either be broken or no longer open at all
+            except (IncompleteReadError, OSError) as e:
+                await self._attempt_reconnect(generation)
+                continue
+            await self._outbox.put(message)
+
+    async def _attempt_reconnect(self, generation):
+        if self.stopped.is_set():
+            return
+        async with self._reconnect_lock:
+            # Another task already brought the connection back up
+            if generation != self._generation:
+                return
+            self.reconnecting.clear()
+            self.broken.set()
+            event = dict()
+            event["name"] = "socket-down"
+            event["data"] = dict()
+            event["data"]["when"] = utc_now_timestamp()
+            self._send_event(event)
+            if self.writer is not None:
+                self.writer.close()
+            attempts = 0
+            while attempts <= self.reconnects and not self.stopped.is_set():
+                err, report = await self._prepare()
+                if not err:
+                    self.reconnecting.set()
+                    self.broken.clear()
+                    event = dict()
+                    event["name"] = "socket-up"
+                    event["data"] = dict()
+                    event["data"]["when"] = utc_now_timestamp()
+                    self._send_event(event)
+                    return
+                # Exponential backoff
+                attempts = attempts + 1
+                max_delay = (2**attempts) - 1
+                delay = randint(0, max_delay)
+                await sleep(delay)
+        await self.stop()
+
+    async def send_message(self, message, *args):
+        packaged = self._package_message(message, *args)
+        if self.broken.is_set():
+            await self.reconnecting.wait()
+        generation = self._generation
+        try:
+            self.writer.write(packaged)
+            await self.writer.drain()
+        except OSError as e:
+            await self._attempt_reconnect(generation)
+
+    async def recv(self):
+        return await self.__anext__()
+
+    async def send(self, message, *args):
+        await self.send_message(message, *args)
+
+    async def start(self):
+        err, report = await self._prepare()
+        if err:
+            eprint(report)
+            return report
+        self.reconnecting.set()
+        self._reading = create_task(self._reader())
+        self.ready.set()
+        return None
+
+    async def stop(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        event = dict()
+        event["name"] = "closing"
+        event["data"] = dict()
+        event["data"]["when"] = utc_now_timestamp()
+        self._send_event(event)
+        if self.writer is not None:
+            self.writer.close()
+        # Unblocks anything still waiting on the connection to come back
+        self.reconnecting.set()
+        self._outbox.put_nowait(None)
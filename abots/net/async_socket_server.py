@@ -0,0 +1,189 @@
+"""
+
+net/AsyncSocketServer
+=====================
+
+The asyncio counterpart to `SocketServer`, built on `asyncio.start_server`.
+It speaks the same 4-byte `>I` length-prefixed protocol, so it can be used with
+either `SocketClient` or `AsyncSocketClient` on the other end.
+With `binary` set it uses the typed frames of binary mode instead.
+
+Messages are received as `(uuid, message)` letters, either by awaiting `recv`
+or by iterating over the server with `async for`.
+
+"""
+
+from abots.helpers import eprint, sha256, utc_now_timestamp, jots
+from abots.net.framing import frame_message, frame_payload, read_payload
+from abots.net.framing import header_format, header_size, typed_format
+from abots.net.framing import typed_size, kind_text
+
+from asyncio import start_server, Queue, Event, IncompleteReadError, gather
+from struct import unpack
+
+class AsyncSocketServer:
+    def __init__(self, host, port, listeners=5, ssl=None, binary=False):
+        # The connection information for server, the clients will use this to
+        # connect to the server
+        self.host = host
+        self.port = port
+
+        # The number of unaccepted connections that the system will allow
+        # before refusing new connections
+        self.listeners = listeners
+
+        # An `ssl.SSLContext` to serve the connections over, if any
+        self.ssl = ssl
+
+        # Uses the typed frames of `SocketServer`'s binary mode
+        self.binary = binary
+
+        self._events = Queue()
+        self._outbox = Queue()
+        self.queues = dict()
+        self.queues["outbox"] = self._outbox
+        self.queues["events"] = self._events
+
+        self.server = None
+        self.uuids = dict()
+
+        self.ready = Event()
+        self.stopped = Event()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        letter = await self._outbox.get()
+        # NOTE: Poison pill put in by `stop`
+        if letter is None:
+            raise StopAsyncIteration
+        return letter
+
+    def _send_event(self, message):
+        self._events.put_nowait(jots(message))
+
+    def _package_message(self, message, *args):
+        if self.binary:
+            return b"".join(frame_payload(message, *args))
+        return b"".join(frame_message(message, *args))
+
+    async def _get_message(self, reader):
+        if self.binary:
+            raw_header = await reader.readexactly(typed_size)
+            message_size, flags, kind = unpack(typed_format, raw_header)
+        else:
+            raw_header = await reader.readexactly(header_size)
+            message_size = unpack(header_format, raw_header)[0]
+            kind = kind_text
+        message = await reader.readexactly(message_size)
+        return read_payload(kind, message)
+
+    # Logic for each client, run as its own task by `start_server`
+    async def _new_client(self, reader, writer):
+        address = writer.get_extra_info("peername")
+        client_host, client_port = address[:2]
+        client_uuid = sha256()
+        self.uuids[client_uuid] = dict()
+        self.uuids[client_uuid]["reader"] = reader
+        self.uuids[client_uuid]["writer"] = writer
+
+        event = dict()
+        event["name"] = "new_client"
+        event["data"] = dict()
+        event["data"]["host"] = client_host
+        event["data"]["port"] = client_port
+        event["data"]["uuid"] = client_uuid
+        self._send_event(event)
+
+        while not self.stopped.is_set():
+            try:
+                message = await self._get_message(reader)
+            # The socket can either be broken or no longer open at all
+            except (IncompleteReadError, OSError) as e:
+                break
+            # Send message and uuid of sender to outbox queue
+            letter = client_uuid, message
+            await self._outbox.put(letter)
+        await self.close_client(client_uuid)
+
+    # Closes a connected client and removes it from the uuids
+    async def close_client(self, uuid):
+        client = self.uuids.pop(uuid, None)
+        if client is None:
+            return
+        event = dict()
+        event["name"] = "close_client"
+        event["data"] = dict()
+        event["data"]["uuid"] = uuid
+        self._send_event(event)
+        writer = client["writer"]
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+    # Packages a message and sends it to the client
+    async def send_message(self, uuid, message, *args):
+        client = self.uuids.get(uuid, None)
+        if client is None:
+            return None
+        writer = client["writer"]
+        try:
+            writer.write(self._package_message(message, *args))
+            await writer.drain()
+        # The socket can either be broken or no longer open at all
+        except OSError as e:
+            await self.close_client(uuid)
+
+    # Like send_message, but sends to all clients but the sender
+    async def broadcast_message(self, client_uuid, message, *args):
+        sending = list()
+        for uuid in list(self.uuids):
+            if uuid != client_uuid:
+                sending.append(self.send_message(uuid, message, *args))
+        await gather(*sending)
+
+    async def recv(self):
+        return await self.__anext__()
+
+    async def send(self, uuid, message, *args):
+        if uuid == "cast":
+            await self.broadcast_message(uuid, message, *args)
+        else:
+            await self.send_message(uuid, message, *args)
+
+    async def start(self):
+        kwargs = dict()
+        kwargs["backlog"] = self.listeners
+        kwargs["ssl"] = self.ssl
+        try:
+            self.server = await start_server(self._new_client, self.host,
+                self.port, **kwargs)
+        # This usually means that the port is already in use
+        except OSError as e:
+            eprint(e)
+            return e
+        self.ready.set()
+        return None
+
+    async def serve_forever(self):
+        if self.server is None:
+            err = await self.start()
+            if err is not None:
+                return err
+        await self.stopped.wait()
+
+    async def stop(self):
+        event = dict()
+        event["name"] = "closing"
+        event["data"] = dict()
+        event["data"]["when"] = utc_now_timestamp()
+        self._send_event(event)
+        self.stopped.set()
+        if self.server is not None:
+            self.server.close()
+        for uuid in list(self.uuids):
+            await self.close_client(uuid)
+        self._outbox.put_nowait(None)
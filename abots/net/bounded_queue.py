@@ -0,0 +1,89 @@
+"""
+
+net/BoundedQueue
+================
+
+A `queue.Queue` with a defined policy for when it is full, used for the queues
+of `SocketServer` and `SocketClient` so that a fast producer or a slow consumer
+can no longer grow them without limit:
+
+* "block" - `put` waits for room, as `Queue` does
+* "drop-oldest" - `put` drops the oldest item to make room for the new one
+* "raise" - `put` raises `queue.Full` right away
+
+The readers that fill an outbox do not follow the policy directly. Unless it is
+"drop-oldest" they stop reading while it is full, either by waiting for room or
+by holding their key in the queue until the consumer has drained it halfway,
+so that TCP flow control pushes back on whoever is sending to them.
+
+"""
+
+from queue import Queue
+
+overflows = ["block", "drop-oldest", "raise"]
+
+class BoundedQueue(Queue):
+    def __init__(self, maxsize=0, overflow="block", on_release=None):
+        if overflow not in overflows:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        super().__init__(maxsize)
+        self.overflow = overflow
+
+        # Called with the keys held by `hold` once there is room again
+        self.on_release = on_release
+        self.held = set()
+
+        # Number of items dropped to make room for newer ones
+        self.dropped = 0
+
+    def _full(self):
+        return 0 < self.maxsize <= self._qsize()
+
+    def _get(self):
+        item = super()._get()
+        if len(self.held) > 0 and self._qsize() <= self.maxsize // 2:
+            released = self.held
+            self.held = set()
+            if self.on_release is not None:
+                self.on_release(released)
+        return item
+
+    def put(self, item, block=True, timeout=None):
+        if self.overflow == "raise":
+            block = False
+        if self.overflow != "drop-oldest":
+            return super().put(item, block, timeout)
+        with self.not_full:
+            if self._full():
+                self._get()
+                self.dropped = self.dropped + 1
+                self.unfinished_tasks = self.unfinished_tasks - 1
+            self._put(item)
+            self.unfinished_tasks = self.unfinished_tasks + 1
+            self.not_empty.notify()
+
+    # Puts the item in even if it is full, for producers that already waited
+    def force(self, item):
+        with self.not_full:
+            self._put(item)
+            self.unfinished_tasks = self.unfinished_tasks + 1
+            self.not_empty.notify()
+
+    # Waits until there is room, returning False if there still is none
+    def wait_for_room(self, timeout=None):
+        if self.overflow == "drop-oldest":
+            return True
+        with self.not_full:
+            if self._full():
+                self.not_full.wait(timeout)
+            return not self._full()
+
+    # Holds onto the key if the queue is full, to be passed to `on_release`
+    def hold(self, key):
+        if self.overflow == "drop-oldest":
+            return False
+        with self.mutex:
+            if not self._full():
+                return False
+            self.held.add(key)
+            return True
@@ -0,0 +1,92 @@
+"""
+
+net/Compression
+===============
+
+Per-connection zlib compression for the typed frames of binary mode. Each
+connection keeps a single streaming compressor and decompressor for its whole
+life, with every frame ending on a sync flush, so keys that repeat between
+frames (as they tend to in JSON) only cost a back-reference after the first.
+
+Because of that the frames have to be compressed in the same order they go out
+on the wire, so `compress_frame` must be called while holding the lock of the
+`FrameWriter` the frame is queued on.
+
+Whether compression is used is negotiated when connecting: the client offers
+it in a hello frame, and only compresses once the server has accepted.
+
+"""
+
+from abots.net.framing import typed_format, flag_compressed
+
+from struct import pack, unpack
+from time import thread_time
+from zlib import compressobj, decompressobj, Z_SYNC_FLUSH
+
+# Methods this side of the connection knows how to use
+methods = ["zlib"]
+
+class Compressor:
+    def __init__(self, level=6, threshold=1024):
+        self.level = level
+
+        # Frames with smaller bodies than this are not worth compressing
+        self.threshold = threshold
+
+        # Set once the other side has agreed to compression
+        self.enabled = False
+
+        self._compress = compressobj(level)
+        self._decompress = decompressobj()
+
+        self.frames_out = 0
+        self.raw_out = 0
+        self.wire_out = 0
+        self.frames_in = 0
+        self.raw_in = 0
+        self.wire_in = 0
+        self.compress_time = 0
+        self.decompress_time = 0
+
+    def compress(self, data):
+        start = thread_time()
+        compressed = self._compress.compress(data)
+        compressed = compressed + self._compress.flush(Z_SYNC_FLUSH)
+        self.compress_time = self.compress_time + thread_time() - start
+        self.frames_out = self.frames_out + 1
+        self.raw_out = self.raw_out + len(data)
+        self.wire_out = self.wire_out + len(compressed)
+        return compressed
+
+    def decompress(self, data):
+        start = thread_time()
+        decompressed = self._decompress.decompress(data)
+        self.decompress_time = self.decompress_time + thread_time() - start
+        self.frames_in = self.frames_in + 1
+        self.raw_in = self.raw_in + len(decompressed)
+        self.wire_in = self.wire_in + len(data)
+        return decompressed
+
+    # Compresses the body of a typed frame if it is enabled and worth it
+    def compress_frame(self, header, body):
+        if not self.enabled or len(body) < self.threshold:
+            return header, body
+        size, flags, kind = unpack(typed_format, header)
+        body = self.compress(body)
+        header = pack(typed_format, len(body), flags | flag_compressed, kind)
+        return header, body
+
+    def stats(self):
+        stats = dict()
+        stats["enabled"] = self.enabled
+        stats["frames_out"] = self.frames_out
+        stats["raw_out"] = self.raw_out
+        stats["wire_out"] = self.wire_out
+        stats["ratio_out"] = self.raw_out / max(self.wire_out, 1)
+        stats["compress_time"] = self.compress_time
+        stats["frames_in"] = self.frames_in
+        stats["raw_in"] = self.raw_in
+        stats["wire_in"] = self.wire_in
+        stats["ratio_in"] = self.raw_in / max(self.wire_in, 1)
+        stats["decompress_time"] = self.decompress_time
+        return stats
@@ -0,0 +1,161 @@
+"""
+
+net/Dispatcher
+==============
+
+Pushes messages to handlers as soon as their frames are decoded, rather than
+leaving them in the outbox for `recv` to be polled for. Used by `SocketServer`
+and `SocketClient` through their `add_handler` and `remove_handler`.
+
+Handlers are registered for a kind of payload ("raw", "text" or "json"), for
+messages published to a topic ("publish"), for streams ("stream", handed over
+as soon as they start) or for every message, and are called
+with `(uuid, message)`. They run either inline on the I/O thread that decoded
+the frame, which is fastest but holds up the reading of that connection until
+they return, or on a `ThreadMarshal` worker.
+
+Batch handlers are instead called with a list of `(uuid, message)` letters,
+once `batch` of them have come in or `window` seconds have passed since the
+first one did, whichever comes first.
+
+Messages that at least one handler was registered for do not go to the outbox.
+
+"""
+
+from abots.helpers import eprint
+from abots.events import ThreadMarshal
+from abots.net.framing import kind_raw, kind_text, kind_json, kind_publish
+from abots.net.framing import kind_stream_start
+
+from threading import Thread, Event, Lock, Condition
+from time import monotonic
+
+kinds = dict()
+kinds["raw"] = kind_raw
+kinds["text"] = kind_text
+kinds["json"] = kind_json
+kinds["publish"] = kind_publish
+kinds["stream"] = kind_stream_start
+
+class Dispatcher:
+    def __init__(self, marshal=None, pool_size=4):
+        # Runs the handlers that are not inline, made when first needed if one
+        # is not given
+        self.marshal = marshal
+        self.pool_size = pool_size
+        self._owns_marshal = False
+
+        # Maps each kind to the handlers for it, with None for every kind
+        self.handlers = dict()
+
+        # Handlers with a window, which the batch thread flushes once it ends
+        self._windows = list()
+        self._lock = Lock()
+        self._waiting = Condition(self._lock)
+        self._batcher = None
+
+        self.stopped = Event()
+
+    def _run(self, entry, args):
+        if entry["inline"]:
+            try:
+                entry["handler"](*args)
+            except Exception as e:
+                eprint(e)
+            return
+        self.marshal.reserve(entry["handler"], args)
+
+    # Adds the letter to the handler's batch, running it if that filled it up
+    def _collect(self, entry, letter):
+        with self._lock:
+            letters = entry["letters"]
+            letters.append(letter)
+            if len(letters) == 1 and entry["window"] is not None:
+                entry["deadline"] = monotonic() + entry["window"]
+                self._waiting.notify()
+            if entry["batch"] is None or len(letters) < entry["batch"]:
+                return
+            entry["letters"] = list()
+        self._run(entry, (letters,))
+
+    # Runs the batches whose windows have ended, sleeping until the next one
+    def _batch_thread(self):
+        while not self.stopped.is_set():
+            due = list()
+            with self._waiting:
+                now = monotonic()
+                wait = None
+                for entry in self._windows:
+                    if len(entry["letters"]) == 0:
+                        continue
+                    if entry["deadline"] <= now:
+                        due.append((entry, entry["letters"]))
+                        entry["letters"] = list()
+                        continue
+                    remaining = entry["deadline"] - now
+                    wait = remaining if wait is None else min(wait, remaining)
+                if len(due) == 0:
+                    self._waiting.wait(wait)
+            for entry, letters in due:
+                self._run(entry, (letters,))
+
+    # Registers the handler for the kind of payload, or every one if None
+    def add_handler(self, handler, kind=None, inline=True, batch=None,
+        window=None):
+        kind = kinds.get(kind, kind)
+        entry = dict()
+        entry["handler"] = handler
+        entry["inline"] = inline
+        entry["batch"] = batch
+        entry["window"] = window
+        entry["batched"] = batch is not None or window is not None
+        entry["letters"] = list()
+        entry["deadline"] = None
+        with self._lock:
+            if not inline and self.marshal is None:
+                self.marshal = ThreadMarshal(self.pool_size)
+                self._owns_marshal = True
+            self.handlers.setdefault(kind, list()).append(entry)
+            if window is None:
+                return
+            self._windows.append(entry)
+            if self._batcher is not None:
+                return
+            self._batcher = Thread(target=self._batch_thread)
+            self._batcher.setDaemon(True)
+            self._batcher.start()
+
+    def remove_handler(self, handler):
+        with self._lock:
+            for kind, entries in list(self.handlers.items()):
+                entries = [entry for entry in entries
+                    if entry["handler"] != handler]
+                if len(entries) == 0:
+                    self.handlers.pop(kind)
+                else:
+                    self.handlers[kind] = entries
+            self._windows = [entry for entry in self._windows
+                if entry["handler"] != handler]
+
+    # Hands the message to its handlers, returning False if there are none
+    def dispatch(self, uuid, message, kind):
+        if len(self.handlers) == 0:
+            return False
+        entries = list(self.handlers.get(kind, list()))
+        entries.extend(self.handlers.get(None, list()))
+        if len(entries) == 0:
+            return False
+        letter = uuid, message
+        for entry in entries:
+            if entry["batched"]:
+                self._collect(entry, letter)
+            else:
+                self._run(entry, letter)
+        return True
+
+    def stop(self):
+        self.stopped.set()
+        with self._waiting:
+            self._waiting.notify()
+        if self._owns_marshal:
+            self.marshal.stop(False)
@@ -0,0 +1,480 @@
+"""
+
+net/Framing
+===========
+
+Helpers for the length-prefixed frames spoken by `SocketServer` and
+`SocketClient`, where every frame is a 4-byte `>I` header holding the size of
+the body that follows it.
+
+In binary mode the header is followed by two more bytes, `>IBB`, holding the
+flags of the frame and the kind of payload in the body (raw bytes, UTF-8 text
+or JSON), so payloads are told apart without having to sniff the body.
+
+`FrameDecoder` reads straight from a socket into a preallocated buffer with
+`recv_into`, so partial headers and bodies are carried over between reads and
+a single read can complete any number of frames. Frames too large to fit in
+the buffer get their own buffer that the rest of the body is read directly
+into, rather than being pieced together one packet at a time.
+
+`FrameWriter` is the other direction, it holds the frames queued for a socket
+and writes as many of them as it can in a single `sendmsg` call, picking back
+up where it left off after a short write.
+
+"""
+
+from abots.helpers import jots, jsto
+
+from struct import pack, unpack_from, calcsize
+from collections import deque
+from itertools import islice
+from threading import RLock, Condition
+from time import monotonic
+from os import writev
+from socket import MSG_DONTWAIT, timeout as sock_timeout
+from ssl import SSLSocket
+
+header_format = ">I"
+header_size = calcsize(header_format)
+
+# Header used in binary mode: body size, flags, kind of payload
+typed_format = ">IBB"
+typed_size = calcsize(typed_format)
+
+# Kinds of payload a typed frame can carry
+kind_raw = 0
+kind_text = 1
+kind_json = 2
+
+# Kinds used by the connections to talk amongst themselves, never passed along
+kind_hello = 16
+kind_call = 17
+kind_reply = 18
+kind_subscribe = 19
+kind_unsubscribe = 20
+
+# Messages published to a topic, which carry the topic along with the message
+kind_publish = 21
+
+# Length of the topic at the start of the body of a published message
+topic_format = ">H"
+topic_size = calcsize(topic_format)
+
+kind_ping = 22
+kind_pong = 23
+
+# Body of a ping, the time it was sent which is echoed back by the pong
+heartbeat_format = ">d"
+
+# Streams of chunks making up one message, which can be larger than any one 
+# frame could be. Every body starts with the id of the stream it is a part of,
+# the first holds metadata describing the stream as JSON.
+kind_stream_start = 24
+kind_stream_chunk = 25
+kind_stream_end = 26
+stream_format = ">I"
+stream_size = calcsize(stream_format)
+
+# Flags a typed frame can have set
+flag_compressed = 1
+
+# Most buffers the kernel takes in a single `sendmsg` call
+iov_max = 1024
+
+# Formats the message and splits it into the header and body of its frame
+def frame_message(message, *args):
+    if len(args) > 0:
+        formatted = message.format(*args)
+    else:
+        formatted = message
+    body = formatted.encode()
+    return pack(header_format, len(body)), body
+
+# Like `frame_message` but for binary mode, where bytes-like messages are sent
+# as they are, strings as text and anything else as JSON
+def frame_payload(message, *args, kind=None, flags=0):
+    if kind is None:
+        if isinstance(message, (bytes, bytearray, memoryview)):
+            kind = kind_raw
+        elif isinstance(message, str):
+            kind = kind_text
+        else:
+            kind = kind_json
+    if kind == kind_text:
+        formatted = message.format(*args) if len(args) > 0 else message
+        body = formatted.encode()
+    elif kind == kind_json:
+        body = encode_json(message)
+    else:
+        body = message
+    return pack(typed_format, memoryview(body).nbytes, flags, kind), body
+
+# Serializes the message as JSON, raising `ValueError` for whatever cannot be,
+# where `jots` would return None or raise a `TypeError`
+def encode_json(message):
+    try:
+        encoded = jots(message)
+    except TypeError as e:
+        raise ValueError(f"Message cannot be sent as JSON: {e}")
+    if encoded is None:
+        raise ValueError("Message cannot be sent as JSON")
+    return encoded.encode()
+
+# Frames a message published to the topic. The body holds the length of the 
+# topic, the topic, the kind of the message and then the message itself.
+def frame_topic(topic, message, *args):
+    header, payload = frame_payload(message, *args)
+    name = topic.encode()
+    body = b"".join([pack(topic_format, len(name)), name, header[-1:], 
+        payload])
+    return pack(typed_format, len(body), 0, kind_publish), body
+
+# Header of a frame in a stream, followed by `size` bytes of the stream
+def stream_header(kind, stream_id, size):
+    header = pack(typed_format, stream_size + size, 0, kind)
+    return header + pack(stream_format, stream_id)
+
+def frame_stream(kind, stream_id, data=b""):
+    body = b"".join([pack(stream_format, stream_id), data])
+    return pack(typed_format, len(body), 0, kind), body
+
+# Splits the body of a frame in a stream into the stream id and its data
+def read_stream(body):
+    view = memoryview(body)
+    return unpack_from(stream_format, view)[0], view[stream_size:]
+
+# Splits the body of a published message into its topic, kind and payload
+def read_topic(body):
+    size = unpack_from(topic_format, body)[0]
+    start = topic_size + size
+    topic = bytes(body[topic_size:start]).decode()
+    return topic, body[start], body[start + 1:]
+
+# Turns the body of a frame back into the message that was sent
+def read_payload(kind, body):
+    if kind == kind_text:
+        return body.decode()
+    elif kind == kind_json:
+        return jsto(body)
+    return body
+
+class FrameDecoder:
+    def __init__(self, buffer_size=4096, typed=False):
+        # Reads the `>IBB` headers of binary mode instead of plain `>I` ones
+        self.typed = typed
+        self.header_size = typed_size if typed else header_size
+
+        self.buffer_size = max(buffer_size, self.header_size)
+        self._buffer = bytearray(self.buffer_size)
+        self._view = memoryview(self._buffer)
+
+        # Unparsed data lives in `_buffer[_start:_end]`
+        self._start = 0
+        self._end = 0
+
+        # Body of a frame that is larger than `_buffer`
+        self._body = None
+        self._body_view = None
+        self._body_filled = 0
+        self._body_flags = 0
+        self._body_kind = kind_text
+
+        # Complete frames that have not been picked up yet, as tuples of the 
+        # flags, kind and body of the frame. Untyped frames are always text.
+        self.frames = deque()
+
+    def _parse_header(self, buffer, offset):
+        if self.typed:
+            return unpack_from(typed_format, buffer, offset)
+        size = unpack_from(header_format, buffer, offset)[0]
+        return size, 0, kind_text
+
+    def _parse(self):
+        buffer = self._buffer
+        while self._end - self._start >= self.header_size:
+            size, flags, kind = self._parse_header(buffer, self._start)
+            start = self._start + self.header_size
+            end = start + size
+            if end <= self._end:
+                body = bytes(self._view[start:end])
+                self.frames.append((flags, kind, body))
+                self._start = end
+                continue
+            if self.header_size + size > len(buffer):
+                # Too large for the buffer, the rest is read into the body
+                self._body_flags = flags
+                self._body_kind = kind
+                self._body = bytearray(size)
+                self._body_view = memoryview(self._body)
+                self._body_filled = self._end - start
+                self._body_view[:self._body_filled] = self._view[start:self._end]
+                self._start = self._end
+            break
+        if self._start == self._end:
+            self._start = 0
+            self._end = 0
+
+    # Moves the partial frame left over to the front of the buffer
+    def _compact(self):
+        if self._start == 0:
+            return
+        remaining = self._end - self._start
+        self._buffer[:remaining] = self._buffer[self._start:self._end]
+        self._start = 0
+        self._end = remaining
+
+    # Does a single read from the socket, returns how many frames are pending
+    # Raises `ConnectionResetError` once the other end closes the connection
+    def recv_from(self, sock):
+        if self._body is not None:
+            view = self._body_view[self._body_filled:]
+        else:
+            self._compact()
+            view = self._view[self._end:]
+        received = sock.recv_into(view)
+        if received == 0:
+            raise ConnectionResetError("Connection closed by peer")
+        if self._body is None:
+            self._end = self._end + received
+            self._parse()
+            return len(self.frames)
+        self._body_filled = self._body_filled + received
+        if self._body_filled == len(self._body):
+            frame = self._body_flags, self._body_kind, self._body
+            self.frames.append(frame)
+            self._body = None
+            self._body_view = None
+            self._body_filled = 0
+        return len(self.frames)
+
+    def pop(self):
+        if len(self.frames) == 0:
+            return None
+        return self.frames.popleft()
+
+    # Drops any partial or pending frames, used when a connection is replaced
+    def clear(self):
+        self._start = 0
+        self._end = 0
+        self._body = None
+        self._body_view = None
+        self._body_filled = 0
+        self.frames.clear()
+
+# The buffers of a queued frame still left to be written out
+class PendingFrame(deque):
+    # Whether `drop_pending` may drop it, see `FrameWriter.queue`
+    droppable = False
+
+class FrameWriter:
+    def __init__(self, sock, threshold=65536, latency=0.01):
+        self.sock = sock
+
+        # Pending bytes that will cause a flush, see `should_flush`
+        self.threshold = threshold
+
+        # Longest a frame should wait to be coalesced with others, in seconds
+        self.latency = latency
+
+        self.lock = RLock()
+        self.pending = 0
+
+        # Notified whenever pending frames are written out or dropped
+        self.drained = Condition(self.lock)
+
+        # Called with how long the oldest frame waited once all are written
+        self.on_flush = None
+
+        # Set while `sendfile` writes to the socket without holding the lock, 
+        # during which frames are still queued but nothing else writes them
+        self.busy = False
+
+        # Each frame is a deque of the memoryviews still left to be written
+        self._frames = deque()
+        self._oldest = None
+        self._partial = False
+
+    def _send(self, buffers, block):
+        if isinstance(self.sock, SSLSocket):
+            # SSL sockets support neither `sendmsg` nor flags
+            return self.sock.send(b"".join(buffers))
+        if block:
+            return self.sock.sendmsg(buffers)
+        if self.sock.gettimeout() is None:
+            return self.sock.sendmsg(buffers, (), MSG_DONTWAIT)
+        # Sockets with a timeout are already non-blocking underneath, but 
+        # `sendmsg` would wait for them to be writable first
+        return writev(self.sock.fileno(), buffers)
+
+    # Drops what was sent from the pending frames, returns how many of the 
+    # frames were finished
+    def _consume(self, sent):
+        self.pending = self.pending - sent
+        finished = 0
+        while sent > 0:
+            frame = self._frames[0]
+            view = frame[0]
+            if sent < len(view):
+                frame[0] = view[sent:]
+                self._partial = True
+                return finished
+            sent = sent - len(view)
+            frame.popleft()
+            self._partial = len(frame) > 0
+            if not self._partial:
+                self._frames.popleft()
+                finished = finished + 1
+        return finished
+
+    # Writes out the first `count` pending frames, returns how many are left
+    def _write(self, count, block):
+        while count > 0:
+            # NOTE: They could have been dropped by `clear` in the meantime
+            count = min(count, len(self._frames))
+            if count == 0:
+                break
+            buffers = list()
+            for frame in islice(self._frames, count):
+                buffers.extend(frame)
+                if len(buffers) >= iov_max:
+                    break
+            try:
+                sent = self._send(buffers[:iov_max], block)
+            except (BlockingIOError, InterruptedError):
+                return count
+            count = count - self._consume(sent)
+            self.drained.notify_all()
+        return 0
+
+    # How many frames there are up to and including the frame, if it is still
+    # waiting to be written out
+    def _through(self, frame):
+        for index, pending in enumerate(self._frames):
+            if pending is frame:
+                return index + 1
+        return 0
+
+    def _written(self):
+        if self.on_flush is not None and self._oldest is not None:
+            self.on_flush(monotonic() - self._oldest)
+        self._oldest = None
+
+    # Queues the buffers making up a single frame, returns the pending bytes
+    # Frames queued as `droppable` can be dropped by `drop_pending`, which 
+    # has to be left to frames that nothing else depends on, so never frames 
+    # from a compressed stream
+    def queue(self, *buffers, droppable=False):
+        frame = PendingFrame(memoryview(buffer) for buffer in buffers if buffer)
+        frame.droppable = droppable
+        size = sum(len(view) for view in frame)
+        with self.lock:
+            if size > 0:
+                self._frames.append(frame)
+                self.pending = self.pending + size
+                if self._oldest is None:
+                    self._oldest = monotonic()
+            return self.pending
+
+    def should_flush(self):
+        if self.pending == 0:
+            return False
+        if self.pending >= self.threshold:
+            return True
+        oldest = self._oldest
+        return oldest is not None and monotonic() - oldest >= self.latency
+
+    # Writes out the pending frames, returns True if nothing is left over
+    # When `block` is False it stops as soon as the socket would block
+    # Also returns False while `sendfile` is writing, without writing anything
+    def flush(self, block=True):
+        with self.lock:
+            if self.busy:
+                return False
+            if self._write(len(self._frames), block) > 0:
+                return False
+            self._written()
+            return True
+
+    # Drops the rest of a partially written frame, which would only desync a
+    # new connection, but keeps any frames that have not been started
+    def reset(self):
+        with self.lock:
+            if self._partial:
+                frame = self._frames.popleft()
+                self.pending = self.pending - sum(len(view) for view in frame)
+                self._partial = False
+            if len(self._frames) == 0:
+                self._oldest = None
+
+    # Drops every droppable frame that has not started being written yet, 
+    # returns how many frames were dropped
+    def drop_pending(self):
+        with self.lock:
+            if len(self._frames) == 0:
+                return 0
+            kept = deque()
+            dropped = 0
+            for index, frame in enumerate(self._frames):
+                # NOTE: Part of a partially written frame is already out
+                if not frame.droppable or (index == 0 and self._partial):
+                    kept.append(frame)
+                    continue
+                self.pending = self.pending - sum(len(view) for view in frame)
+                dropped = dropped + 1
+            self._frames = kept
+            if len(self._frames) == 0:
+                self._oldest = None
+            return dropped
+
+    def clear(self):
+        with self.lock:
+            self._frames.clear()
+            self.pending = 0
+            self._oldest = None
+            self._partial = False
+            self.drained.notify_all()
+
+    # Waits until fewer than `limit` bytes are pending, for producers that must
+    # not queue up more than the socket is taking. Returns False on a timeout.
+    def wait_for_room(self, limit, timeout=None):
+        with self.drained:
+            return self.drained.wait_for(lambda: self.pending < limit, timeout)
+
+    # Writes out the pending frames and then `count` bytes of the file from 
+    # `offset` as the rest of a frame whose header is given, with `sendfile`
+    # so the file never has to pass through userspace. The lock is only held
+    # between writes, so others can keep queueing frames for the socket (and
+    # flushing other sockets) while a slow peer takes its time with the file.
+    def sendfile(self, header, file, offset, count):
+        end = offset + count
+        with self.drained:
+            self.drained.wait_for(lambda: not self.busy)
+            self.queue(header)
+            # Frames queued from here on have to wait for the file
+            self.busy = True
+            header_frame = self._frames[-1]
+        try:
+            while True:
+                with self.lock:
+                    left = self._through(header_frame)
+                    if left == 0:
+                        break
+                    try:
+                        self._write(left, True)
+                    # The socket is slow, carry on from where it got to
+                    except sock_timeout:
+                        pass
+            while offset < end:
+                try:
+                    if self.sock.sendfile(file, offset, end - offset) == 0:
+                        raise EOFError("File ended before the frame did")
+                # The socket is slow, carry on from where it got to
+                except sock_timeout:
+                    pass
+                offset = file.tell()
+        finally:
+            with self.lock:
+                self.busy = False
+                if len(self._frames) == 0:
+                    self._written()
+                self.drained.notify_all()
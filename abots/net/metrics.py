@@ -0,0 +1,187 @@
+"""
+
+net/Metrics
+===========
+
+Counters and histograms kept by `SocketServer` and `SocketClient` about the
+traffic going through them, cheap enough to leave on: the hot path only adds
+to numbers that are already there, and anything derived from them is worked
+out when a snapshot is taken. Updates are not locked, so a snapshot taken
+while messages are moving can be off by the few updates that raced with it.
+
+`snapshot` returns everything as a dict, and `export` renders the same in the
+Prometheus text format so that it can be scraped.
+
+"""
+
+from collections import deque
+from time import time, monotonic
+
+# How far back the accept rate looks, in seconds
+rate_window = 60
+
+class Histogram:
+    # Buckets are powers of two, bucket `i` holding values up to `2**i - 1`
+    def __init__(self, buckets=40):
+        self.counts = [0] * (buckets + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        value = int(value)
+        index = min(value.bit_length(), len(self.counts) - 1)
+        self.counts[index] = self.counts[index] + 1
+        self.count = self.count + 1
+        self.sum = self.sum + value
+
+    def snapshot(self):
+        snapshot = dict()
+        snapshot["count"] = self.count
+        snapshot["sum"] = self.sum
+        # Cumulative counts by upper bound, leaving out the empty top end
+        buckets = dict()
+        total = 0
+        for index, count in enumerate(self.counts):
+            total = total + count
+            buckets[2**index - 1] = total
+            if total == self.count:
+                break
+        snapshot["buckets"] = buckets
+        return snapshot
+
+class Metrics:
+    def __init__(self, queues=None):
+        # The queues whose depths are part of every snapshot
+        self.queues = dict() if queues is None else queues
+
+        # Messages in, bytes in, messages out and bytes out for each uuid
+        self.peers = dict()
+        self.totals = [0, 0, 0, 0]
+
+        self.frame_size_in = Histogram()
+        self.frame_size_out = Histogram()
+
+        # Time from a frame being queued until it was written, in microseconds
+        self.send_latency = Histogram()
+
+        self.accepts = 0
+        self.disconnects = 0
+        self.reconnects = 0
+        # Frames that could not be read, such as ones cut short
+        self.malformed_frames = 0
+        self._accepted = deque()
+        self.started = time()
+
+    # Starts counting for the uuid, frames of uuids that are not connected 
+    # only go towards the totals
+    def connected(self, uuid):
+        self.peers.setdefault(uuid, [0, 0, 0, 0])
+
+    def received(self, uuid, size):
+        counters = self.peers.get(uuid, None)
+        if counters is not None:
+            counters[0] = counters[0] + 1
+            counters[1] = counters[1] + size
+        self.totals[0] = self.totals[0] + 1
+        self.totals[1] = self.totals[1] + size
+        self.frame_size_in.observe(size)
+
+    def sent(self, uuid, size):
+        counters = self.peers.get(uuid, None)
+        if counters is not None:
+            counters[2] = counters[2] + 1
+            counters[3] = counters[3] + size
+        self.totals[2] = self.totals[2] + 1
+        self.totals[3] = self.totals[3] + size
+        self.frame_size_out.observe(size)
+
+    # Used as the `on_flush` of a `FrameWriter`, with the seconds waited
+    def flushed(self, waited):
+        self.send_latency.observe(waited * 1000000)
+
+    def accepted(self, uuid):
+        self.accepts = self.accepts + 1
+        self._accepted.append(monotonic())
+        self._trim()
+        self.connected(uuid)
+
+    # Drops the counters of the uuid, the totals keep what it added to them
+    def disconnected(self, uuid):
+        self.disconnects = self.disconnects + 1
+        self.peers.pop(uuid, None)
+
+    def reconnected(self):
+        self.reconnects = self.reconnects + 1
+
+    def malformed(self):
+        self.malformed_frames = self.malformed_frames + 1
+
+    # Forgets the accepts that are older than the window
+    def _trim(self):
+        cutoff = monotonic() - rate_window
+        while len(self._accepted) > 0 and self._accepted[0] < cutoff:
+            self._accepted.popleft()
+
+    def accept_rate(self):
+        self._trim()
+        window = min(rate_window, max(time() - self.started, 1))
+        return len(self._accepted) / window
+
+    def snapshot(self):
+        snapshot = dict()
+        snapshot["uptime"] = time() - self.started
+        names = ["messages_in", "bytes_in", "messages_out", "bytes_out"]
+        snapshot["totals"] = dict(zip(names, self.totals))
+        peers = dict()
+        for uuid, counters in list(self.peers.items()):
+            peers[uuid] = dict(zip(names, counters))
+        snapshot["peers"] = peers
+        depths = dict()
+        for name, queue in self.queues.items():
+            depths[name] = queue.qsize()
+        snapshot["queue_depths"] = depths
+        snapshot["frame_size_in"] = self.frame_size_in.snapshot()
+        snapshot["frame_size_out"] = self.frame_size_out.snapshot()
+        snapshot["send_latency_us"] = self.send_latency.snapshot()
+        snapshot["accepts"] = self.accepts
+        snapshot["accept_rate"] = self.accept_rate()
+        snapshot["disconnects"] = self.disconnects
+        snapshot["reconnects"] = self.reconnects
+        snapshot["malformed_frames"] = self.malformed_frames
+        return snapshot
+
+    # Renders a snapshot in the Prometheus text exposition format
+    def export(self, prefix="abots"):
+        snapshot = self.snapshot()
+        lines = list()
+        def metric(name, kind, samples):
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{prefix}_{name}{labels} {value}")
+        for name, value in snapshot["totals"].items():
+            samples = [("", value)]
+            for uuid, counters in snapshot["peers"].items():
+                samples.append((f'{{uuid="{uuid}"}}', counters[name]))
+            metric(f"{name}_total", "counter", samples)
+        depths = snapshot["queue_depths"]
+        metric("queue_depth", "gauge", [(f'{{queue="{name}"}}', depth)
+            for name, depth in depths.items()])
+        for name in ["frame_size_in", "frame_size_out", "send_latency_us"]:
+            histogram = snapshot[name]
+            samples = [(f'_bucket{{le="{bound}"}}', count)
+                for bound, count in histogram["buckets"].items()]
+            samples.append(('_bucket{le="+Inf"}', histogram["count"]))
+            samples.append(("_sum", histogram["sum"]))
+            samples.append(("_count", histogram["count"]))
+            lines.append(f"# TYPE {prefix}_{name} histogram")
+            for suffix, value in samples:
+                lines.append(f"{prefix}_{name}{suffix} {value}")
+        metric("accepts_total", "counter", [("", snapshot["accepts"])])
+        metric("accept_rate", "gauge", [("", snapshot["accept_rate"])])
+        metric("disconnects_total", "counter", [("",
+            snapshot["disconnects"])])
+        metric("reconnects_total", "counter", [("", snapshot["reconnects"])])
+        metric("malformed_frames_total", "counter", [("",
+            snapshot["malformed_frames"])])
+        metric("uptime_seconds", "gauge", [("", snapshot["uptime"])])
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,149 @@
+"""
+
+net/Reactor
+===========
+
+A small selector-based event loop (epoll on Linux) used by `SocketServer` when
+it runs in reactor mode. Sockets are registered along with a handler which is
+called with `(sock, mask)` from the thread running the loop whenever the socket
+is ready. Other threads talk to the loop through `call`, which queues a method
+to run inside of the loop and wakes up the selector.
+
+"""
+
+from abots.helpers import eprint, cast
+
+from selectors import DefaultSelector, EVENT_READ
+from socket import socketpair
+from threading import Thread, Event, current_thread
+from collections import deque
+
+class Reactor:
+    def __init__(self, timeout=1):
+        # Maximum time spent waiting in the selector before checking the state
+        self.timeout = timeout
+
+        self.selector = DefaultSelector()
+        self.thread = None
+        self.kill_switch = Event()
+        self.stopped = Event()
+
+        # Methods queued by other threads to be run inside of the loop
+        self._calls = deque()
+        self._woken = False
+
+        # Writing to `_waker` will break the loop out of the selector
+        self._waker, self._wakee = socketpair()
+        self._waker.setblocking(False)
+        self._wakee.setblocking(False)
+        self.selector.register(self._wakee, EVENT_READ, self._wake)
+
+    def _wake(self, sock, mask):
+        try:
+            while sock.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _run_calls(self):
+        self._woken = False
+        while len(self._calls) > 0:
+            method, args = self._calls.popleft()
+            try:
+                method(*args)
+            except Exception as e:
+                eprint(e)
+
+    def _register(self, sock, events, handler):
+        try:
+            self.selector.register(sock, events, handler)
+        # The socket can either be broken or no longer open at all
+        except (KeyError, ValueError, OSError) as e:
+            eprint(e)
+
+    # Leaves the selector while there is nothing to wait on, and comes back
+    # once there is something again
+    def _modify(self, sock, events, handler):
+        try:
+            if events == 0:
+                self.selector.unregister(sock)
+            elif sock in self.selector.get_map():
+                self.selector.modify(sock, events, handler)
+            else:
+                self.selector.register(sock, events, handler)
+        # The socket can either be broken or no longer open at all
+        except (KeyError, ValueError, OSError):
+            pass
+
+    def _unregister(self, sock, close=False):
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError, OSError):
+            pass
+        if close:
+            sock.close()
+
+    def in_loop(self):
+        return self.thread is current_thread()
+
+    # Runs the method inside of the loop, right away if already in the loop
+    def call(self, method, *args):
+        if self.in_loop():
+            return method(*args)
+        self._calls.append((method, args))
+        if self._woken:
+            return None
+        self._woken = True
+        try:
+            self._waker.send(b"\0")
+        # The loop is either stopped or is already going to wake up
+        except OSError:
+            pass
+        return None
+
+    def register(self, sock, events, handler):
+        self.call(self._register, sock, events, handler)
+
+    def modify(self, sock, events, handler):
+        self.call(self._modify, sock, events, handler)
+
+    def unregister(self, sock, close=False):
+        self.call(self._unregister, sock, close)
+
+    def run(self):
+        self.thread = current_thread()
+        while not self.kill_switch.is_set():
+            try:
+                ready = self.selector.select(self.timeout)
+            except OSError as e:
+                eprint(e)
+                continue
+            for key, mask in ready:
+                handler = key.data
+                try:
+                    handler(key.fileobj, mask)
+                except Exception as e:
+                    eprint(e)
+            self._run_calls()
+        self._run_calls()
+        for key in list(self.selector.get_map().values()):
+            self._unregister(key.fileobj)
+        self.selector.close()
+        self._waker.close()
+        self._wakee.close()
+        self.stopped.set()
+
+    def start(self):
+        thread = Thread(target=self.run)
+        thread.setDaemon(True)
+        self.thread = thread
+        thread.start()
+        return thread
+
+    def stop(self, done=None):
+        self.kill_switch.set()
+        try:
+            self._waker.send(b"\0")
+        except OSError:
+            pass
+        cast(done, "set")
@@ -0,0 +1,104 @@
+"""
+
+net/RPC
+=======
+
+Bookkeeping for the request/response calls that can be made over the typed
+frames of binary mode. Every call gets a correlation id that its reply echoes
+back, so any number of calls can be in flight on one connection at a time and
+their replies can come back in any order.
+
+Calls are JSON objects of `{"id", "method", "params"}`, and their replies are
+either `{"id", "result"}` or `{"id", "error"}`.
+
+"""
+
+from concurrent.futures import Future
+from itertools import count
+from threading import Lock
+from time import monotonic
+
+# Raised by the future of a call that the handler on the other side failed on
+class RemoteError(Exception):
+    pass
+
+class Calls:
+    def __init__(self):
+        self._ids = count(1)
+        self._lock = Lock()
+
+        # Maps the id of each call in flight to its future and deadline
+        self._pending = dict()
+
+    def __len__(self):
+        return len(self._pending)
+
+    # Returns the future for a new call and the request to send for it
+    def create(self, method, params, timeout=None):
+        future = Future()
+        future.set_running_or_notify_cancel()
+        call_id = next(self._ids)
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._lock:
+            self._pending[call_id] = future, deadline
+        request = dict()
+        request["id"] = call_id
+        request["method"] = method
+        request["params"] = list(params)
+        return future, request
+
+    def resolve(self, reply):
+        if type(reply) != dict:
+            return
+        with self._lock:
+            pending = self._pending.pop(reply.get("id", None), None)
+        if pending is None:
+            return
+        future, deadline = pending
+        if "error" in reply:
+            future.set_exception(RemoteError(reply["error"]))
+        else:
+            future.set_result(reply.get("result", None))
+
+    # Fails every call that has gone past its deadline
+    def expire(self):
+        now = monotonic()
+        expired = list()
+        with self._lock:
+            for call_id, (future, deadline) in list(self._pending.items()):
+                if deadline is not None and deadline <= now:
+                    expired.append(self._pending.pop(call_id)[0])
+        for future in expired:
+            future.set_exception(TimeoutError("Call timed out"))
+
+    # Forgets a call that never made it out, such as one whose parameters
+    # cannot be sent as JSON
+    def discard(self, call_id):
+        with self._lock:
+            self._pending.pop(call_id, None)
+
+    # Fails every call in flight, used when their connection is lost
+    def fail(self, error):
+        with self._lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for future, deadline in pending:
+            future.set_exception(error)
+
+# Runs the handler for a call and builds the reply to send back for it
+def answer(methods, request, *args):
+    reply = dict()
+    if type(request) != dict:
+        reply["id"] = None
+        reply["error"] = "Malformed call"
+        return reply
+    reply["id"] = request.get("id", None)
+    handler = methods.get(request.get("method", None), None)
+    if handler is None:
+        reply["error"] = f"Unknown method: {request.get('method', None)}"
+        return reply
+    try:
+        reply["result"] = handler(*args, *request.get("params", list()))
+    except Exception as e:
+        reply["error"] = repr(e)
+    return reply
@@ -0,0 +1,319 @@
+"""
+
+net/SharedRing
+==============
+
+A transport for processes on the same host built on
+`multiprocessing.shared_memory`, skipping the kernel (and the two copies and
+syscalls of a socket) on the path of every message.
+
+`SharedRing` is a single producer, single consumer ring buffer in a shared
+memory segment. Records are a `>IB` header of the body length and its kind,
+followed by the body, with a marker at the end of the buffer when the next
+record has to wrap around to the start. The producer and consumer each only
+ever move their own position forward, so no lock is shared between them.
+
+Python has no memory fences, so nothing but the order of the writes keeps the
+consumer from seeing the head move before the records it covers are in place.
+That holds on CPUs that keep stores in order with each other and loads in order
+with each other, such as x86-64, where each write is a separate call into C
+that the compiler cannot move past the next. It does not on weakly ordered
+CPUs such as ARM, where records could be read before they are all there, so
+the ring is only meant to be used on the former.
+
+`SharedMemoryChannel` puts two rings together, one for each direction, behind
+the `send`/`recv` interface of `SocketClient`, with messages framed the same as
+in binary mode. Each end has a doorbell, a named FIFO that the other end only
+writes to when it has said it is about to sleep, so a busy channel makes no
+syscalls at all. The flag is checked without a memory fence, so a wakeup that
+races with it can be missed, which costs at most `poll_interval`.
+
+One end creates the channel with `create=True` and the other attaches to it
+by the same name, such as a parent and the child processes it starts. Creating
+it removes whatever a crashed run left behind under the same name first.
+
+"""
+
+from abots.net.framing import frame_payload, read_payload, kind_raw
+
+from multiprocessing.shared_memory import SharedMemory
+from multiprocessing import resource_tracker
+from struct import Struct
+from select import select
+from os import mkfifo, open as os_open, read, write, close, unlink
+from os import O_RDWR, O_NONBLOCK
+from os.path import join
+from tempfile import gettempdir
+from time import monotonic
+
+# Positions and flags at the start of the segment, each on its own cache line
+# so the producer and consumer are not writing to the same one
+position = Struct("<Q")
+head_offset = 0
+tail_offset = 64
+reader_waiting_offset = 128
+writer_waiting_offset = 192
+data_offset = 256
+
+record = Struct(">IB")
+wrap_marker = 0xFFFFFFFF
+
+class SharedRing:
+    def __init__(self, name, create=False, size=1048576):
+        self.name = name
+        self.create = create
+        if create:
+            try:
+                self.shm = SharedMemory(name, True, data_offset + size)
+            # Left behind by a run that never got to remove it
+            except FileExistsError:
+                stale = SharedMemory(name)
+                stale.close()
+                stale.unlink()
+                self.shm = SharedMemory(name, True, data_offset + size)
+            self.shm.buf[:data_offset] = bytes(data_offset)
+        else:
+            self.shm = SharedMemory(name)
+            # Only the end that created it gets to remove it, otherwise the
+            # tracker would when this process exits
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+        self.buf = self.shm.buf
+        self.capacity = len(self.buf) - data_offset
+
+    def _get(self, offset):
+        return position.unpack_from(self.buf, offset)[0]
+
+    def _set(self, offset, value):
+        position.pack_into(self.buf, offset, value)
+
+    def empty(self):
+        return self._get(head_offset) == self._get(tail_offset)
+
+    # Bytes that can be written, a record may also need what is left at the end
+    def free(self):
+        used = self._get(head_offset) - self._get(tail_offset)
+        return self.capacity - used
+
+    @property
+    def reader_waiting(self):
+        return self.buf[reader_waiting_offset] == 1
+
+    @reader_waiting.setter
+    def reader_waiting(self, waiting):
+        self.buf[reader_waiting_offset] = 1 if waiting else 0
+
+    @property
+    def writer_waiting(self):
+        return self.buf[writer_waiting_offset] == 1
+
+    @writer_waiting.setter
+    def writer_waiting(self, waiting):
+        self.buf[writer_waiting_offset] = 1 if waiting else 0
+
+    # Writes as many of the `(kind, body)` records as fit, returning how many
+    # did. Records are joined into one write for each stretch of the buffer up
+    # to where it wraps, and the head is only moved once they are all in place.
+    # NOTE: That the head is written last is all that orders it after the 
+    # records, see the top of the module
+    def put_many(self, records):
+        buf = self.buf
+        capacity = self.capacity
+        head = self._get(head_offset)
+        free = capacity - (head - self._get(tail_offset))
+        written = 0
+        while written < len(records):
+            offset = head % capacity
+            remaining = capacity - offset
+            room = min(free, remaining)
+            parts = list()
+            filled = 0
+            for kind, body in records[written:]:
+                size = record.size + len(body)
+                if size > capacity // 2:
+                    raise ValueError("Record is too large for the ring")
+                if filled + size > room:
+                    break
+                parts.append(record.pack(len(body), kind))
+                parts.append(body)
+                filled = filled + size
+            if filled > 0:
+                start = data_offset + offset
+                buf[start:start + filled] = b"".join(parts)
+                head = head + filled
+                free = free - filled
+                remaining = remaining - filled
+                written = written + len(parts) // 2
+            if written == len(records):
+                break
+            # Whatever is left at the end is skipped if the next record fits
+            # at the start, otherwise the ring is full
+            size = record.size + len(records[written][1])
+            if size <= remaining or remaining + size > free:
+                break
+            if remaining >= 4:
+                start = data_offset + head % capacity
+                buf[start:start + 4] = wrap_marker.to_bytes(4, "big")
+            head = head + remaining
+            free = free - remaining
+        if written > 0:
+            self._set(head_offset, head)
+        return written
+
+    def put(self, kind, body):
+        return self.put_many([(kind, body)]) == 1
+
+    # Reads every record that is in the ring as `(kind, body)` tuples, copying
+    # each stretch of the buffer out at once before splitting it up
+    def get_many(self):
+        capacity = self.capacity
+        tail = self._get(tail_offset)
+        head = self._get(head_offset)
+        records = list()
+        while tail < head:
+            offset = tail % capacity
+            remaining = capacity - offset
+            if remaining < 4:
+                tail = tail + remaining
+                continue
+            start = data_offset + offset
+            end = start + min(remaining, head - tail)
+            chunk = bytes(self.buf[start:end])
+            if int.from_bytes(chunk[:4], "big") == wrap_marker:
+                tail = tail + remaining
+                continue
+            cursor = 0
+            while cursor + record.size <= len(chunk):
+                length, kind = record.unpack_from(chunk, cursor)
+                if length == wrap_marker:
+                    break
+                body_start = cursor + record.size
+                records.append((kind, chunk[body_start:body_start + length]))
+                cursor = body_start + length
+            tail = tail + cursor
+        self._set(tail_offset, tail)
+        return records
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.create:
+            # The other end let go of it in the tracker, which it may share
+            resource_tracker.register(self.shm._name, "shared_memory")
+            self.shm.unlink()
+
+class Doorbell:
+    def __init__(self, path, create=False):
+        self.path = path
+        self.create = create
+        if create:
+            try:
+                mkfifo(path)
+            # Left behind by a run that never got to remove it
+            except FileExistsError:
+                unlink(path)
+                mkfifo(path)
+        # Opened for both reading and writing so that neither end blocks
+        self.fd = os_open(path, O_RDWR | O_NONBLOCK)
+
+    def ring(self):
+        try:
+            write(self.fd, b"\0")
+        # It is already ringing
+        except BlockingIOError:
+            pass
+
+    # Waits for the bell for up to `timeout` seconds, and quiets it again
+    def wait(self, timeout=None):
+        readable = select([self.fd], [], [], timeout)[0]
+        try:
+            while read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        return len(readable) > 0
+
+    def close(self):
+        close(self.fd)
+        if self.create:
+            unlink(self.path)
+
+class SharedMemoryChannel:
+    def __init__(self, name, create=False, size=1048576, poll_interval=0.01):
+        self.name = name
+        self.create = create
+        self.poll_interval = poll_interval
+
+        # The end that creates the channel writes to the first ring and reads
+        # from the second, the other end the other way around
+        side = 0 if create else 1
+        self._out = SharedRing(f"{name}-{side}", create, size)
+        self._in = SharedRing(f"{name}-{1 - side}", create, size)
+        bells = [join(gettempdir(), f"{name}-{end}.bell") for end in range(2)]
+        if create:
+            self._peer_bell = Doorbell(bells[1], True)
+            self._bell = Doorbell(bells[0], True)
+        else:
+            self._peer_bell = Doorbell(bells[0])
+            self._bell = Doorbell(bells[1])
+
+    # Sleeps on the doorbell until the condition holds or the time is up
+    def _sleep(self, flag, ready, timeout):
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            setattr(*flag, True)
+            if ready():
+                setattr(*flag, False)
+                return True
+            wait = self.poll_interval
+            if deadline is not None:
+                wait = min(wait, deadline - monotonic())
+                if wait <= 0:
+                    setattr(*flag, False)
+                    return False
+            self._bell.wait(wait)
+            setattr(*flag, False)
+            if ready():
+                return True
+
+    def send_many(self, messages):
+        records = list()
+        for message in messages:
+            # Bytes are sent as they are without building a header for them
+            if isinstance(message, (bytes, bytearray)):
+                records.append((kind_raw, message))
+                continue
+            header, body = frame_payload(message)
+            records.append((header[-1], body))
+        while len(records) > 0:
+            written = self._out.put_many(records)
+            records = records[written:]
+            if written > 0 and self._out.reader_waiting:
+                self._peer_bell.ring()
+            if len(records) > 0:
+                # The ring is full, so wait for the other end to make room
+                size = record.size + len(records[0][1])
+                self._sleep((self._out, "writer_waiting"),
+                    lambda: self._out.free() >= 2 * size, None)
+
+    def send(self, message, *args):
+        if len(args) > 0:
+            message = message.format(*args)
+        self.send_many([message])
+
+    # Returns every message waiting, after waiting up to `timeout` seconds
+    # for one if there are none (or for as long as it takes if it is None)
+    def recv(self, timeout=0):
+        if self._in.empty() and timeout != 0:
+            self._sleep((self._in, "reader_waiting"),
+                lambda: not self._in.empty(), timeout)
+        records = self._in.get_many()
+        if len(records) > 0 and self._in.writer_waiting:
+            self._peer_bell.ring()
+        return [body if kind == kind_raw else read_payload(kind, body)
+            for kind, body in records]
+
+    def close(self):
+        self._out.close()
+        self._in.close()
+        self._bell.close()
+        self._peer_bell.close()
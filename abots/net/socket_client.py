@@ -8,33 +8,127 @@ Socket Client
 """
 
 from abots.helpers import eprint, cast, jots, jsto, utc_now_timestamp
+from abots.net.framing import FrameDecoder, FrameWriter, frame_message
+from abots.net.framing import frame_payload, read_payload, encode_json
+from abots.net.framing import kind_json, kind_hello, kind_call, kind_reply
+from abots.net.framing import kind_subscribe, kind_unsubscribe
+from abots.net.framing import kind_publish, flag_compressed, frame_topic
+from abots.net.framing import read_topic, kind_ping, kind_pong
+from abots.net.framing import heartbeat_format, kind_stream_start
+from abots.net.framing import kind_stream_chunk, kind_stream_end
+from abots.net.framing import frame_stream, stream_header
+from abots.net.rpc import Calls
+from abots.net.compression import Compressor, methods as compress_methods
+from abots.net.bounded_queue import BoundedQueue
+from abots.net.dispatcher import Dispatcher
+from abots.net.streams import Streams
+from abots.net.metrics import Metrics
+from abots.events import Every
 
-from struct import pack, unpack
+from struct import pack, unpack, error as struct_error
+from zlib import error as zlib_error
 from socket import socket, timeout as sock_timeout
-from socket import AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
+from socket import socketpair, AF_INET, AF_UNIX, SOCK_STREAM, SOL_SOCKET
+from socket import SO_REUSEADDR
 from ssl import wrap_socket
 from threading import Thread, Event
-from queue import Queue, Empty
-from time import sleep
+from queue import Queue, Empty, Full
+from time import sleep, monotonic
 from random import randint
+from itertools import count
+from functools import partial
+from os.path import basename
+from os import fstat
 
 class SocketClient(Thread):
-    def __init__(self, host, port, buffer_size=4096, secure=False, 
-        timeout=None, daemon=False, reconnects=10):
+    def __init__(self, host, port=None, buffer_size=4096, secure=False, 
+        timeout=None, daemon=False, reconnects=10, flush_threshold=65536,
+        flush_latency=0.01, binary=False, compress=False, compress_level=6,
+        compress_threshold=1024, inbox_size=0, outbox_size=0, events_size=0,
+        overflow="block", sock=None, marshal=None, heartbeat=None,
+        heartbeat_timeout=None, downloads=None, stream_size=16):
         super().__init__()
         self.setDaemon(daemon)
 
+        # Without a port the host is instead the path of the Unix domain 
+        # socket the server is listening on
         self.host = host
         self.port = port
+        self.family = AF_UNIX if port is None else AF_INET
         self.buffer_size = buffer_size
         self.secure = secure
         self.timeout = timeout
         self.reconnects = reconnects
-        self.sock = socket(AF_INET, SOCK_STREAM)
+
+        # Uses typed frames that carry bytes, text or JSON as they are, rather 
+        # than forcing every message through a string. See `frame_payload`.
+        self.binary = binary
+
+        # Asks the server to compress frames of at least `compress_threshold`
+        # bytes when connecting, and does the same if it agrees
+        if compress and not binary:
+            raise ValueError("Compression needs binary mode")
+        self.compress = compress
+        self.compress_level = compress_level
+        self.compress_threshold = compress_threshold
+        self.compressor = None
+
+        # Streams being received from the server, with the ones of files 
+        # written straight into `downloads` if it is set. Reading from the 
+        # server is paused while one of its streams has `stream_size` chunks 
+        # that have not been read yet, with 0 leaving them unbounded. See 
+        # `Streams`.
+        self.streams = Streams(downloads, stream_size)
+        self._stream_ids = count(1)
+
+        # Pings the server each `heartbeat` seconds, and treats the connection 
+        # as broken once nothing at all has come from the server for 
+        # `heartbeat_timeout` seconds
+        if heartbeat is not None and not binary:
+            raise ValueError("Heartbeats need binary mode")
+        self.heartbeat = heartbeat
+        self.heartbeat_timeout = heartbeat_timeout
+        if heartbeat is not None and heartbeat_timeout is None:
+            self.heartbeat_timeout = 3 * heartbeat
+        self._heartbeats = None
+        self._seen = monotonic()
+
+        # Round trip time of the last heartbeat, in seconds
+        self.rtt = None
+
+        # Calls made with `call` that are still waiting on their replies
+        self.calls = Calls()
+
+        # Topic patterns subscribed to, sent again after every reconnect
+        self.topics = set()
+
+        # Handlers that messages are pushed to as soon as they are decoded, the
+        # ones that are not inline run on `marshal`. See `Dispatcher`.
+        self.dispatcher = Dispatcher(marshal)
+
+        # An already connected socket can be given instead, in which case there 
+        # is nothing to reconnect to once it breaks. See `socket_pair`.
+        self.paired = sock is not None
+        if self.paired:
+            self.family = sock.family
+            self.sock = sock
+        else:
+            self.sock = socket(self.family, SOCK_STREAM)
         if self.secure:
             self.sock = wrap_socket(self.sock, **kwargs)
+        self.decoder = FrameDecoder(self.buffer_size, self.binary)
+
+        # Outgoing frames are coalesced until either this many bytes are 
+        # pending, this many seconds have passed since the oldest one was 
+        # queued, or the inbox has run dry. See `FrameWriter`.
+        self.flush_threshold = flush_threshold
+        self.flush_latency = flush_latency
+        writer_args = self.sock, self.flush_threshold, self.flush_latency
+        self.writer = FrameWriter(*writer_args)
 
         self.connection = (self.host, self.port)
+        if self.family == AF_UNIX:
+            self.connection = self.host
         self.running = True
 
         self.kill_switch = Event()
@@ -42,33 +136,58 @@ class SocketClient(Thread):
         self.stopped = Event()
         self.broken = Event()
         self.reconnecting = Event()
+        # Counts the times the connection broke, so a stream can tell that it
+        # was cut off part way through
+        self._breaks = 0
 
-        self._inbox = Queue()
-        self._events = Queue()
-        self._outbox = Queue()
+        # Bounds on each of the queues, with 0 leaving them unbounded, and what
+        # is done once one is full. See `BoundedQueue`. Reading from the server 
+        # is paused while the outbox is full unless it is set to "drop-oldest".
+        self.overflow = overflow
+        self._inbox = BoundedQueue(inbox_size, overflow)
+        self._events = BoundedQueue(events_size, overflow)
+        self._outbox = BoundedQueue(outbox_size, overflow)
         self.queues = dict()
         self.queues["inbox"] = self._inbox
         self.queues["outbox"] = self._outbox
         self.queues["events"] = self._events
 
+        # Counters and histograms of the traffic, see `Metrics`
+        self.metrics = Metrics(self.queues)
+        self.metrics.connected("server")
+        self.writer.on_flush = self.metrics.flushed
+
     def _send_event(self, message):
-        self._events.put(jots(message))
+        # NOTE: Never waits for room, it is called from the threads doing I/O
+        try:
+            self._events.put(jots(message), block=False)
+        # Nobody is keeping up with the events, so this one is dropped
+        except Full:
+            self._events.dropped = self._events.dropped + 1
     
     def _prepare(self):
         self.sock.setblocking(False)
         self.sock.settimeout(1)
+        if self.paired:
+            return False, None
         try:
             self.sock.connect(self.connection)
         except Exception as e:
             return True, e
         return False, None
     
-    def _obtain(self, queue, timeout=False):
+    # With `block` set, the first item is waited on for up to `timeout` (or for
+    # as long as it takes when that is None) and the rest are taken as they are
+    def _obtain(self, queue, timeout=False, block=False):
         if timeout is False:
             timeout = self.timeout
+        waiting = block
         while True:
             try:
-                if timeout is not None:
+                if waiting:
+                    waiting = False
+                    yield queue.get(timeout=timeout)
+                elif timeout is not None and not block:
                     yield queue.get(timeout=timeout)
                 else:
                     yield queue.get_nowait()
@@ -78,77 +197,195 @@ class SocketClient(Thread):
 
     def _queue_thread(self, inbox, timeout):
         while not self.kill_switch.is_set():
-            for message in self._obtain(inbox, timeout):
+            # Sleeps until there is a message, or only until the frames held 
+            # back are due to be written out if there are any
+            wait = timeout
+            if self.writer.pending > 0:
+                wait = self.flush_latency
+            for message in self._obtain(inbox, wait, True):
+                # NOTE: Sentinel put in by `stop` to wake the thread up
+                if message is None:
+                    continue
                 if self.broken.is_set():
                     self.reconnecting.wait()
-                self.send_message(message)
+                try:
+                    self.send_message(message)
+                # The message could not be framed, see `frame_payload`
+                except ValueError as e:
+                    event = dict()
+                    event["name"] = "message_error"
+                    event["data"] = dict()
+                    event["data"]["error"] = str(e)
+                    self._send_event(event)
+            # Anything still held back gets written out once the inbox is dry
+            if self.writer.pending > 0:
+                self._flush()
 
-    def _recv_bytes(self, get_bytes, decode=True):
-        data = "".encode()
-        attempts = 0
-        while len(data) < get_bytes:
-            # Automatically break loop to prevent infinite loop
-            # Allow at least twice the needed iterations to occur exiting loop
-            if attempts > 2 * (get_bytes / self.buffer_size):
-                break
-            else:
-                attempts = attempts + 1
-            bufsize = get_bytes - len(data)
+    # Splits the message into the header and body of its frame
+    def _frame(self, message, *args):
+        if self.binary:
+            return frame_payload(message, *args)
+        return frame_message(message, *args)
+
+    def _package_message(self, message, *args):
+        return b"".join(self._frame(message, *args))
+
+    # Frames one of the JSON messages the connections use amongst themselves
+    def _control(self, kind, message):
+        return frame_payload(encode_json(message), kind=kind)
+
+    # Queues the frame, compressing it first if that was agreed on
+    def _send_frame(self, header, body):
+        with self.writer.lock:
+            if self.compressor is not None:
+                header, body = self.compressor.compress_frame(header, body)
+            self.writer.queue(header, body)
+        self.metrics.sent("server", len(header) + len(body))
+
+    # Offers the server what this client supports, sent on every connect
+    def _hello(self):
+        if not self.compress:
+            return
+        self.compressor = Compressor(self.compress_level, 
+            self.compress_threshold)
+        hello = dict()
+        hello["compress"] = compress_methods
+        self._send_frame(*self._control(kind_hello, hello))
 
-            # Force bufsize to cap out at buffer_size
-            if bufsize > self.buffer_size:
-                bufsize = self.buffer_size
+    # Turns a frame into the message it carries, or handles it and returns 
+    # None if it is one the connections use to talk amongst themselves
+    def _read_frame(self, frame):
+        try:
+            return self._open_frame(frame)
+        # The compressed stream cannot be followed anymore, so it starts over
+        # on a new connection
+        except zlib_error:
+            self.metrics.malformed()
+            self._attempt_reconnect()
+        # Too short for what its kind holds, so it is dropped
+        except struct_error:
+            self.metrics.malformed()
+        return None
+
+    def _open_frame(self, frame):
+        flags, kind, body = frame
+        self.metrics.received("server", self.decoder.header_size + len(body))
+        self._seen = monotonic()
+        if flags & flag_compressed:
+            if self.compressor is None:
+                return None
+            body = self.compressor.decompress(body)
+        if kind == kind_hello:
+            reply = read_payload(kind_json, body)
+            if type(reply) == dict and self.compressor is not None:
+                accepted = reply.get("compress", None)
+                # The other end of a pair offers its own methods rather than
+                # picking one, and it will make the same choice from ours
+                if type(accepted) == list:
+                    accepted = any(method in accepted 
+                        for method in compress_methods)
+                else:
+                    accepted = accepted in compress_methods
+                self.compressor.enabled = accepted
+            return None
+        elif kind == kind_reply:
+            self.calls.resolve(read_payload(kind_json, body))
+            return None
+        elif kind == kind_ping:
+            self._send_frame(*frame_payload(body, kind=kind_pong))
+            self._flush()
+            return None
+        elif kind == kind_pong:
+            self.rtt = monotonic() - unpack(heartbeat_format, body)[0]
+            return None
+        elif kind == kind_publish:
+            topic, message_kind, payload = read_topic(body)
+            message = topic, read_payload(message_kind, payload)
+        elif kind == kind_stream_start:
+            message = self.streams.start(None, body)
+            if message is None:
+                return None
+        elif kind == kind_stream_chunk:
+            self.streams.chunk(None, body)
+            return None
+        elif kind == kind_stream_end:
+            download = self.streams.end(None, body)
+            if download is not None:
+                event = dict()
+                event["name"] = "file_received"
+                event["data"] = dict()
+                event["data"]["path"] = download.path
+                event["data"]["size"] = download.received
+                event["data"]["error"] = None
+                if download.error is not None:
+                    event["data"]["error"] = str(download.error)
+                self._send_event(event)
+            return None
+        else:
+            message = read_payload(kind, body)
+        # Clients have no uuid of their own to be called with
+        if self.dispatcher.dispatch(None, message, kind):
+            return None
+        return message
+
+    def _flush(self):
+        try:
+            self.writer.flush()
+        # The socket can either be broken or no longer open at all
+        except (BrokenPipeError, OSError) as e:
+            # The server is too slow to keep up, try again on the next flush
+            if not isinstance(e, sock_timeout):
+                self._attempt_reconnect()
+
+    # Get message from socket, reading more from it if none are pending
+    def _get_message(self):
+        if len(self.decoder.frames) == 0:
             try:
-                packet = self.sock.recv(bufsize)
+                self.decoder.recv_from(self.sock)
             # The socket can either be broken or no longer open at all
             except (BrokenPipeError, OSError) as e:
                 if not isinstance(e, sock_timeout):
                     self._attempt_reconnect()
                 return None
-            data = data + packet
-        return data.decode() if decode else data
-
-    def _package_message(self, message, *args):
-        if len(args) > 0:
-            formatted = message.format(*args)
-        else:
-            formatted = message
-        packaged = pack(">I", len(formatted)) + formatted.encode()
-        return packaged
-
-    def _get_message_size(self):
-        raw_message_size = self._recv_bytes(4, False)
-        if not raw_message_size:
-            return None
-        message_size = unpack(">I", raw_message_size)[0]
-        return message_size
-
-    def _get_message(self):
-        message_size = self._get_message_size()
-        if message_size is None:
-            return None
-        try:
-            return self._recv_bytes(message_size)
-        except OSError:
+        frame = self.decoder.pop()
+        if frame is None:
             return None
+        return self._read_frame(frame)
 
     def _attempt_reconnect(self):
         if self.kill_switch.is_set():
             return
         print("BROKEN!")
         self.reconnecting.clear()
+        self._breaks = self._breaks + 1
         self.broken.set()
         event = dict()
         event["name"] = "socket-down"
         event["data"] = dict()
         event["data"]["when"] = utc_now_timestamp()
         self._send_event(event)
+        # Their replies will never make it back over a new connection
+        self.calls.fail(ConnectionResetError("Connection lost"))
+        self.streams.abort(None)
+        if self.paired:
+            self.stop()
+            return
         attempts = 0
         while attempts <= self.reconnects or not self.kill_switch.is_set():
             # Need to be run to prevent ConnectionAbortedError
-            self.sock.__init__()
+            self.sock.__init__(self.family, SOCK_STREAM)
+            # Partial frames from the old connection would desync the new one
+            self.decoder.clear()
+            self.writer.reset()
+            if self.compressor is not None and self.compressor.enabled:
+                # So would frames compressed for the old connection's stream
+                self.writer.clear()
             err, report = self._prepare()
             if not err:
+                self._seen = monotonic()
+                self.metrics.reconnected()
+                self._hello()
+                self._resubscribe()
                 self.reconnecting.set()
                 self.broken.clear()
                 event = dict()
@@ -164,18 +401,173 @@ class SocketClient(Thread):
             sleep(delay)
         self.stop()
 
+    # Waits out a reconnect before a stream starts, returning the connection
+    # it is sent on. Unlike other control frames these are never left out.
+    def _stream_connection(self):
+        if not self.ready.is_set():
+            raise ConnectionError("Streams need a connection")
+        if self.broken.is_set():
+            self.reconnecting.wait()
+        return self._breaks
+
+    # The server drops whatever it had of the stream once the connection it 
+    # started on breaks, so the rest of it must not go out on a new one
+    def _send_stream_frame(self, connection, header, body):
+        if self.broken.is_set() or self._breaks != connection:
+            raise ConnectionResetError("Stream cut off")
+        self._send_frame(header, body)
+
+    # Sends the chunks as a single message that the server receives as a
+    # `Stream`, so that it never has to be held in memory all at once
+    def send_stream(self, chunks, meta=None):
+        if not self.binary:
+            raise ValueError("Streams need binary mode")
+        meta = dict() if meta is None else meta
+        start_body = encode_json(meta)
+        connection = self._stream_connection()
+        stream_id = next(self._stream_ids)
+        start = frame_stream(kind_stream_start, stream_id, start_body)
+        self._send_stream_frame(connection, *start)
+        for chunk in chunks:
+            chunk_frame = frame_stream(kind_stream_chunk, stream_id, chunk)
+            self._send_stream_frame(connection, *chunk_frame)
+            if self.writer.pending >= self.flush_threshold:
+                self._flush()
+        end = frame_stream(kind_stream_end, stream_id)
+        self._send_stream_frame(connection, *end)
+        self._flush()
+
+    # Sends the file as a stream, using `sendfile` so that it goes from the 
+    # disk to the socket without being copied through userspace
+    def send_file(self, path, name=None, chunk_size=1048576):
+        if not self.binary:
+            raise ValueError("Streams need binary mode")
+        with open(path, "rb") as file:
+            size = fstat(file.fileno()).st_size
+            meta = dict()
+            meta["name"] = basename(path) if name is None else name
+            meta["size"] = size
+            meta["file"] = True
+            # SSL sockets cannot use `sendfile`
+            if self.secure:
+                chunks = iter(partial(file.read, chunk_size), b"")
+                return self.send_stream(chunks, meta)
+            start_body = encode_json(meta)
+            connection = self._stream_connection()
+            stream_id = next(self._stream_ids)
+            start = frame_stream(kind_stream_start, stream_id, start_body)
+            self._send_stream_frame(connection, *start)
+            offset = 0
+            while offset < size:
+                length = min(chunk_size, size - offset)
+                header = stream_header(kind_stream_chunk, stream_id, length)
+                if self.broken.is_set() or self._breaks != connection:
+                    raise ConnectionResetError("Stream cut off")
+                try:
+                    self.writer.sendfile(header, file, offset, length)
+                    self.metrics.sent("server", len(header) + length)
+                # The socket can either be broken or no longer open at all
+                except (BrokenPipeError, OSError, EOFError) as e:
+                    self._attempt_reconnect()
+                    raise ConnectionResetError("Stream cut off")
+                offset = offset + length
+        end = frame_stream(kind_stream_end, stream_id)
+        self._send_stream_frame(connection, *end)
+        self._flush()
+
     def send_message(self, message, *args):
-        packaged = self._package_message(message, *args)
+        self._send_frame(*self._frame(message, *args))
+        if self._inbox.empty() or self.writer.should_flush():
+            self._flush()
+
+    # Calls the method registered on the server, returning a future for the 
+    # result. Any number of calls can be in flight at the same time.
+    def call(self, method, *params, timeout=None):
+        if not self.binary:
+            raise ValueError("Calls need binary mode")
+        future, request = self.calls.create(method, params, timeout)
         try:
-            self.sock.send(packaged)
-        except (BrokenPipeError, OSError) as e:
-            if not isinstance(e, sock_timeout):
-                self._attempt_reconnect()
-            self._attempt_reconnect()
+            frame = self._control(kind_call, request)
+        # The parameters cannot be sent as JSON, so the call never goes out
+        except ValueError:
+            self.calls.discard(request["id"])
+            raise
+        if self.broken.is_set():
+            self.reconnecting.wait()
+        self._send_frame(*frame)
+        if self._inbox.empty() or self.writer.should_flush():
+            self._flush()
+        return future
+
+    # Like `call`, but waits for the result
+    def request(self, method, *params, timeout=None):
+        return self.call(method, *params, timeout=timeout).result(timeout)
+
+    # Sends a control frame right away, if connected, or leaves it for the 
+    # next time it connects otherwise
+    def _send_control(self, header, body):
+        if not self.ready.is_set():
+            return
+        if self.broken.is_set():
+            self.reconnecting.wait()
+        self._send_frame(header, body)
+        if self._inbox.empty() or self.writer.should_flush():
+            self._flush()
+
+    def _heartbeat(self, state):
+        ping = pack(heartbeat_format, monotonic())
+        self._send_control(*frame_payload(ping, kind=kind_ping))
+        return state
+
+    # Whether the server has gone quiet for longer than it should have
+    def _silent(self):
+        if self.heartbeat is None:
+            return False
+        return monotonic() - self._seen > self.heartbeat_timeout
+
+    # Sends the subscriptions over again, as a new connection starts without
+    def _resubscribe(self):
+        for pattern in list(self.topics):
+            self._send_frame(*frame_payload(pattern.encode(), 
+                kind=kind_subscribe))
+
+    # Has the server send along messages published to topics matching the
+    # pattern, which they come out of `recv` as `(topic, message)` tuples
+    def subscribe(self, pattern):
+        if not self.binary:
+            raise ValueError("Topics need binary mode")
+        self.topics.add(pattern)
+        self._send_control(*frame_payload(pattern.encode(), 
+            kind=kind_subscribe))
+
+    def unsubscribe(self, pattern):
+        self.topics.discard(pattern)
+        self._send_control(*frame_payload(pattern.encode(), 
+            kind=kind_unsubscribe))
+
+    # Publishes the message to every other client subscribed to the topic
+    def publish(self, topic, message, *args):
+        if not self.binary:
+            raise ValueError("Topics need binary mode")
+        self._send_control(*frame_topic(topic, message, *args))
+
+    # Has the handler called with `(None, message)` for every message of the 
+    # kind, or every message at all, instead of them going to the outbox
+    def add_handler(self, handler, kind=None, inline=True, batch=None, 
+        window=None):
+        self.dispatcher.add_handler(handler, kind, inline, batch, window)
+
+    def remove_handler(self, handler):
+        self.dispatcher.remove_handler(handler)
 
     def recv(self):
         return [letter for letter in self._obtain(self._outbox)]
 
+    def compression_stats(self):
+        if self.compressor is None:
+            return None
+        return self.compressor.stats()
+
     def send(self, message):
         self._inbox.put(message)
 
@@ -184,17 +576,43 @@ class SocketClient(Thread):
         if err:
             eprint(report)
             return report
+        self._seen = monotonic()
+        self._hello()
+        self._resubscribe()
         queue_args = self._inbox, self.timeout
         Thread(target=self._queue_thread, args=queue_args).start()
         print("Client ready!")
         self.ready.set()
+        # Also sent after every reconnect, so whoever tracks the health of the
+        # connection can go by these events alone
+        event = dict()
+        event["name"] = "socket-up"
+        event["data"] = dict()
+        event["data"]["when"] = utc_now_timestamp()
+        self._send_event(event)
+        if self.heartbeat is not None:
+            self._heartbeats = Every(self.heartbeat, self._heartbeat)
+            self._heartbeats.start()
         while self.running:
             if self.broken.is_set():
                 self.reconnecting.wait()
+            self.calls.expire()
+            if self._silent():
+                self._attempt_reconnect()
+                continue
+            # Stops reading while the outbox is full, so TCP pushes back
+            if not self._outbox.wait_for_room(1):
+                continue
+            # Same for the streams the server is sending
+            if not self.streams.wait_for_room(None, 1):
+                continue
             message = self._get_message()
             if message is None:
                 continue
-            self._outbox.put(message)
+            if self._outbox.overflow == "drop-oldest":
+                self._outbox.put(message)
+            else:
+                self._outbox.force(message)
 
     def stop(self, done=None):
         # print("Stopping client!")
@@ -205,7 +623,19 @@ class SocketClient(Thread):
         event["data"]["when"] = utc_now_timestamp()
         self._send_event(event)
         self.running = False
+        self._inbox.force(None)
+        self.dispatcher.stop()
+        cast(self._heartbeats, "stop")
+        self.calls.fail(ConnectionAbortedError("Client stopped"))
         self.sock.close()
         self.stopped.set()
         cast(done, "set")
-        # print("Stopped client!")
\ No newline at end of file
+        # print("Stopped client!")
+
+# Connects two clients to each other over a `socketpair`, such as for a parent 
+# and the child process it forks, which each start their own end
+def socket_pair(**kwargs):
+    left, right = socketpair()
+    left_client = SocketClient(None, sock=left, **kwargs)
+    right_client = SocketClient(None, sock=right, **kwargs)
+    return left_client, right_client
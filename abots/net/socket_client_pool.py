@@ -0,0 +1,234 @@
+"""
+
+net/SocketClientPool
+====================
+
+Manages `size` connections to one or more `(host, port)` endpoints, so that
+one slow message no longer holds up everything behind it on a single stream.
+
+The pool has the same `send`/`recv`/`call`/`queues` interface as
+`SocketClient`. Each `send` or `call` goes to one of the connections, picked
+either in turn (`round-robin`) or by having the fewest messages and calls still
+outstanding (`least-outstanding`). Connections that are broken or reconnecting
+are routed around until they come back up, which the pool learns from their
+`socket-down` and `socket-up` events. Connections that gave up, either because
+they could not connect in the first place or ran out of reconnects, are
+replaced with new ones every `retry` seconds.
+
+The messages and events of every connection are relayed to the pool, with the
+events tagged by the index of the connection they came from.
+
+"""
+
+from abots.helpers import cast, jsto, jots, utc_now_timestamp
+from abots.net.socket_client import SocketClient
+from abots.events import Every
+
+from threading import Thread, Event, Lock
+from queue import Queue, Empty
+from itertools import count
+from time import monotonic
+
+strategies = ["round-robin", "least-outstanding"]
+
+class SocketClientPool:
+    def __init__(self, endpoints, size=None, strategy="round-robin",
+        timeout=None, daemon=False, connect_timeout=5, retry=1, **kwargs):
+        if strategy not in strategies:
+            raise ValueError(f"Unknown strategy: {strategy}")
+        # Either a single `(host, port)` or a list of them
+        if type(endpoints) == tuple:
+            endpoints = [endpoints]
+        self.endpoints = endpoints
+        self.size = len(endpoints) if size is None else size
+        self.strategy = strategy
+        self.timeout = timeout
+        self.daemon = daemon
+        # How long `start` waits for the connections to come up, the ones that
+        # do not by then are routed around until they do
+        self.connect_timeout = connect_timeout
+        # How often connections whose thread has exited are replaced
+        self.retry = retry
+        self._revivals = None
+
+        # Passed along to each `SocketClient`
+        kwargs["timeout"] = timeout
+        kwargs["daemon"] = daemon
+        self.kwargs = kwargs
+
+        self._events = Queue()
+        self._outbox = Queue()
+        self.queues = dict()
+        self.queues["outbox"] = self._outbox
+        self.queues["events"] = self._events
+
+        # The connections are spread evenly over the endpoints
+        self.clients = [self._connect(index) for index in range(self.size)]
+
+        # Whether each connection is up, kept current by its events
+        self.healthy = [False] * self.size
+        self._turns = count()
+        self._lock = Lock()
+
+        self.ready = Event()
+        self.stopped = Event()
+
+    def _send_event(self, message):
+        self._events.put(jots(message))
+
+    def _obtain(self, queue, timeout=False):
+        if timeout is False:
+            timeout = self.timeout
+        while True:
+            try:
+                if timeout is not None:
+                    yield queue.get(timeout=timeout)
+                else:
+                    yield queue.get_nowait()
+                queue.task_done()
+            except Empty:
+                break
+
+    # Moves the messages of a connection up to the pool
+    def _connect(self, index):
+        host, port = self.endpoints[index % len(self.endpoints)]
+        return SocketClient(host, port, **self.kwargs)
+
+    def _attach(self, index, client):
+        client.start()
+        relays = list()
+        relays.append(Thread(target=self._relay_outbox, args=(client,)))
+        relay_args = index, client
+        relays.append(Thread(target=self._relay_events, args=relay_args))
+        for relay in relays:
+            relay.setDaemon(True)
+            relay.start()
+
+    # NOTE: A `None` on either of its queues tells the relays of a connection
+    # that it was replaced
+    def _detach(self, client):
+        client._outbox.put(None)
+        client._events.put(None)
+
+    # Replaces the connections whose thread has exited, carrying over the
+    # messages they were never able to send
+    def _revive(self, state):
+        for index in range(self.size):
+            client = self.clients[index]
+            if self.stopped.is_set() or client.is_alive():
+                continue
+            revived = self._connect(index)
+            while True:
+                try:
+                    revived.send(client._inbox.get_nowait())
+                except Empty:
+                    break
+            with self._lock:
+                self.healthy[index] = False
+                self.clients[index] = revived
+            self._detach(client)
+            self._attach(index, revived)
+
+    def _relay_outbox(self, client):
+        while not self.stopped.is_set():
+            message = client._outbox.get()
+            if message is None:
+                break
+            self._outbox.put(message)
+            client._outbox.task_done()
+
+    # Keeps track of the health of a connection before passing its events on
+    def _relay_events(self, index, client):
+        while True:
+            raw_event = client._events.get()
+            client._events.task_done()
+            if raw_event is None:
+                break
+            event = jsto(raw_event)
+            if type(event) != dict:
+                continue
+            name = event.get("name", None)
+            with self._lock:
+                if name == "socket-up":
+                    self.healthy[index] = True
+                elif name in ["socket-down", "closing"]:
+                    self.healthy[index] = False
+            event.setdefault("data", dict())["client"] = index
+            self._send_event(event)
+            if name == "closing":
+                break
+
+    def _usable(self, index):
+        client = self.clients[index]
+        if client.stopped.is_set() or client.broken.is_set():
+            return False
+        return self.healthy[index]
+
+    def _outstanding(self, index):
+        client = self.clients[index]
+        return client._inbox.qsize() + len(client.calls)
+
+    # NOTE: Only a connection whose thread is still running ever sends what is
+    # put in its inbox
+    def _running(self, index):
+        client = self.clients[index]
+        return client.is_alive() and not client.stopped.is_set()
+
+    # Picks the connection to use next, falling back to any that is still
+    # reconnecting if none of them are up right now
+    def pick(self):
+        indexes = [index for index in range(self.size) if self._usable(index)]
+        if len(indexes) == 0:
+            indexes = [index for index in range(self.size)
+                if self._running(index)]
+        if len(indexes) == 0:
+            return None
+        turn = next(self._turns) % len(indexes)
+        if self.strategy == "least-outstanding":
+            # Starts from the next turn so that ties are still spread out
+            indexes = indexes[turn:] + indexes[:turn]
+            return self.clients[min(indexes, key=self._outstanding)]
+        return self.clients[indexes[turn]]
+
+    def recv(self):
+        return [message for message in self._obtain(self._outbox)]
+
+    def send(self, message):
+        client = self.pick()
+        if client is None:
+            raise ConnectionAbortedError("No connections left")
+        client.send(message)
+
+    def call(self, method, *params, timeout=None):
+        client = self.pick()
+        if client is None:
+            raise ConnectionAbortedError("No connections left")
+        return client.call(method, *params, timeout=timeout)
+
+    # Like `call`, but waits for the result
+    def request(self, method, *params, timeout=None):
+        return self.call(method, *params, timeout=timeout).result(timeout)
+
+    def start(self):
+        for index, client in enumerate(self.clients):
+            self._attach(index, client)
+        # NOTE: Their health is left to the relayed events, which already saw
+        # the connections that came up
+        deadline = monotonic() + self.connect_timeout
+        for client in self.clients:
+            client.ready.wait(max(deadline - monotonic(), 0))
+        self._revivals = Every(self.retry, self._revive)
+        self._revivals.start()
+        self.ready.set()
+
+    def stop(self, done=None):
+        event = dict()
+        event["name"] = "closing"
+        event["data"] = dict()
+        event["data"]["when"] = utc_now_timestamp()
+        self._send_event(event)
+        self.stopped.set()
+        cast(self._revivals, "stop")
+        for client in self.clients:
+            client.stop()
+        cast(done, "set")
@@ -10,49 +10,167 @@ TODO:
 
 from abots.helpers import eprint, cast, sha256, utc_now_timestamp
 from abots.helpers import jsto, jots
+from abots.net.reactor import Reactor
+from abots.net.framing import FrameDecoder, FrameWriter, frame_message
+from abots.net.framing import frame_payload, read_payload, encode_json
+from abots.net.framing import kind_text, kind_json, kind_hello, kind_call
+from abots.net.framing import kind_reply, kind_ping, kind_pong
+from abots.net.framing import heartbeat_format, kind_stream_start
+from abots.net.framing import kind_stream_chunk, kind_stream_end
+from abots.net.framing import frame_stream, stream_header
+from abots.net.framing import kind_subscribe, kind_unsubscribe, kind_publish
+from abots.net.framing import flag_compressed, frame_topic, read_topic
+from abots.net.rpc import answer
+from abots.net.compression import Compressor, methods as compress_methods
+from abots.net.bounded_queue import BoundedQueue
+from abots.net.dispatcher import Dispatcher
+from abots.net.topics import TopicIndex
+from abots.net.streams import Streams
+from abots.net.metrics import Metrics
+from abots.events import Every
 
 from threading import Thread, Event, Lock
-from struct import pack, unpack
+from struct import pack, unpack, error as struct_error
+from zlib import error as zlib_error
 from select import select
-from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
-from time import time
+from selectors import EVENT_READ, EVENT_WRITE
+from functools import partial
+from socket import socket, AF_INET, AF_UNIX, SOCK_STREAM, SOL_SOCKET
+from socket import SO_REUSEADDR, SO_REUSEPORT, SHUT_RDWR
+from socket import timeout as sock_timeout
+from time import time, monotonic
+from collections import OrderedDict
+from itertools import count
+from os.path import basename
+from os import fstat
 from ssl import wrap_socket
-from queue import Queue, Empty
+from os import stat, unlink
+from stat import S_ISSOCK
+from queue import Queue, Empty, Full
 
 class SocketServer(Thread):
-    def __init__(self, host, port, listeners=5, buffer_size=4096, 
-        secure=False, timeout=None, daemon=False):
+    def __init__(self, host, port=None, listeners=5, buffer_size=4096, 
+        secure=False, timeout=None, daemon=False, reactor=False, loops=1,
+        flush_threshold=65536, flush_latency=0.01, slow_policy="buffer",
+        slow_limit=1048576, reuse_port=False, binary=False, compress=False,
+        compress_level=6, compress_threshold=1024, inbox_size=0, outbox_size=0,
+        events_size=0, overflow="block", marshal=None, heartbeat=None,
+        heartbeat_timeout=None, downloads=None, stream_size=16):
         super().__init__()
         self.setDaemon(daemon)
 
         # The connection information for server, the clients will use this to 
-        # connect to the server
+        # connect to the server. Without a port the host is instead the path 
+        # of a Unix domain socket, which skips the TCP stack entirely for
+        # servers and clients on the same machine.
         self.host = host
         self.port = port
+        self.family = AF_UNIX if port is None else AF_INET
 
         # The number of unaccepted connections that the system will allow 
         # before refusing new connections
         self.listeners = listeners
 
-        # Size of buffer pulled by `receive_bytes` when not specified
+        # Size of the buffer each client's `FrameDecoder` reads into
         self.buffer_size = buffer_size
 
         # Determines if SSL wrapper is used
         self.secure = secure
 
+        # Uses typed frames that carry bytes, text or JSON as they are, rather 
+        # than forcing every message through a string. See `frame_payload`.
+        self.binary = binary
+
+        # Compresses the frames of clients that ask for it when connecting 
+        # once they are at least `compress_threshold` bytes. See `Compressor`.
+        if compress and not binary:
+            raise ValueError("Compression needs binary mode")
+        self.compress = compress
+        self.compress_level = compress_level
+        self.compress_threshold = compress_threshold
+
+        # Handlers for the calls made by `SocketClient.call`, by method name
+        self.methods = dict()
+
+        # Handlers that messages are pushed to as soon as they are decoded, the 
+        # ones that are not inline run on `marshal`. See `Dispatcher`.
+        self.dispatcher = Dispatcher(marshal)
+
+        # The topics each client is subscribed to, published messages only go 
+        # to the clients subscribed to them. See `TopicIndex`.
+        self.topics = TopicIndex()
+
+        # Streams being received from the clients, with the ones of files 
+        # written straight into `downloads` if it is set. Reading from a client
+        # is paused while one of its streams has `stream_size` chunks that 
+        # have not been read yet, with 0 leaving them unbounded. See `Streams`.
+        self.streams = Streams(downloads, stream_size, self._release)
+        self._stream_ids = count(1)
+
+        # Pings every client each `heartbeat` seconds and disconnects the ones 
+        # that have sent nothing at all for `heartbeat_timeout` seconds
+        if heartbeat is not None and not binary:
+            raise ValueError("Heartbeats need binary mode")
+        self.heartbeat = heartbeat
+        self.heartbeat_timeout = heartbeat_timeout
+        if heartbeat is not None and heartbeat_timeout is None:
+            self.heartbeat_timeout = 3 * heartbeat
+        self._heartbeats = None
+
+        # When each client was last heard from, oldest first. As every client 
+        # has the same timeout this also keeps them in order of their deadline,
+        # so reaping only ever looks at the ones that have expired.
+        self._seen = OrderedDict()
+        self._seen_lock = Lock()
+
+        # Lets several servers bind the same host and port, with the kernel 
+        # spreading the connections between them. See `SocketSupervisor`.
+        self.reuse_port = reuse_port
+
         # Timeout set on queues
         self.timeout = timeout
 
-        self._inbox = Queue()
-        self._events = Queue()
-        self._outbox = Queue()
+        # Multiplexes every socket on `loops` selector threads instead of 
+        # running a thread for each client. See `_run_reactor`.
+        self.reactor = reactor
+        self.loops = max(1, loops)
+        self.reactors = list()
+        self._reactor_cursor = 0
+
+        # Outgoing frames are coalesced per client until either this many 
+        # bytes are pending, this many seconds have passed since the oldest 
+        # one was queued, or the inbox has run dry. See `FrameWriter`.
+        self.flush_threshold = flush_threshold
+        self.flush_latency = flush_latency
+        self._dirty = set()
+        self._dirty_lock = Lock()
+
+        # What `broadcast_message` does with a client that has more than 
+        # `slow_limit` bytes waiting to be written to it:
+        # * "buffer" - frames past the limit are dropped for that client
+        # * "drop" - its backlog is dropped to make room for the new frame
+        # * "disconnect" - the client is disconnected
+        self.slow_policy = slow_policy
+        self.slow_limit = slow_limit
+        self._backlog = set()
+
+        # Bounds on each of the queues, with 0 leaving them unbounded, and what
+        # is done once one is full. See `BoundedQueue`. Reading from clients is 
+        # paused while the outbox is full unless it is set to "drop-oldest".
+        self.overflow = overflow
+        self._inbox = BoundedQueue(inbox_size, overflow)
+        self._events = BoundedQueue(events_size, overflow)
+        self._outbox = BoundedQueue(outbox_size, overflow, self._release)
         self.queues = dict()
         self.queues["inbox"] = self._inbox
         self.queues["outbox"] = self._outbox
         self.queues["events"] = self._events
 
+        # Counters and histograms of the traffic, see `Metrics`
+        self.metrics = Metrics(self.queues)
+
         # Sets up the socket itself
-        self.sock = socket(AF_INET, SOCK_STREAM)
+        self.sock = socket(self.family, SOCK_STREAM)
         if self.secure:
             # Note: kwargs is used here to specify any SSL parameters desired
             self.sock = wrap_socket(self.sock, **kwargs)
@@ -67,12 +185,44 @@ class SocketServer(Thread):
         self.ready = Event()
         self.stopped = Event()
 
+        # Why the server could not start, if it could not
+        self.error = None
+
     def _send_event(self, message):
-        self._events.put(jots(message))
+        # NOTE: Never waits for room, it is called from the threads doing I/O
+        try:
+            self._events.put(jots(message), block=False)
+        # Nobody is keeping up with the events, so this one is dropped
+        except Full:
+            self._events.dropped = self._events.dropped + 1
+
+    # Hands a letter read from a client to the outbox, which the reader has
+    # already waited to have room for unless it drops the oldest letters
+    def _deliver(self, letter):
+        if self._outbox.overflow == "drop-oldest":
+            self._outbox.put(letter)
+        else:
+            self._outbox.force(letter)
+
+    # Called once the outbox (or one of their streams) has room for the 
+    # clients paused on it again
+    def _release(self, uuids):
+        for uuid in uuids:
+            client = self.uuids.get(uuid, None)
+            if client is None:
+                continue
+            client["paused"] = False
+            client["reactor"].call(self._reactor_arm, uuid)
 
     def _new_client(self, sock, address):
-        sock.settimeout(60)
-        client_host, client_port = address
+        if self.reactor:
+            sock.setblocking(False)
+        else:
+            sock.settimeout(60)
+        if self.family == AF_UNIX:
+            client_host, client_port = self.host, None
+        else:
+            client_host, client_port = address
         self.sockets.append(sock)
 
         client_kill = Event()
@@ -80,6 +230,16 @@ class SocketServer(Thread):
         self.uuids[client_uuid] = dict()
         self.uuids[client_uuid]["sock"] = sock
         self.uuids[client_uuid]["kill"] = client_kill
+        decoder = FrameDecoder(self.buffer_size, self.binary)
+        self.uuids[client_uuid]["decoder"] = decoder
+        writer_args = sock, self.flush_threshold, self.flush_latency
+        writer = FrameWriter(*writer_args)
+        writer.on_flush = self.metrics.flushed
+        self.uuids[client_uuid]["writer"] = writer
+        self.metrics.accepted(client_uuid)
+        self.uuids[client_uuid]["rtt"] = None
+        if self.heartbeat is not None:
+            self._touch(client_uuid)
 
         event = dict()
         event["name"] = "new_client"
@@ -89,6 +249,10 @@ class SocketServer(Thread):
         event["data"]["uuid"] = client_uuid
         self._send_event(event)
 
+        if self.reactor:
+            self._reactor_client(client_uuid, sock)
+            return
+
         client_args = sock, client_kill, client_uuid
         client_thread = Thread(target=self._client_thread, args=client_args)
         self.clients.append(client_thread)
@@ -97,6 +261,12 @@ class SocketServer(Thread):
     # Logic for the client socket running in its own thread
     def _client_thread(self, sock, kill_switch, uuid):
         while not kill_switch.is_set():
+            # Stops reading while the outbox is full, so TCP pushes back
+            if not self._outbox.wait_for_room(1):
+                continue
+            # Same for the streams the client is sending
+            if not self.streams.wait_for_room(uuid, 1):
+                continue
             try:
                 message = self.get_message(uuid)
             # The socket can either be broken or no longer open at all
@@ -107,25 +277,301 @@ class SocketServer(Thread):
                 continue
             # Send message and uuid of sender to outbox queue
             letter = uuid, message
-            self._outbox.put(letter)
+            self._deliver(letter)
+        if uuid in self.uuids:
+            self.close_sock(uuid)
+
+    # Hands the client over to one of the reactors, spread out round-robin
+    def _reactor_client(self, uuid, sock):
+        reactor = self.reactors[self._reactor_cursor]
+        self._reactor_cursor = (self._reactor_cursor + 1) % len(self.reactors)
+        client = self.uuids[uuid]
+        client["reactor"] = reactor
+        client["uuid"] = uuid
+        client["handler"] = partial(self._reactor_handler, uuid)
+        client["writing"] = False
+        client["paused"] = False
+        reactor.register(sock, EVENT_READ, client["handler"])
+
+    # Accepts every pending connection on the server socket
+    def _reactor_accept(self, sock, mask):
+        while not self.kill_switch.is_set():
+            try:
+                client_sock, client_address = sock.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            # The socket can either be broken or no longer open at all
+            except (BrokenPipeError, OSError) as e:
+                break
+            self._new_client(client_sock, client_address)
+
+    # Called by the client's reactor whenever its socket is ready
+    def _reactor_handler(self, uuid, sock, mask):
+        client = self.uuids.get(uuid, None)
+        if client is None:
+            return
+        if mask & EVENT_READ and not self._reactor_read(uuid, client):
+            return
+        if mask & EVENT_WRITE:
+            self._reactor_write(uuid, client)
+
+    def _reactor_read(self, uuid, client):
+        # Stops reading while the outbox is full, so TCP pushes back
+        client["paused"] = True
+        if self._outbox.hold(uuid) or self.streams.hold(uuid):
+            self._reactor_arm(uuid)
+            return True
+        client["paused"] = False
+        decoder = client["decoder"]
+        try:
+            decoder.recv_from(client["sock"])
+        except (BlockingIOError, InterruptedError):
+            return True
+        # The socket can either be broken or no longer open at all
+        except (BrokenPipeError, OSError) as e:
+            self.close_sock(uuid)
+            return False
+        while len(decoder.frames) > 0:
+            message = self._read_frame(uuid, client, decoder.frames.popleft())
+            # Closed over a frame it could not read
+            if uuid not in self.uuids:
+                return False
+            if message is None:
+                continue
+            # Send message and uuid of sender to outbox queue
+            letter = uuid, message
+            self._deliver(letter)
+        return True
+
+    def _reactor_write(self, uuid, client):
+        writer = client["writer"]
+        with writer.lock:
+            try:
+                flushed = writer.flush(False)
+            # The socket can either be broken or no longer open at all
+            except (BrokenPipeError, OSError) as e:
+                flushed = None
+            if not flushed:
+                if flushed is None:
+                    self.close_sock(uuid)
+                return
+            client["writing"] = False
+        self._reactor_arm(uuid)
+
+    # Has the reactor write out the client's frames once the socket is ready
+    def _reactor_send(self, client):
+        writer = client["writer"]
+        with writer.lock:
+            if client["writing"]:
+                return
+            client["writing"] = True
+        client["reactor"].call(self._reactor_arm, client["uuid"])
+
+    # Waits on the events the client currently needs, run inside of its loop
+    def _reactor_arm(self, uuid):
+        client = self.uuids.get(uuid, None)
+        if client is None:
+            return
+        events = 0
+        if not client["paused"]:
+            events = events | EVENT_READ
+        if client["writing"]:
+            events = events | EVENT_WRITE
+        client["reactor"].modify(client["sock"], events, client["handler"])
+
+    def _run_reactor(self):
+        self.reactors = [Reactor() for loop in range(self.loops)]
+        for reactor in self.reactors[1:]:
+            reactor.start()
+        server = self.reactors[0]
+        server.register(self.sock, EVENT_READ, self._reactor_accept)
+        self.ready.set()
+        server.run()
+
+    # Turns a frame into the message it carries, or handles it and returns 
+    # None if it is one the connections use to talk amongst themselves
+    def _read_frame(self, uuid, client, frame):
+        try:
+            return self._open_frame(uuid, client, frame)
+        # The compressed stream cannot be followed anymore, so neither can 
+        # anything else the client sends
+        except zlib_error:
+            self.metrics.malformed()
+            self.close_sock(uuid)
+        # Too short for what its kind holds, so it is dropped
+        except struct_error:
+            self.metrics.malformed()
+        return None
+
+    def _open_frame(self, uuid, client, frame):
+        flags, kind, body = frame
+        self.metrics.received(uuid, client["decoder"].header_size + len(body))
+        if self.heartbeat is not None:
+            self._touch(uuid)
+        if flags & flag_compressed:
+            compressor = client.get("compressor", None)
+            if compressor is None:
+                return None
+            body = compressor.decompress(body)
+        if kind == kind_hello:
+            self._hello(uuid, client, read_payload(kind_json, body))
+            return None
+        elif kind == kind_call:
+            request = read_payload(kind_json, body)
+            self._answer(uuid, client, request)
+            return None
+        elif kind == kind_ping:
+            self._send_frame(uuid, client, *frame_payload(body, kind=kind_pong))
+            return None
+        elif kind == kind_pong:
+            client["rtt"] = monotonic() - unpack(heartbeat_format, body)[0]
+            return None
+        elif kind == kind_subscribe:
+            self.topics.subscribe(uuid, read_payload(kind_text, body))
+            return None
+        elif kind == kind_unsubscribe:
+            self.topics.unsubscribe(uuid, read_payload(kind_text, body))
+            return None
+        elif kind == kind_publish:
+            # Passed along as it is, without decoding the message
+            topic = read_topic(body)[0]
+            header, body = frame_payload(body, kind=kind_publish)
+            self._multicast(self.topics.match(topic), header, body, uuid)
+            return None
+        elif kind == kind_stream_start:
+            message = self.streams.start(uuid, body)
+            if message is None:
+                return None
+        elif kind == kind_stream_chunk:
+            self.streams.chunk(uuid, body)
+            return None
+        elif kind == kind_stream_end:
+            download = self.streams.end(uuid, body)
+            if download is not None:
+                event = dict()
+                event["name"] = "file_received"
+                event["data"] = dict()
+                event["data"]["uuid"] = uuid
+                event["data"]["path"] = download.path
+                event["data"]["size"] = download.received
+                event["data"]["error"] = None
+                if download.error is not None:
+                    event["data"]["error"] = str(download.error)
+                self._send_event(event)
+            return None
+        else:
+            message = read_payload(kind, body)
+        if self.dispatcher.dispatch(uuid, message, kind):
+            return None
+        return message
+
+    # Runs the handler of the call right away and sends the result back
+    def _answer(self, uuid, client, request):
+        reply = answer(self.methods, request, uuid)
+        try:
+            frame = self._control(kind_reply, reply)
+        # The handler returned something that cannot be sent as JSON
+        except ValueError as e:
+            error = dict()
+            error["id"] = reply.get("id", None)
+            error["error"] = repr(e)
+            frame = self._control(kind_reply, error)
+        self._send_frame(uuid, client, *frame)
+
+    def _touch(self, uuid):
+        with self._seen_lock:
+            if uuid not in self.uuids:
+                return
+            self._seen[uuid] = monotonic()
+            self._seen.move_to_end(uuid)
+
+    # Disconnects the clients that have gone quiet for too long, and pings the
+    # rest with a frame that is shared between all of them
+    def _heartbeat(self, state):
+        now = monotonic()
+        expired = list()
+        with self._seen_lock:
+            while len(self._seen) > 0:
+                uuid, seen = next(iter(self._seen.items()))
+                if now - seen < self.heartbeat_timeout:
+                    break
+                self._seen.popitem(last=False)
+                expired.append(uuid)
+        for uuid in expired:
+            event = dict()
+            event["name"] = "client_timeout"
+            event["data"] = dict()
+            event["data"]["uuid"] = uuid
+            self._send_event(event)
+            self.close_sock(uuid)
+        header, body = frame_payload(pack(heartbeat_format, now), 
+            kind=kind_ping)
+        self._multicast(list(self.uuids), header, body)
+        return state
+
+    # Answers the hello a client sends when it connects
+    def _hello(self, uuid, client, hello):
+        offered = list()
+        if type(hello) == dict:
+            offered = hello.get("compress", list())
+        reply = dict()
+        reply["compress"] = None
+        method = [method for method in compress_methods if method in offered]
+        if not self.compress or len(method) == 0:
+            self._send_frame(uuid, client, *self._control(kind_hello, reply))
+            return
+        reply["compress"] = method[0]
+        compressor = Compressor(self.compress_level, self.compress_threshold)
+        writer = client["writer"]
+        with writer.lock:
+            client["compressor"] = compressor
+            # The reply has to go out before any compressed frames do
+            self._send_frame(uuid, client, *self._control(kind_hello, reply))
+            compressor.enabled = True
 
     def _queue_thread(self, inbox, timeout):
         while not self.kill_switch.is_set():
-            for letter in self._obtain(inbox, timeout):
+            # Sleeps until there is a letter, or only until the frames held 
+            # back are due to be written out if there are any
+            wait = timeout
+            if len(self._dirty) > 0 or len(self._backlog) > 0:
+                wait = self.flush_latency
+            for letter in self._obtain(inbox, wait, True):
+                # NOTE: Sentinel put in by `stop` to wake the thread up
+                if letter is None:
+                    continue
                 if len(letter) != 2:
                     continue
                 uuid, message = letter
-                if uuid == "cast":
-                    self.broadcast_message(uuid, message)
-                else:
-                    self.send_message(uuid, message)
-
-    def _obtain(self, queue, timeout=False):
+                try:
+                    if uuid == "cast":
+                        self.broadcast_message(uuid, message)
+                    else:
+                        self.send_message(uuid, message)
+                # The message could not be framed, see `frame_payload`
+                except ValueError as e:
+                    event = dict()
+                    event["name"] = "message_error"
+                    event["data"] = dict()
+                    event["data"]["uuid"] = uuid
+                    event["data"]["error"] = str(e)
+                    self._send_event(event)
+            # Anything still held back gets written out once the inbox is dry
+            self._flush_dirty()
+            self._flush_backlog()
+
+    # With `block` set, the first item is waited on for up to `timeout` (or for
+    # as long as it takes when that is None) and the rest are taken as they are
+    def _obtain(self, queue, timeout=False, block=False):
         if timeout is False:
             timeout = self.timeout
+        waiting = block
         while True:
             try:
-                if timeout is not None:
+                if waiting:
+                    waiting = False
+                    yield queue.get(timeout=timeout)
+                elif timeout is not None and not block:
                     yield queue.get(timeout=timeout)
                 else:
                     yield queue.get_nowait()
@@ -136,8 +582,14 @@ class SocketServer(Thread):
     # Prepares socket server before starting it
     def _prepare(self):
         self.sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        if self.reuse_port and self.family != AF_UNIX:
+            self.sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        address = (self.host, self.port)
+        if self.family == AF_UNIX:
+            address = self.host
+            self._unlink()
         try:
-            self.sock.bind((self.host, self.port))
+            self.sock.bind(address)
         # The socket can either be broken or no longer open at all
         except (BrokenPipeError, OSError) as e:
             # This usually means that the port is already in use
@@ -148,16 +600,98 @@ class SocketServer(Thread):
         self.sockets.append(self.sock)
         return None
 
+    # Removes the Unix domain socket left behind at the path, if any
+    def _unlink(self):
+        try:
+            if S_ISSOCK(stat(self.host).st_mode):
+                unlink(self.host)
+        except OSError:
+            pass
+
     def _sock_from_uuid(self, uuid):
         return self.uuids.get(uuid, dict()).get("sock", None)
 
+    # Splits the message into the header and body of its frame
+    def _frame(self, message, *args):
+        if self.binary:
+            return frame_payload(message, *args)
+        return frame_message(message, *args)
+
     def _package_message(self, message, *args):
-        if len(args) > 0:
-            formatted = message.format(*args)
-        else:
-            formatted = message
-        packaged = pack(">I", len(formatted)) + formatted.encode()
-        return packaged
+        return b"".join(self._frame(message, *args))
+
+    # Frames one of the JSON messages the connections use amongst themselves
+    def _control(self, kind, message):
+        return frame_payload(encode_json(message), kind=kind)
+
+    # Writes out every client with frames held back by their `FrameWriter`
+    def _flush_dirty(self):
+        with self._dirty_lock:
+            dirty = list(self._dirty)
+            self._dirty.clear()
+        for uuid in dirty:
+            self._flush(uuid)
+
+    # Writes out what the slow clients will take without blocking
+    def _flush_backlog(self):
+        with self._dirty_lock:
+            backlog = list(self._backlog)
+            self._backlog.clear()
+        for uuid in backlog:
+            writer = self.uuids.get(uuid, dict()).get("writer", None)
+            if writer is None:
+                continue
+            try:
+                flushed = writer.flush(False)
+            # The socket can either be broken or no longer open at all
+            except (BrokenPipeError, OSError) as e:
+                writer.clear()
+                continue
+            if not flushed:
+                with self._dirty_lock:
+                    self._backlog.add(uuid)
+
+    # Queues a frame shared with other clients, unless the client is too slow
+    def _fan_out(self, uuid, header, body):
+        client = self.uuids.get(uuid, None)
+        if client is None:
+            return False
+        writer = client["writer"]
+        size = len(header) + len(body)
+        if writer.pending + size > self.slow_limit:
+            if self.slow_policy == "disconnect":
+                self.close_sock(uuid)
+                return False
+            elif self.slow_policy == "drop":
+                dropped = writer.drop_pending()
+                client["dropped"] = client.get("dropped", 0) + dropped
+            if writer.pending + size > self.slow_limit:
+                client["dropped"] = client.get("dropped", 0) + 1
+                return False
+        # NOTE: Shared frames are never compressed, so dropping them later 
+        # leaves the compressed stream of the client intact
+        writer.queue(header, body, droppable=True)
+        self.metrics.sent(uuid, size)
+        if "reactor" in client:
+            self._reactor_send(client)
+        return True
+
+    def _flush(self, uuid):
+        writer = self.uuids.get(uuid, dict()).get("writer", None)
+        if writer is None:
+            return
+        try:
+            # NOTE: Held back while `send_file` writes to the client
+            if not writer.flush():
+                with self._dirty_lock:
+                    self._dirty.add(uuid)
+        # The peer is too slow to keep up, try again on the next flush
+        except sock_timeout:
+            with self._dirty_lock:
+                self._dirty.add(uuid)
+        # The socket can either be broken or no longer open at all
+        except (BrokenPipeError, OSError) as e:
+            writer.clear()
 
     # Closes a connected socket and removes it from the sockets list
     def close_sock(self, uuid):
@@ -166,73 +700,233 @@ class SocketServer(Thread):
         event["data"] = dict()
         event["data"]["uuid"] = uuid
         self._send_event(event)
-        if uuid in list(self.uuids):
-            sock = self.uuids[uuid]["sock"]
-            kill = self.uuids[uuid]["kill"]
+        client = self.uuids.pop(uuid, None)
+        self.topics.remove(uuid)
+        self.streams.abort(uuid)
+        with self._seen_lock:
+            self._seen.pop(uuid, None)
+        if client is not None:
+            self.metrics.disconnected(uuid)
+            sock = client["sock"]
+            kill = client["kill"]
             kill.set()
-            del self.uuids[uuid]
-            self.sockets.remove(sock)
-            sock.close()
+            if sock in self.sockets:
+                self.sockets.remove(sock)
+            reactor = client.get("reactor", None)
+            if reactor is not None:
+                # Must leave the selector before the socket can be closed
+                reactor.unregister(sock, close=True)
+            else:
+                # Wakes up the client's thread if it is blocked reading
+                try:
+                    sock.shutdown(SHUT_RDWR)
+                except OSError:
+                    pass
+                sock.close()
 
     # Receives specified number of bytes from a socket
     # sock - one of the sockets in sockets
     # get_bytes - number of bytes to receive from socket
     # decode - flag if the returned data is binary-to-string decoded
     def receive_bytes(self, sock, get_bytes, decode=True):
-        data = "".encode()
-        attempts = 0
-        while len(data) < get_bytes:
-            # Automatically break loop to prevent infinite loop
-            # Allow at least twice the needed iterations to occur exiting loop
-            if attempts > 2 * (get_bytes / self.buffer_size):
-                break
-            else:
-                attempts = attempts + 1
-            bufsize = get_bytes - len(data)
-
-            # Force bufsize to cap out at buffer_size
-            if bufsize > self.buffer_size:
-                bufsize = self.buffer_size
+        data = bytearray(get_bytes)
+        view = memoryview(data)
+        received = 0
+        while received < get_bytes:
             try:
-                packet = sock.recv(bufsize)
+                packet_size = sock.recv_into(view[received:])
             # The socket can either be broken or no longer open at all
             except (BrokenPipeError, OSError) as e:
                 return None
-            data = data + packet
-        return data.decode() if decode else data
+            if packet_size == 0:
+                return None
+            received = received + packet_size
+        return data.decode() if decode else bytes(data)
 
-    # Get message from socket
+    # Get message from socket, reading more from it if none are pending
     def get_message(self, uuid):
-        sock = self._sock_from_uuid(uuid)
-        if sock is None:
+        client = self.uuids.get(uuid, None)
+        if client is None:
             return None
-        raw_message_size = self.receive_bytes(sock, 4, False)
-        if raw_message_size is None or len(raw_message_size) != 4:
+        decoder = client["decoder"]
+        if len(decoder.frames) == 0:
+            try:
+                decoder.recv_from(client["sock"])
+            except sock_timeout:
+                return None
+        frame = decoder.pop()
+        if frame is None:
             return None
-        message_size = unpack(">I", raw_message_size)[0]
-        return self.receive_bytes(sock, message_size)
+        return self._read_frame(uuid, client, frame)
+
+    # Holds a producer back until the client has taken most of what it queued
+    def _wait_for_room(self, uuid, client):
+        writer = client["writer"]
+        if "reactor" not in client:
+            if writer.pending >= self.flush_threshold:
+                self._flush(uuid)
+            return
+        # The loop that would write it out is the one waiting
+        if client["reactor"].in_loop():
+            return
+        while uuid in self.uuids:
+            if writer.wait_for_room(self.flush_threshold, 1):
+                break
 
-    # Packages a message and sends it to socket
+    # Sends the chunks as a single message that the client receives as a
+    # `Stream`, so that it never has to be held in memory all at once
+    def send_stream(self, uuid, chunks, meta=None):
+        if not self.binary:
+            raise ValueError("Streams need binary mode")
+        client = self.uuids.get(uuid, None)
+        if client is None:
+            return False
+        stream_id = next(self._stream_ids)
+        meta = dict() if meta is None else meta
+        start = frame_stream(kind_stream_start, stream_id, jots(meta).encode())
+        self._send_frame(uuid, client, *start)
+        for chunk in chunks:
+            chunk_frame = frame_stream(kind_stream_chunk, stream_id, chunk)
+            self._send_frame(uuid, client, *chunk_frame)
+            self._wait_for_room(uuid, client)
+            if uuid not in self.uuids:
+                return False
+        self._send_frame(uuid, client, *frame_stream(kind_stream_end, 
+            stream_id))
+        return True
+
+    # Sends the file as a stream, using `sendfile` so that it goes from the 
+    # disk to the socket without being copied through userspace
+    def send_file(self, uuid, path, name=None, chunk_size=1048576):
+        if not self.binary:
+            raise ValueError("Streams need binary mode")
+        client = self.uuids.get(uuid, None)
+        if client is None:
+            return False
+        with open(path, "rb") as file:
+            size = fstat(file.fileno()).st_size
+            meta = dict()
+            meta["name"] = basename(path) if name is None else name
+            meta["size"] = size
+            meta["file"] = True
+            # Non-blocking and SSL sockets cannot use `sendfile`
+            if "reactor" in client or self.secure:
+                chunks = iter(partial(file.read, chunk_size), b"")
+                return self.send_stream(uuid, chunks, meta)
+            stream_id = next(self._stream_ids)
+            meta = jots(meta).encode()
+            start = frame_stream(kind_stream_start, stream_id, meta)
+            self._send_frame(uuid, client, *start)
+            writer = client["writer"]
+            offset = 0
+            while offset < size:
+                length = min(chunk_size, size - offset)
+                header = stream_header(kind_stream_chunk, stream_id, length)
+                try:
+                    writer.sendfile(header, file, offset, length)
+                    self.metrics.sent(uuid, len(header) + length)
+                # The socket can either be broken or no longer open at all
+                except (BrokenPipeError, OSError, EOFError) as e:
+                    self.close_sock(uuid)
+                    return False
+                offset = offset + length
+        self._send_frame(uuid, client, *frame_stream(kind_stream_end, 
+            stream_id))
+        return True
+
+    # Packages a message and queues it to be sent to the socket
     def send_message(self, uuid, message, *args):
-        sock = self._sock_from_uuid(uuid)
-        if sock is None:
+        client = self.uuids.get(uuid, None)
+        if client is None:
             return None
-        formatted = self._package_message(message)
-        try:
-            sock.send(formatted)
-        # The socket can either be broken or no longer open at all
-        except (BrokenPipeError, OSError) as e:
+        self._send_frame(uuid, client, *self._frame(message, *args))
+
+    def _send_frame(self, uuid, client, header, body):
+        writer = client["writer"]
+        compressor = client.get("compressor", None)
+        with writer.lock:
+            if compressor is not None:
+                header, body = compressor.compress_frame(header, body)
+            writer.queue(header, body)
+        self.metrics.sent(uuid, len(header) + len(body))
+        if "reactor" in client:
+            self._reactor_send(client)
+            return
+        # NOTE: Only ever writes to this client, the rest of the dirty ones 
+        # are left to the queue thread so that this thread (which could be 
+        # another client's) is never held up by a slow peer
+        if self._inbox.empty() or writer.should_flush():
+            with self._dirty_lock:
+                self._dirty.discard(uuid)
+            self._flush(uuid)
             return
+        with self._dirty_lock:
+            self._dirty.add(uuid)
 
     # Like send_message, but sends to all sockets but the server and the sender
+    # The frame is only packaged once and shared between all of the clients
     def broadcast_message(self, client_uuid, message, *args):
-        for uuid in list(self.uuids):
-            if uuid != client_uuid:
-                self.send_message(uuid, message, *args)
+        header, body = self._frame(message, *args)
+        self._multicast(list(self.uuids), header, body, client_uuid)
+
+    # Queues a frame shared between the clients, leaving out the sender
+    def _multicast(self, uuids, header, body, sender=None):
+        queued = list()
+        for uuid in uuids:
+            if uuid != sender and self._fan_out(uuid, header, body):
+                queued.append(uuid)
+        if self.reactor:
+            return
+        # A stalled client must not hold up the rest, so never block here
+        with self._dirty_lock:
+            self._backlog.update(queued)
+        self._flush_backlog()
+
+    # Sends the message to the clients subscribed to a matching topic
+    def publish(self, topic, message, *args):
+        if not self.binary:
+            raise ValueError("Topics need binary mode")
+        header, body = frame_topic(topic, message, *args)
+        self._multicast(self.topics.match(topic), header, body)
+
+    # Subscribes the client to the topic pattern, as if it had asked to
+    def subscribe(self, uuid, pattern):
+        if uuid in self.uuids:
+            self.topics.subscribe(uuid, pattern)
+
+    def unsubscribe(self, uuid, pattern):
+        self.topics.unsubscribe(uuid, pattern)
 
     def recv(self):
         return [letter for letter in self._obtain(self._outbox)]
 
+    # Registers the handler that calls to the method are answered with, it is 
+    # called with the uuid of the caller followed by the params of the call
+    def register(self, method, handler):
+        self.methods[method] = handler
+
+    def unregister(self, method):
+        self.methods.pop(method, None)
+
+    # Has the handler called with `(uuid, message)` for every message of the 
+    # kind, or every message at all, instead of them going to the outbox
+    def add_handler(self, handler, kind=None, inline=True, batch=None, 
+        window=None):
+        self.dispatcher.add_handler(handler, kind, inline, batch, window)
+
+    def remove_handler(self, handler):
+        self.dispatcher.remove_handler(handler)
+
+    # Round trip time of the last heartbeat to the client, in seconds
+    def rtt(self, uuid):
+        return self.uuids.get(uuid, dict()).get("rtt", None)
+
+    def compression_stats(self, uuid):
+        compressor = self.uuids.get(uuid, dict()).get("compressor", None)
+        if compressor is None:
+            return None
+        return compressor.stats()
+
     def send(self, uuid, message):
         letter = uuid, message
         self._inbox.put(letter)
@@ -242,9 +936,19 @@ class SocketServer(Thread):
         err = self._prepare()
         if err is not None:
             eprint(err)
+            # NOTE: Left for whoever started it, as `ready` will never be set
+            self.error = err
             return err
         queue_args = self._inbox, self.timeout
         Thread(target=self._queue_thread, args=queue_args).start()
+        if self.heartbeat is not None:
+            self._heartbeats = Every(self.heartbeat, self._heartbeat)
+            self._heartbeats.start()
+        if self.reactor:
+            return self._run_reactor()
+        # Sleeps in `accept` rather than polling it, waking up to check the 
+        # kill switch every so often
+        self.sock.settimeout(1)
         # print("Server ready!")
         self.ready.set()
         while not self.kill_switch.is_set():
@@ -267,9 +971,18 @@ class SocketServer(Thread):
         for uuid in list(self.uuids):
             self.close_sock(uuid)
         self.kill_switch.set()
+        self._inbox.force(None)
+        self.dispatcher.stop()
+        cast(self._heartbeats, "stop")
+        for reactor in self.reactors:
+            reactor.stop()
         self.sock.close()
+        if self.family == AF_UNIX:
+            self._unlink()
         if join:
             for client in self.clients:
                 client.join(self.timeout)
+            for reactor in self.reactors:
+                reactor.stopped.wait(self.timeout)
         self.stopped.set()
         cast(done, "set")
\ No newline at end of file
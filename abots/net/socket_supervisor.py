@@ -0,0 +1,226 @@
+"""
+
+net/SocketSupervisor
+====================
+
+Runs a `SocketServer` in each of `workers` forked processes, all bound to the
+same host and port with `SO_REUSEPORT` so the kernel spreads the connections
+between them and the server is no longer held to a single core by the GIL.
+
+The supervisor has the same `send`/`recv`/`queues` interface as `SocketServer`.
+The letters and events of every worker are relayed back to it over a local
+queue, it keeps track of which worker each uuid is connected to so that
+messages are routed to the right one, and broadcasts are sent by every worker.
+
+"""
+
+from abots.helpers import cast, jsto, jots, utc_now_timestamp
+from abots.net.socket_server import SocketServer
+
+from threading import Thread, Event
+from multiprocessing import get_context, cpu_count
+from queue import Queue, Empty
+
+# Moves everything from one of the server's queues up to the supervisor
+def _relay(index, kind, queue, up):
+    while True:
+        item = queue.get()
+        up.put((index, kind, item))
+        queue.task_done()
+
+# Runs inside of each of the worker processes
+def _shard(index, host, port, kwargs, up, down):
+    try:
+        server = SocketServer(host, port, reuse_port=True, **kwargs)
+    # Such as settings that do not go together
+    except Exception as e:
+        up.put((index, "error", repr(e)))
+        return
+    server.start()
+    # The server gives up without ever being ready when it cannot bind
+    while not server.ready.wait(0.1):
+        if not server.is_alive():
+            up.put((index, "error", str(server.error)))
+            return
+    for kind, queue in [("outbox", server._outbox), ("event", server._events)]:
+        relay_args = index, kind, queue, up
+        relay = Thread(target=_relay, args=relay_args)
+        relay.setDaemon(True)
+        relay.start()
+    up.put((index, "ready", None))
+    while True:
+        letter = down.get()
+        # NOTE: Poison pill to stop the worker
+        if letter is None:
+            break
+        server.send(*letter)
+    server.stop()
+
+class SocketSupervisor(Thread):
+    def __init__(self, host, port, workers=None, timeout=None, daemon=False,
+        **kwargs):
+        super().__init__()
+        self.setDaemon(daemon)
+
+        self.host = host
+        self.port = port
+        self.workers = cpu_count() if workers is None else workers
+        self.timeout = timeout
+
+        # Passed along to the `SocketServer` in each worker
+        kwargs["timeout"] = timeout
+        self.kwargs = kwargs
+
+        self._inbox = Queue()
+        self._events = Queue()
+        self._outbox = Queue()
+        self.queues = dict()
+        self.queues["inbox"] = self._inbox
+        self.queues["outbox"] = self._outbox
+        self.queues["events"] = self._events
+
+        # Maps the uuid of each client to the index of the worker it is on
+        self.uuids = dict()
+
+        context = get_context("fork")
+        self._up = context.Queue()
+        self._downs = [context.Queue() for worker in range(self.workers)]
+        self._context = context
+        self.processes = list()
+
+        self.kill_switch = Event()
+        self.ready = Event()
+        self.stopped = Event()
+
+        # Why the workers could not start, if they could not
+        self.error = None
+        self._settled = Event()
+
+    def _send_event(self, message):
+        self._events.put(jots(message))
+
+    # With `block` set, the first item is waited on for up to `timeout` (or for
+    # as long as it takes when that is None) and the rest are taken as they are
+    def _obtain(self, queue, timeout=False, block=False):
+        if timeout is False:
+            timeout = self.timeout
+        waiting = block
+        while True:
+            try:
+                if waiting:
+                    waiting = False
+                    yield queue.get(timeout=timeout)
+                elif timeout is not None and not block:
+                    yield queue.get(timeout=timeout)
+                else:
+                    yield queue.get_nowait()
+                queue.task_done()
+            except Empty:
+                break
+
+    def _queue_thread(self, inbox, timeout):
+        while not self.kill_switch.is_set():
+            for letter in self._obtain(inbox, timeout, True):
+                # NOTE: Sentinel put in by `stop` to wake the thread up
+                if letter is None:
+                    continue
+                if len(letter) != 2:
+                    continue
+                uuid, message = letter
+                if uuid == "cast":
+                    for down in self._downs:
+                        down.put(letter)
+                    continue
+                index = self.uuids.get(uuid, None)
+                if index is not None:
+                    self._downs[index].put(letter)
+
+    # Keeps track of where the clients are before passing the event on
+    def _worker_event(self, index, raw_event):
+        event = jsto(raw_event)
+        if type(event) != dict:
+            return
+        name = event.get("name", None)
+        data = event.get("data", dict())
+        if name == "new_client":
+            self.uuids[data["uuid"]] = index
+        elif name == "close_client":
+            self.uuids.pop(data["uuid"], None)
+        data["worker"] = index
+        self._send_event(event)
+
+    def recv(self):
+        return [letter for letter in self._obtain(self._outbox)]
+
+    def send(self, uuid, message):
+        letter = uuid, message
+        self._inbox.put(letter)
+
+    def run(self):
+        for index in range(self.workers):
+            worker_args = (index, self.host, self.port, self.kwargs, self._up,
+                self._downs[index])
+            process = self._context.Process(target=_shard, args=worker_args)
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+        waiting = self.workers
+        while waiting > 0:
+            try:
+                index, kind, item = self._up.get(timeout=1)
+            except Empty:
+                # A worker that died without saying why never will
+                dead = [index for index, process in enumerate(self.processes)
+                    if not process.is_alive()]
+                if len(dead) == 0:
+                    continue
+                index, kind = dead[0], "error"
+                item = f"exited with {self.processes[index].exitcode}"
+            if kind == "ready":
+                waiting = waiting - 1
+            elif kind == "event":
+                self._worker_event(index, item)
+            elif kind == "error":
+                self.error = OSError(f"Worker {index} failed to start: {item}")
+                self.stop()
+                self._settled.set()
+                return
+        queue_args = self._inbox, self.timeout
+        Thread(target=self._queue_thread, args=queue_args).start()
+        self.ready.set()
+        self._settled.set()
+        while not self.kill_switch.is_set():
+            try:
+                index, kind, item = self._up.get(timeout=1)
+            except Empty:
+                continue
+            # The queue can be closed out from under it by `stop`
+            except (EOFError, OSError) as e:
+                break
+            if kind == "outbox":
+                self._outbox.put(tuple(item))
+            elif kind == "event":
+                self._worker_event(index, item)
+
+    # Waits for every worker to be ready, raising the error if one is not
+    def start(self):
+        super().start()
+        self._settled.wait()
+        if self.error is not None:
+            raise self.error
+
+    def stop(self, done=None, join=False):
+        event = dict()
+        event["name"] = "closing"
+        event["data"] = dict()
+        event["data"]["when"] = utc_now_timestamp()
+        self._send_event(event)
+        self.kill_switch.set()
+        self._inbox.put(None)
+        for down in self._downs:
+            down.put(None)
+        if join:
+            for process in self.processes:
+                process.join(self.timeout)
+        self.stopped.set()
+        cast(done, "set")
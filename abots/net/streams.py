@@ -0,0 +1,204 @@
+"""
+
+net/Streams
+===========
+
+The receiving end of the chunked streams of binary mode, which carry a single
+message as any number of frames so that it never has to fit in memory, or in
+the 4 GiB a single frame is limited to.
+
+A stream is handed over as a `Stream` as soon as its first frame comes in, and
+is read by iterating over it, which yields each chunk as it arrives. Streams of
+files are instead written straight to disk as their chunks come in when there
+is a `downloads` directory to write them to.
+
+Each `Stream` holds at most `stream_size` chunks that have not been read yet.
+Much like with the outbox of `BoundedQueue`, the chunks that come in are never
+dropped, instead whoever reads from the connection stops while one of its
+streams is full, either by waiting for room or by holding their key until the
+stream has been read halfway, so that TCP flow control pushes back on the
+sender.
+
+"""
+
+from abots.helpers import jsto
+from abots.net.framing import read_stream
+from abots.net.bounded_queue import BoundedQueue
+
+from os import fdopen, link, unlink
+from os.path import join, basename, splitext
+from tempfile import mkstemp
+from itertools import count
+from threading import Event
+
+class Stream:
+    def __init__(self, stream_id, meta, size=0, on_release=None):
+        self.id = stream_id
+
+        # Whatever the sender described the stream with, such as its name
+        self.meta = meta
+
+        self.received = 0
+        self.error = None
+        self.done = Event()
+        self._chunks = BoundedQueue(size, "block", on_release)
+
+    def __iter__(self):
+        while True:
+            chunk = self._chunks.get()
+            # NOTE: Sentinel put in by `close`
+            if chunk is None:
+                break
+            yield chunk
+        if self.error is not None:
+            raise self.error
+
+    # Waits for the whole stream and joins it back together
+    def read(self):
+        return b"".join(self)
+
+    # NOTE: Never waits, the reader already did before reading the chunk
+    def write(self, data):
+        self.received = self.received + len(data)
+        self._chunks.force(bytes(data))
+
+    def close(self, error=None):
+        self.error = error
+        self._chunks.force(None)
+        self.done.set()
+
+# Written to a hidden temporary file next to where it ends up, which is only
+# moved into place once the whole file came in, and removed otherwise. Files
+# already there are never overwritten, the name gets a number added instead.
+class Download:
+    def __init__(self, stream_id, meta, directory):
+        self.id = stream_id
+        self.meta = meta
+        # Only the name is used, so the sender cannot write outside of it
+        name = basename(str(meta.get("name", "")))
+        if name in ["", ".", ".."]:
+            name = str(stream_id)
+        self.directory = directory
+        self.name = name
+        self.path = join(directory, name)
+        self.received = 0
+        self.error = None
+        fd, self._temp = mkstemp(".part", f".{name}.", directory)
+        self._file = fdopen(fd, "wb")
+
+    def write(self, data):
+        if self.error is not None:
+            return
+        self.received = self.received + len(data)
+        try:
+            self._file.write(data)
+        # Such as the disk being full, the rest of the stream is ignored
+        except OSError as e:
+            self.close(e)
+
+    def close(self, error=None):
+        if self._file.closed:
+            return
+        self.error = error
+        try:
+            self._file.close()
+            if self.error is None:
+                self._place()
+        except OSError as e:
+            self.error = e
+        if self.error is not None:
+            try:
+                unlink(self._temp)
+            except FileNotFoundError:
+                pass
+
+    # Moves the file into place under the first of its names that is free
+    def _place(self):
+        stem, extension = splitext(self.name)
+        for copy in count():
+            name = self.name if copy == 0 else f"{stem}.{copy}{extension}"
+            path = join(self.directory, name)
+            try:
+                # NOTE: Unlike a rename, it fails if the path is taken
+                link(self._temp, path)
+            except FileExistsError:
+                continue
+            unlink(self._temp)
+            self.path = path
+            return
+
+class Streams:
+    def __init__(self, downloads=None, size=0, on_release=None):
+        # Directory that the streams of files are written to, if any
+        self.downloads = downloads
+
+        # Most chunks each stream holds before reading is paused, and what is
+        # called with the keys held by `hold` once they can read again
+        self.size = size
+        self.on_release = on_release
+
+        # Maps each `(key, stream id)` to the stream it is receiving into
+        self._open = dict()
+
+    # Starts the stream, returning it unless it is a file being written to disk
+    def start(self, key, body):
+        stream_id, data = read_stream(body)
+        meta = jsto(bytes(data))
+        if type(meta) != dict:
+            meta = dict()
+        if meta.get("file", False) and self.downloads is not None:
+            try:
+                self._open[key, stream_id] = Download(stream_id, meta,
+                    self.downloads)
+                return None
+            # There is nowhere to write it, so it is handed over instead
+            except OSError:
+                pass
+        stream = Stream(stream_id, meta, self.size, self.on_release)
+        self._open[key, stream_id] = stream
+        return stream
+
+    def _receiving(self, key):
+        return [stream for open_key, stream in list(self._open.items())
+            if open_key[0] == key and isinstance(stream, Stream)]
+
+    # Waits until every stream coming from the key has room for another chunk,
+    # returning False if one still has none
+    def wait_for_room(self, key, timeout=None):
+        for stream in self._receiving(key):
+            if not stream._chunks.wait_for_room(timeout):
+                return False
+        return True
+
+    # Holds onto the key if one of its streams is full, to be passed to 
+    # `on_release`
+    def hold(self, key):
+        for stream in self._receiving(key):
+            if stream._chunks.hold(key):
+                return True
+        return False
+
+    def chunk(self, key, body):
+        stream_id, data = read_stream(body)
+        stream = self._open.get((key, stream_id), None)
+        if stream is not None:
+            stream.write(data)
+
+    # Ends the stream, returning it if it was a file written to disk, or one 
+    # that failed to be, in which case it has the error
+    def end(self, key, body):
+        stream_id, data = read_stream(body)
+        stream = self._open.pop((key, stream_id), None)
+        if stream is None:
+            return None
+        stream.close()
+        return stream if isinstance(stream, Download) else None
+
+    # Cuts off every stream coming from the key, used once it disconnects
+    def abort(self, key):
+        for open_key in list(self._open):
+            if open_key[0] != key:
+                continue
+            stream = self._open.pop(open_key, None)
+            if stream is not None:
+                stream.close(ConnectionResetError("Stream cut off"))
@@ -0,0 +1,113 @@
+"""
+
+net/Topics
+==========
+
+The subscription index `SocketServer` uses to find the clients a published
+message should go to. Topics are split into segments on ".", and the patterns
+clients subscribe with are kept in a trie of those segments, where:
+
+* "*" matches exactly one segment, so "chat.*" matches "chat.lobby"
+* "#" as the last segment matches any number of them, so "chat.#" matches
+  "chat", "chat.lobby" and "chat.lobby.mods"
+
+Finding the subscribers of a topic walks one path of the trie per segment
+(plus the wildcard branches along it), so it costs the same no matter how many
+clients are connected or subscribed to other topics.
+
+"""
+
+from threading import Lock
+
+class TopicIndex:
+    def __init__(self):
+        self._root = self._node()
+        self._lock = Lock()
+
+        # Maps each uuid to the patterns it is subscribed to
+        self.patterns = dict()
+
+    def _node(self):
+        node = dict()
+        node["children"] = dict()
+        # Subscribed to the pattern ending at this node
+        node["uuids"] = set()
+        # Subscribed to the pattern ending at this node followed by "#"
+        node["rest"] = set()
+        return node
+
+    def subscribe(self, uuid, pattern):
+        segments = pattern.split(".")
+        with self._lock:
+            node = self._root
+            for segment in segments[:-1]:
+                node = node["children"].setdefault(segment, self._node())
+            if segments[-1] == "#":
+                node["rest"].add(uuid)
+            else:
+                node = node["children"].setdefault(segments[-1], self._node())
+                node["uuids"].add(uuid)
+            self.patterns.setdefault(uuid, set()).add(pattern)
+
+    def _unsubscribe(self, uuid, pattern):
+        segments = pattern.split(".")
+        path = list()
+        node = self._root
+        for segment in segments[:-1]:
+            path.append((node, segment))
+            node = node["children"].get(segment, None)
+            if node is None:
+                return
+        if segments[-1] == "#":
+            node["rest"].discard(uuid)
+        else:
+            path.append((node, segments[-1]))
+            node = node["children"].get(segments[-1], None)
+            if node is None:
+                return
+            node["uuids"].discard(uuid)
+        # Prunes the nodes that no longer lead to any subscribers
+        for parent, segment in reversed(path):
+            child = parent["children"][segment]
+            if child["children"] or child["uuids"] or child["rest"]:
+                break
+            parent["children"].pop(segment)
+
+    def unsubscribe(self, uuid, pattern):
+        with self._lock:
+            patterns = self.patterns.get(uuid, set())
+            if pattern not in patterns:
+                return
+            patterns.discard(pattern)
+            if len(patterns) == 0:
+                self.patterns.pop(uuid)
+            self._unsubscribe(uuid, pattern)
+
+    # Drops every subscription of the uuid, used once it disconnects
+    def remove(self, uuid):
+        with self._lock:
+            for pattern in self.patterns.pop(uuid, set()):
+                self._unsubscribe(uuid, pattern)
+
+    # Returns the uuids subscribed to a pattern matching the topic
+    def match(self, topic):
+        segments = topic.split(".")
+        matched = set()
+        with self._lock:
+            nodes = [self._root]
+            for segment in segments:
+                following = list()
+                for node in nodes:
+                    matched.update(node["rest"])
+                    children = node["children"]
+                    for key in (segment, "*"):
+                        child = children.get(key, None)
+                        if child is not None:
+                            following.append(child)
+                nodes = following
+                if len(nodes) == 0:
+                    break
+            for node in nodes:
+                matched.update(node["uuids"])
+                matched.update(node["rest"])
+        return matched
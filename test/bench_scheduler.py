@@ -0,0 +1,66 @@
+#!env/bin/python3
+
+import sys
+from os.path import dirname, realpath
+
+source = "/".join(dirname(realpath(__file__)).split("/")[:-1])
+sys.path.insert(0, source)
+
+from abots.events import ThreadMarshal
+
+from random import Random
+from threading import Lock
+from time import perf_counter, sleep
+
+workers = 4
+tasks = 2000
+# Seconds between tasks being handed out, about half of what the workers take
+interval = 0.002
+short_task = 0.001
+long_task = 0.05
+long_share = 0.05
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def bench(scheduler):
+    marshal = ThreadMarshal(workers, monitor=0, scheduler=scheduler)
+    # Same mix of tasks for every scheduler
+    random = Random(0)
+    latencies = list()
+    lock = Lock()
+    def task(queued, duration, short):
+        sleep(duration)
+        if short:
+            with lock:
+                latencies.append(perf_counter() - queued)
+    dones = list()
+    scheduled = perf_counter()
+    for t in range(tasks):
+        delay = scheduled - perf_counter()
+        if delay > 0:
+            sleep(delay)
+        scheduled = scheduled + interval
+        short = random.random() >= long_share
+        duration = short_task if short else long_task
+        # Not reserving a worker, so tasks can queue up behind each other
+        args = perf_counter(), duration, short
+        if scheduler == "priority":
+            # Short tasks go ahead of the long ones waiting
+            priority = 0 if short else 1
+            dones.append(marshal.reserve(task, args, reserve=False,
+                priority=priority))
+        else:
+            dones.append(marshal.reserve(task, args, reserve=False))
+    for done in dones:
+        done.wait()
+    pools = len(marshal.pools)
+    marshal.stop()
+    latencies.sort()
+    timings = [percentile(latencies, fraction) * 1000
+        for fraction in [0.5, 0.99, 0.999]]
+    print(f"{scheduler:>10}: p50 {timings[0]:7.2f}ms  p99 {timings[1]:7.2f}ms  "
+        f"p999 {timings[2]:7.2f}ms  pools {pools}")
+
+for scheduler in ["dedicated", "shared", "stealing", "priority"]:
+    bench(scheduler)
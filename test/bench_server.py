@@ -0,0 +1,193 @@
+#!env/bin/python3
+
+import sys
+from os.path import dirname, realpath
+
+source = "/".join(dirname(realpath(__file__)).split("/")[:-1])
+sys.path.insert(0, source)
+
+from abots.net import SocketServer, SocketClient
+from abots.helpers import jots, jsto
+
+from argparse import ArgumentParser
+from multiprocessing import get_context
+from resource import getrusage, RUSAGE_SELF
+from struct import pack, unpack_from
+from threading import Thread, Lock, Event
+from time import perf_counter, sleep
+
+host = "127.0.0.1"
+port = 10703
+
+# Metrics where a higher number is better, the rest are better lower
+higher_better = ["throughput", "bandwidth"]
+
+def parse_args():
+    parser = ArgumentParser(description="Load tests SocketServer on localhost")
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--size", type=int, default=256,
+        help="Bytes in each message")
+    parser.add_argument("--rate", type=float, default=0,
+        help="Messages a second from each client, 0 to send flat out")
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--reactor", action="store_true")
+    parser.add_argument("--loops", type=int, default=1)
+    parser.add_argument("--output", help="Writes the results here as JSON")
+    parser.add_argument("--baseline", help="Compares against these results")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+        help="Fraction a metric can get worse by before it is a regression")
+    return parser.parse_args()
+
+# Resources used by the process so far, in seconds of CPU and MiB of RSS
+def usage():
+    rusage = getrusage(RUSAGE_SELF)
+    return rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss / 1024
+
+# Runs in its own process so that its CPU and memory are measured on their own
+def serve(args, ready, done, results):
+    server = SocketServer(host, port, binary=True, daemon=True,
+        reactor=args.reactor, loops=args.loops)
+    # Echoes every message straight back from the I/O thread
+    server.add_handler(server.send_message)
+    server.start()
+    server.ready.wait()
+    start_cpu, start_rss = usage()
+    ready.set()
+    done.wait()
+    cpu, rss = usage()
+    results.put((cpu - start_cpu, rss))
+    server.stop()
+
+class Load:
+    def __init__(self, args):
+        self.args = args
+        self.latencies = list()
+        self.sent = 0
+        self.received = 0
+        self.lock = Lock()
+        self.stopped = Event()
+
+    def _received(self, uuid, message):
+        latency = perf_counter() - unpack_from(">d", message)[0]
+        with self.lock:
+            self.latencies.append(latency)
+            self.received = self.received + 1
+
+    # Sends on a schedule when there is a rate, timing each message from when
+    # it should have been sent so that stalls are not hidden
+    def _drive(self, client):
+        padding = b"\0" * max(0, self.args.size - 8)
+        interval = 1 / self.args.rate if self.args.rate > 0 else 0
+        scheduled = perf_counter()
+        sent = 0
+        while not self.stopped.is_set():
+            if interval > 0:
+                delay = scheduled - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+                stamp = scheduled
+                scheduled = scheduled + interval
+            else:
+                stamp = perf_counter()
+            client.send(pack(">d", stamp) + padding)
+            sent = sent + 1
+        with self.lock:
+            self.sent = self.sent + sent
+
+    def run(self):
+        clients = list()
+        for c in range(self.args.clients):
+            # Bounded so that sending flat out waits on the socket
+            client = SocketClient(host, port, binary=True, daemon=True,
+                inbox_size=1024)
+            client.add_handler(self._received)
+            client.start()
+            client.ready.wait()
+            clients.append(client)
+        drivers = [Thread(target=self._drive, args=(client,))
+            for client in clients]
+        start_cpu, start_rss = usage()
+        start = perf_counter()
+        for driver in drivers:
+            driver.start()
+        sleep(self.args.duration)
+        self.stopped.set()
+        for driver in drivers:
+            driver.join()
+        # Gives the messages still in flight a moment to come back
+        sleep(0.5)
+        elapsed = perf_counter() - start
+        cpu, rss = usage()
+        for client in clients:
+            client.stop()
+        return elapsed, cpu - start_cpu, rss
+
+def percentile(ordered, fraction):
+    if len(ordered) == 0:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def compare(results, baseline, tolerance):
+    regressed = list()
+    for metric, value in results["metrics"].items():
+        previous = baseline.get("metrics", dict()).get(metric, None)
+        if previous is None or value is None or previous == 0:
+            continue
+        change = (value - previous) / previous
+        if metric in higher_better:
+            worse = change < -tolerance
+        else:
+            worse = change > tolerance
+        flag = "REGRESSED" if worse else ""
+        print(f"{metric:>16}: {previous:14.3f} -> {value:14.3f} "
+            f"({change:+7.1%}) {flag}")
+        if worse:
+            regressed.append(metric)
+    return regressed
+
+def main():
+    args = parse_args()
+    context = get_context("fork")
+    ready = context.Event()
+    done = context.Event()
+    server_results = context.Queue()
+    server_args = args, ready, done, server_results
+    server = context.Process(target=serve, args=server_args)
+    server.start()
+    ready.wait()
+    load = Load(args)
+    elapsed, client_cpu, client_rss = load.run()
+    done.set()
+    server_cpu, server_rss = server_results.get()
+    server.join()
+
+    latencies = sorted(load.latencies)
+    metrics = dict()
+    metrics["throughput"] = load.received / elapsed
+    metrics["bandwidth"] = load.received * args.size / elapsed / 2**20
+    for name, fraction in [("p50", 0.5), ("p99", 0.99), ("p999", 0.999)]:
+        latency = percentile(latencies, fraction)
+        metrics[f"{name}_ms"] = None if latency is None else latency * 1000
+    metrics["server_cpu"] = server_cpu / elapsed * 100
+    metrics["server_rss_mb"] = server_rss
+    metrics["client_cpu"] = client_cpu / elapsed * 100
+    metrics["client_rss_mb"] = client_rss
+    results = dict()
+    results["config"] = vars(args)
+    results["sent"] = load.sent
+    results["received"] = load.received
+    results["metrics"] = metrics
+    print(jots(results, readable=True))
+
+    if args.output is not None:
+        with open(args.output, "w") as output:
+            output.write(jots(results, readable=True))
+    if args.baseline is not None:
+        with open(args.baseline) as baseline:
+            regressed = compare(results, jsto(baseline.read()),
+                args.tolerance)
+        if len(regressed) > 0:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!env/bin/python3
+
+import sys
+from os.path import dirname, realpath
+
+source = "/".join(dirname(realpath(__file__)).split("/")[:-1])
+sys.path.insert(0, source)
+
+from abots.net import SocketServer, SocketClient, socket_pair
+from abots.net import SharedMemoryChannel
+
+from multiprocessing import get_context
+from time import perf_counter, sleep
+
+host = "127.0.0.1"
+port = 10702
+path = "/tmp/abots-bench.sock"
+timeout = 0.05
+calls = 2000
+messages = 20000
+message_size = 1024
+
+def latency(client):
+    timings = list()
+    for c in range(calls):
+        start = perf_counter()
+        client.request("echo", c, timeout=5)
+        timings.append(perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2], timings[int(len(timings) * 0.99)]
+
+def throughput(client, receive):
+    message = b"x" * message_size
+    received = 0
+    start = perf_counter()
+    for m in range(messages):
+        client.send(message)
+    while received < messages:
+        received = received + len(receive())
+    elapsed = perf_counter() - start
+    return messages / elapsed, messages * message_size / elapsed / 2**20
+
+def report(name, client, receive):
+    p50, p99 = latency(client)
+    rate, mbps = throughput(client, receive)
+    print(f"{name:>10}: p50 {p50 * 1e6:8.1f}us  p99 {p99 * 1e6:8.1f}us  "
+        f"{rate:10.0f} msg/s  {mbps:8.1f} MiB/s")
+
+def bench_server(name, *address):
+    server = SocketServer(*address, timeout=timeout, daemon=True, binary=True)
+    server.register("echo", lambda uuid, value: value)
+    server.start()
+    server.ready.wait()
+    client = SocketClient(*address, timeout=timeout, daemon=True, binary=True)
+    client.start()
+    client.ready.wait()
+    report(name, client, server.recv)
+    client.stop()
+    server.stop()
+    sleep(0.1)
+
+def bench_pair():
+    left, right = socket_pair(timeout=timeout, daemon=True, binary=True)
+    left.start()
+    right.start()
+    left.ready.wait()
+    right.ready.wait()
+    rate, mbps = throughput(left, right.recv)
+    # Pairs have no handlers to answer calls with, so only throughput is run
+    print(f"{'socketpair':>10}: {'':>32}{rate:10.0f} msg/s  {mbps:8.1f} MiB/s")
+    left.stop()
+    right.stop()
+
+# Counts the messages coming in and sends back how many once it has them all
+def drain_ring(name, expected):
+    channel = SharedMemoryChannel(name)
+    received = 0
+    while received < expected:
+        received = received + len(channel.recv(None))
+    channel.send(received)
+    channel.recv(None)
+    channel.close()
+
+def bench_ring(size, batch):
+    name = "abots-bench"
+    total = messages * 50
+    channel = SharedMemoryChannel(name, create=True)
+    reader = get_context("fork").Process(target=drain_ring, args=(name, total))
+    reader.start()
+    message = b"x" * size
+    start = perf_counter()
+    if batch > 1:
+        messages_batch = [message] * batch
+        for b in range(total // batch):
+            channel.send_many(messages_batch)
+    else:
+        for m in range(total):
+            channel.send(message)
+    channel.recv(None)
+    elapsed = perf_counter() - start
+    channel.send("done")
+    reader.join()
+    channel.close()
+    label = f"ring {size}b" + ("" if batch == 1 else f" x{batch}")
+    print(f"{label:>10}: {total / elapsed:10.0f} msg/s  "
+        f"{total * size / elapsed / 2**20:8.1f} MiB/s")
+
+bench_server("tcp", host, port)
+bench_server("unix", path)
+bench_pair()
+for size in [32, message_size]:
+    bench_ring(size, 1)
+    bench_ring(size, 1000)
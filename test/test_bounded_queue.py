@@ -0,0 +1,84 @@
+#!env/bin/python3
+
+import sys
+from os.path import dirname, realpath
+
+source = "/".join(dirname(realpath(__file__)).split("/")[:-1])
+sys.path.insert(0, source)
+
+from abots.net.bounded_queue import BoundedQueue
+
+from queue import Full
+from unittest import TestCase, main
+
+class TestBoundedQueue(TestCase):
+    def drain(self, queue):
+        items = list()
+        while not queue.empty():
+            items.append(queue.get_nowait())
+        return items
+
+    def test_unknown_overflow(self):
+        with self.assertRaises(ValueError):
+            BoundedQueue(2, overflow="spill")
+
+    def test_block_times_out(self):
+        queue = BoundedQueue(2)
+        queue.put(1)
+        queue.put(2)
+        with self.assertRaises(Full):
+            queue.put(3, timeout=0.01)
+        self.assertEqual(self.drain(queue), [1, 2])
+
+    def test_raise(self):
+        queue = BoundedQueue(2, overflow="raise")
+        queue.put(1)
+        queue.put(2)
+        # Raises even when asked to block
+        with self.assertRaises(Full):
+            queue.put(3, block=True)
+        self.assertEqual(self.drain(queue), [1, 2])
+
+    def test_drop_oldest(self):
+        queue = BoundedQueue(2, overflow="drop-oldest")
+        for item in range(5):
+            queue.put(item)
+        self.assertEqual(queue.dropped, 3)
+        self.assertEqual(self.drain(queue), [3, 4])
+        self.assertTrue(queue.wait_for_room(0))
+        self.assertFalse(queue.hold("key"))
+
+    def test_unbounded(self):
+        queue = BoundedQueue(overflow="raise")
+        for item in range(100):
+            queue.put(item)
+        self.assertEqual(queue.qsize(), 100)
+
+    def test_force(self):
+        queue = BoundedQueue(1, overflow="raise")
+        queue.put(1)
+        queue.force(2)
+        self.assertEqual(self.drain(queue), [1, 2])
+
+    def test_wait_for_room(self):
+        queue = BoundedQueue(1)
+        self.assertTrue(queue.wait_for_room(0))
+        queue.put(1)
+        self.assertFalse(queue.wait_for_room(0.01))
+
+    def test_hold_until_half_drained(self):
+        released = list()
+        queue = BoundedQueue(4, on_release=released.append)
+        self.assertFalse(queue.hold("a"))
+        for item in range(4):
+            queue.put(item)
+        self.assertTrue(queue.hold("a"))
+        self.assertTrue(queue.hold("b"))
+        queue.get_nowait()
+        self.assertEqual(released, list())
+        queue.get_nowait()
+        self.assertEqual(released, [{"a", "b"}])
+        self.assertEqual(queue.held, set())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!env/bin/python3
+
+import sys
+from os.path import dirname, realpath
+
+source = "/".join(dirname(realpath(__file__)).split("/")[:-1])
+sys.path.insert(0, source)
+
+from abots.net.framing import FrameDecoder, frame_message, frame_payload
+from abots.net.framing import read_payload, kind_raw, kind_text, kind_json
+
+from socket import socketpair
+from unittest import TestCase, main
+
+class TestFrameDecoder(TestCase):
+    def setUp(self):
+        self.writer, self.reader = socketpair()
+
+    def tearDown(self):
+        self.writer.close()
+        self.reader.close()
+
+    # Sends the data in pieces, reading each one before the next is sent
+    def feed(self, decoder, data, step):
+        counts = list()
+        for start in range(0, len(data), step):
+            self.writer.sendall(data[start:start + step])
+            counts.append(decoder.recv_from(self.reader))
+        return counts
+
+    def test_header_split_across_reads(self):
+        decoder = FrameDecoder()
+        header, body = frame_message("hello")
+        counts = self.feed(decoder, header + body, 1)
+        # Nothing is a frame until its last byte is in
+        self.assertEqual(counts, [0] * (len(header + body) - 1) + [1])
+        self.assertEqual(decoder.pop(), (0, kind_text, b"hello"))
+        self.assertIsNone(decoder.pop())
+
+    def test_frames_sharing_reads(self):
+        decoder = FrameDecoder()
+        data = b"".join(b"".join(frame_message(word))
+            for word in ["one", "two", "three"])
+        self.feed(decoder, data, 5)
+        bodies = [body for flags, kind, body in decoder.frames]
+        self.assertEqual(bodies, [b"one", b"two", b"three"])
+
+    def test_frame_larger_than_buffer(self):
+        decoder = FrameDecoder(buffer_size=16, typed=True)
+        message = bytes(range(256)) * 4
+        header, body = frame_payload(message)
+        self.feed(decoder, header + body, 7)
+        flags, kind, received = decoder.pop()
+        self.assertEqual(kind, kind_raw)
+        self.assertEqual(bytes(received), message)
+
+    def test_typed_frames(self):
+        decoder = FrameDecoder(typed=True)
+        data = b"".join(b"".join(frame_payload(message))
+            for message in ["text", {"a": 1}])
+        self.feed(decoder, data, 3)
+        flags, kind, body = decoder.pop()
+        self.assertEqual(read_payload(kind, body), "text")
+        flags, kind, body = decoder.pop()
+        self.assertEqual(kind, kind_json)
+        self.assertEqual(read_payload(kind, body), {"a": 1})
+
+    def test_closed_connection(self):
+        decoder = FrameDecoder()
+        self.writer.close()
+        with self.assertRaises(ConnectionResetError):
+            decoder.recv_from(self.reader)
+
+    def test_clear_drops_partial_frame(self):
+        decoder = FrameDecoder()
+        header, body = frame_message("lost")
+        self.feed(decoder, header + body[:2], 6)
+        decoder.clear()
+        self.feed(decoder, b"".join(frame_message("kept")), 8)
+        self.assertEqual(decoder.pop(), (0, kind_text, b"kept"))
+
+if __name__ == "__main__":
+    main()
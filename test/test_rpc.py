@@ -0,0 +1,108 @@
+#!env/bin/python3
+
+import sys
+from os.path import dirname, realpath
+
+source = "/".join(dirname(realpath(__file__)).split("/")[:-1])
+sys.path.insert(0, source)
+
+from abots.net.rpc import Calls, RemoteError, answer
+
+from unittest import TestCase, main
+
+class TestCalls(TestCase):
+    def setUp(self):
+        self.calls = Calls()
+
+    def test_resolve(self):
+        future, request = self.calls.create("add", (1, 2))
+        self.assertEqual(request["method"], "add")
+        self.assertEqual(request["params"], [1, 2])
+        reply = dict()
+        reply["id"] = request["id"]
+        reply["result"] = 3
+        self.calls.resolve(reply)
+        self.assertEqual(future.result(0), 3)
+        self.assertEqual(len(self.calls), 0)
+
+    def test_remote_error(self):
+        future, request = self.calls.create("add", tuple())
+        reply = dict()
+        reply["id"] = request["id"]
+        reply["error"] = "TypeError()"
+        self.calls.resolve(reply)
+        with self.assertRaises(RemoteError):
+            future.result(0)
+
+    def test_ids_are_unique(self):
+        first = self.calls.create("a", tuple())[1]["id"]
+        second = self.calls.create("a", tuple())[1]["id"]
+        self.assertNotEqual(first, second)
+
+    def test_unknown_replies_are_ignored(self):
+        future, request = self.calls.create("a", tuple())
+        self.calls.resolve({"id": request["id"] + 1, "result": 1})
+        self.calls.resolve("not a reply")
+        self.assertFalse(future.done())
+        self.assertEqual(len(self.calls), 1)
+
+    def test_expire(self):
+        expired, request = self.calls.create("a", tuple(), timeout=0)
+        waiting, request = self.calls.create("b", tuple(), timeout=60)
+        forever, request = self.calls.create("c", tuple())
+        self.calls.expire()
+        with self.assertRaises(TimeoutError):
+            expired.result(0)
+        self.assertFalse(waiting.done())
+        self.assertFalse(forever.done())
+        self.assertEqual(len(self.calls), 2)
+
+    def test_late_reply_after_expire(self):
+        future, request = self.calls.create("a", tuple(), timeout=0)
+        self.calls.expire()
+        # Would raise `InvalidStateError` if the call were still known
+        self.calls.resolve({"id": request["id"], "result": 1})
+        with self.assertRaises(TimeoutError):
+            future.result(0)
+
+    def test_fail(self):
+        futures = [self.calls.create("a", tuple())[0] for _ in range(3)]
+        self.calls.fail(ConnectionResetError("Connection lost"))
+        for future in futures:
+            with self.assertRaises(ConnectionResetError):
+                future.result(0)
+        self.assertEqual(len(self.calls), 0)
+
+    def test_discard(self):
+        future, request = self.calls.create("a", tuple())
+        self.calls.discard(request["id"])
+        self.assertEqual(len(self.calls), 0)
+        self.calls.fail(ConnectionResetError())
+        self.assertFalse(future.done())
+
+class TestAnswer(TestCase):
+    def setUp(self):
+        self.methods = dict()
+        self.methods["add"] = lambda a, b: a + b
+
+    def test_result(self):
+        reply = answer(self.methods, {"id": 1, "method": "add",
+            "params": [1, 2]})
+        self.assertEqual(reply, {"id": 1, "result": 3})
+
+    def test_handler_error(self):
+        reply = answer(self.methods, {"id": 1, "method": "add",
+            "params": [1]})
+        self.assertEqual(reply["id"], 1)
+        self.assertIn("TypeError", reply["error"])
+
+    def test_unknown_method(self):
+        reply = answer(self.methods, {"id": 2, "method": "sub"})
+        self.assertEqual(reply["error"], "Unknown method: sub")
+
+    def test_malformed(self):
+        reply = answer(self.methods, [1, 2])
+        self.assertEqual(reply, {"id": None, "error": "Malformed call"})
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!env/bin/python3
+
+import sys
+from os.path import dirname, realpath
+
+source = "/".join(dirname(realpath(__file__)).split("/")[:-1])
+sys.path.insert(0, source)
+
+from abots.events.threads import PriorityJobQueue
+from abots.helpers import noop
+
+from concurrent.futures import Future
+from queue import Empty
+from time import monotonic, sleep
+from unittest import TestCase, main
+
+def job(name, future=None):
+    controls = dict()
+    controls["name"] = name
+    if future is not None:
+        controls["future"] = future
+    return controls, (print, (name,), dict())
+
+class TestPriorityJobQueue(TestCase):
+    def names(self, queue):
+        names = list()
+        while not queue.empty():
+            controls, task = queue.get_nowait()
+            names.append(controls["name"])
+        return names
+
+    def test_strict_priorities(self):
+        queue = PriorityJobQueue()
+        queue.put_nowait(job("low"), priority=5)
+        queue.put_nowait(job("high"), priority=0)
+        queue.put_nowait(job("middle"), priority=2)
+        queue.put_nowait(job("high again"), priority=0)
+        expected = ["high", "high again", "middle", "low"]
+        self.assertEqual(self.names(queue), expected)
+
+    def test_aging(self):
+        queue = PriorityJobQueue(aging=0.01)
+        queue.put_nowait(job("old"), priority=2)
+        # Waited longer than the 0.02 seconds its priority is worth
+        sleep(0.05)
+        queue.put_nowait(job("new"), priority=0)
+        self.assertEqual(self.names(queue), ["old", "new"])
+
+    def test_aging_keeps_priority_when_fresh(self):
+        queue = PriorityJobQueue(aging=60)
+        queue.put_nowait(job("old"), priority=2)
+        sleep(0.01)
+        queue.put_nowait(job("new"), priority=0)
+        self.assertEqual(self.names(queue), ["new", "old"])
+
+    def test_expired_without_handler(self):
+        queue = PriorityJobQueue()
+        future = Future()
+        queue.put_nowait(job("late", future), deadline=monotonic() - 1)
+        controls, task = queue.get_nowait()
+        self.assertEqual(task, (noop, tuple(), dict()))
+        self.assertNotIn("future", controls)
+        with self.assertRaises(TimeoutError):
+            future.result(0)
+        self.assertEqual(queue.stats.classes[0][:2], [0, 1])
+
+    def test_expired_with_handler(self):
+        queue = PriorityJobQueue()
+        expired = list()
+        late = job("late")
+        queue.put_nowait(late, deadline=monotonic() - 1,
+            on_expired=expired.append)
+        controls, (function, args, kwargs) = queue.get_nowait()
+        self.assertTrue(controls["inline"])
+        function(*args, **kwargs)
+        self.assertEqual(expired, [late[1]])
+
+    def test_within_deadline(self):
+        queue = PriorityJobQueue()
+        queue.put_nowait(job("on time"), deadline=monotonic() + 60)
+        controls, task = queue.get_nowait()
+        self.assertEqual(controls["name"], "on time")
+        self.assertEqual(queue.stats.totals()[0], 1)
+
+    def test_pills_never_expire(self):
+        queue = PriorityJobQueue()
+        pill = dict(), None
+        queue.put_nowait(pill, deadline=monotonic() - 1)
+        self.assertIs(queue.get_nowait(), pill)
+
+    def test_empty(self):
+        queue = PriorityJobQueue()
+        with self.assertRaises(Empty):
+            queue.get_nowait()
+        with self.assertRaises(Empty):
+            queue.get(timeout=0.01)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+#!env/bin/python3
+
+import sys
+from os.path import dirname, realpath
+
+source = "/".join(dirname(realpath(__file__)).split("/")[:-1])
+sys.path.insert(0, source)
+
+from abots.net.shared_ring import SharedRing
+
+from os import getpid
+from unittest import TestCase, main
+
+class TestSharedRing(TestCase):
+    def setUp(self):
+        self.ring = SharedRing(f"abots-test-{getpid()}", create=True, size=64)
+
+    def tearDown(self):
+        self.ring.close()
+
+    def test_round_trip(self):
+        self.assertTrue(self.ring.empty())
+        self.assertTrue(self.ring.put(1, b"hello"))
+        self.assertFalse(self.ring.empty())
+        self.assertEqual(self.ring.get_many(), [(1, b"hello")])
+        self.assertTrue(self.ring.empty())
+
+    def test_wraps_with_marker(self):
+        records = [(0, bytes([index]) * 20) for index in range(2)]
+        self.assertEqual(self.ring.put_many(records), 2)
+        self.assertEqual(self.ring.get_many(), records)
+        # Only 14 bytes are left at the end, so the next one starts over
+        records = [(0, bytes([index]) * 20) for index in range(2, 4)]
+        self.assertEqual(self.ring.put_many(records), 2)
+        self.assertEqual(self.ring.get_many(), records)
+        self.assertEqual(self.ring.free(), self.ring.capacity)
+
+    def test_wraps_without_room_for_marker(self):
+        records = [(0, b"a" * 25), (0, b"b" * 26)]
+        self.assertEqual(self.ring.put_many(records), 2)
+        self.assertEqual(self.ring.get_many(), records)
+        # Leaves 3 bytes at the end, too few for the marker
+        self.assertTrue(self.ring.put(2, b"c" * 10))
+        self.assertEqual(self.ring.get_many(), [(2, b"c" * 10)])
+
+    def test_full(self):
+        records = [(0, bytes([index]) * 15) for index in range(4)]
+        self.assertEqual(self.ring.put_many(records), 3)
+        self.assertFalse(self.ring.put(0, b"d" * 15))
+        self.assertEqual(self.ring.get_many(), records[:3])
+        self.assertEqual(self.ring.put_many(records[3:]), 1)
+        self.assertEqual(self.ring.get_many(), records[3:])
+
+    def test_record_too_large(self):
+        with self.assertRaises(ValueError):
+            self.ring.put(0, b"x" * 40)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#!env/bin/python3
+
+import sys
+from os.path import dirname, realpath
+
+source = "/".join(dirname(realpath(__file__)).split("/")[:-1])
+sys.path.insert(0, source)
+
+from abots.net.topics import TopicIndex
+
+from unittest import TestCase, main
+
+class TestTopicIndex(TestCase):
+    def setUp(self):
+        self.index = TopicIndex()
+
+    def test_exact(self):
+        self.index.subscribe("a", "chat.lobby")
+        self.assertEqual(self.index.match("chat.lobby"), {"a"})
+        self.assertEqual(self.index.match("chat"), set())
+        self.assertEqual(self.index.match("chat.lobby.mods"), set())
+
+    def test_star_matches_one_segment(self):
+        self.index.subscribe("a", "chat.*")
+        self.index.subscribe("b", "*.lobby")
+        self.assertEqual(self.index.match("chat.lobby"), {"a", "b"})
+        self.assertEqual(self.index.match("chat.games"), {"a"})
+        self.assertEqual(self.index.match("chat"), set())
+        self.assertEqual(self.index.match("chat.lobby.mods"), set())
+
+    def test_hash_matches_any_number_of_segments(self):
+        self.index.subscribe("a", "chat.#")
+        self.index.subscribe("b", "#")
+        self.assertEqual(self.index.match("chat"), {"a", "b"})
+        self.assertEqual(self.index.match("chat.lobby.mods"), {"a", "b"})
+        self.assertEqual(self.index.match("news"), {"b"})
+
+    def test_star_then_hash(self):
+        self.index.subscribe("a", "*.lobby.#")
+        self.assertEqual(self.index.match("chat.lobby"), {"a"})
+        self.assertEqual(self.index.match("games.lobby.mods"), {"a"})
+        self.assertEqual(self.index.match("chat.games"), set())
+
+    def test_unsubscribe(self):
+        self.index.subscribe("a", "chat.*")
+        self.index.subscribe("b", "chat.*")
+        self.index.unsubscribe("a", "chat.*")
+        self.assertEqual(self.index.match("chat.lobby"), {"b"})
+        self.index.unsubscribe("b", "chat.*")
+        self.assertEqual(self.index.match("chat.lobby"), set())
+        # Nothing is left behind once the last subscriber is gone
+        self.assertEqual(self.index._root["children"], dict())
+        self.assertEqual(self.index.patterns, dict())
+
+    def test_remove(self):
+        self.index.subscribe("a", "chat.#")
+        self.index.subscribe("a", "news.*")
+        self.index.subscribe("b", "news.*")
+        self.index.remove("a")
+        self.assertEqual(self.index.match("chat.lobby"), set())
+        self.assertEqual(self.index.match("news.today"), {"b"})
+
+if __name__ == "__main__":
+    main()